@@ -0,0 +1,414 @@
+import collections
+import concurrent.futures
+import json
+import logging
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+import joblib
+import redis
+
+from metabolomics_spectrum_resolver import config, deadlines, parsing, upstream
+from metabolomics_spectrum_resolver.error import UsiError
+
+
+logger = logging.getLogger(__name__)
+
+_redis_client = None
+_redis_retry_time = 0.0
+_redis_lock = threading.Lock()
+# Fallback negative cache entries (expiry time, error code, message) if
+# Redis is unavailable.
+_negative_cache: "collections.OrderedDict[str, Tuple[float, int, str]]" = (
+    collections.OrderedDict()
+)
+_negative_cache_lock = threading.Lock()
+# Fallback MassIVE file entries (expiry time, files) per msRun if Redis is
+# unavailable.
+_msv_files: "collections.OrderedDict[str, Tuple[float, Dict[str, bool]]]" = (
+    collections.OrderedDict()
+)
+_msv_files_lock = threading.Lock()
+_refreshes: Dict[str, float] = {}
+_refreshes_lock = threading.Lock()
+_flights: Dict[Hashable, concurrent.futures.Future] = {}
+_flights_lock = threading.Lock()
+
+
+def get_redis() -> Optional[redis.Redis]:
+    """
+    Get the Redis client shared by the web and worker processes.
+
+    Returns
+    -------
+    Optional[redis.Redis]
+        The Redis client, or None if Redis recently was unavailable.
+    """
+    global _redis_client
+    if time.time() < _redis_retry_time:
+        return None
+    with _redis_lock:
+        if _redis_client is None:
+            _redis_client = redis.Redis.from_url(
+                config.REDIS_URL,
+                socket_connect_timeout=config.REDIS_TIMEOUT,
+                socket_timeout=config.REDIS_TIMEOUT,
+            )
+    return _redis_client
+
+
+def redis_unavailable() -> None:
+    """
+    Stop using Redis for `config.REDIS_RETRY_INTERVAL` seconds after a failed
+    Redis command.
+    """
+    global _redis_retry_time
+    if time.time() >= _redis_retry_time:
+        logger.warning(
+            "Redis unavailable, retrying in %d seconds",
+            config.REDIS_RETRY_INTERVAL,
+        )
+    _redis_retry_time = time.time() + config.REDIS_RETRY_INTERVAL
+
+
+def singleflight(
+    key: Hashable, func: Callable[..., Any], *args: Any, **kwargs: Any
+) -> Any:
+    """
+    Call a function, sharing the computation with concurrent identical calls
+    in the current process.
+
+    If a call with the same key is already in progress, its result (or
+    exception) is returned instead of calling the function again. Callers
+    wait for the shared result until the deadline of their own request.
+
+    Parameters
+    ----------
+    key : Hashable
+        A unique key for the function call.
+    func : Callable[..., Any]
+        The function to be called.
+    args : Any
+        The function arguments.
+    kwargs : Any
+        The function keyword arguments.
+
+    Returns
+    -------
+    Any
+        The function's result, which is shared by all concurrent callers.
+    """
+    with _flights_lock:
+        flight = _flights.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _flights[key] = concurrent.futures.Future()
+    if not is_leader:
+        try:
+            return flight.result(timeout=deadlines.remaining())
+        except concurrent.futures.TimeoutError:
+            raise deadlines.exceeded()
+    try:
+        result = func(*args, **kwargs)
+    except BaseException as e:
+        flight.set_exception(e)
+        raise
+    else:
+        flight.set_result(result)
+        return result
+    finally:
+        with _flights_lock:
+            del _flights[key]
+
+
+def timestamped(
+    func: Callable[..., Any], *args: Any
+) -> Tuple[float, float, Any]:
+    """
+    Call a function and record when and how long it was computed, for use
+    with `get_revalidated`.
+
+    Parameters
+    ----------
+    func : Callable[..., Any]
+        The function to be called.
+    args : Any
+        The function arguments.
+
+    Returns
+    -------
+    Tuple[float, float, Any]
+        A tuple of (i) the time at which the computation started, (ii) its
+        duration in seconds, and (iii) the function's result.
+    """
+    start = time.time()
+    result = func(*args)
+    return start, time.time() - start, result
+
+
+def get_revalidated(
+    cached_func: joblib.memory.MemorizedFunc,
+    key: str,
+    *args: Any,
+    **refresh_kwargs: Any,
+) -> Any:
+    """
+    Get a cached result and refresh it in the background when it's stale.
+
+    Stale results are returned immediately while a single background refresh
+    recomputes them. Results are considered stale after
+    `config.CACHE_SOFT_TTL` seconds, or probabilistically somewhat earlier
+    (XFetch) to avoid refreshing many results that were cached at the same
+    time simultaneously. How much earlier depends on the computation time and
+    on the soft TTL itself (see `config.CACHE_SOFT_TTL_JITTER`).
+
+    Parameters
+    ----------
+    cached_func : joblib.memory.MemorizedFunc
+        The cached function, which returns its results as produced by
+        `timestamped`.
+    key : str
+        A unique key for the function call.
+    args : Any
+        The function arguments.
+    refresh_kwargs : Any
+        Additional keyword arguments that are only passed when the result is
+        refreshed. They should be ignored by the cache.
+
+    Returns
+    -------
+    Any
+        The (possibly stale) result of the function call.
+    """
+    fetch_time, duration, result = cached_func(*args)
+    # Refresh probabilistically earlier the longer the computation takes,
+    # with a head start proportional to the soft TTL.
+    early = (
+        duration * config.CACHE_XFETCH_BETA
+        + config.CACHE_SOFT_TTL * config.CACHE_SOFT_TTL_JITTER
+    ) * random.expovariate(1)
+    if time.time() + early >= fetch_time + config.CACHE_SOFT_TTL:
+        _schedule_refresh(cached_func, key, *args, **refresh_kwargs)
+    return result
+
+
+def get_negative(usi: str) -> Optional[UsiError]:
+    """
+    Get the error of a USI that recently failed to resolve.
+
+    Parameters
+    ----------
+    usi : str
+        The USI of the spectrum to be retrieved from its resource.
+
+    Returns
+    -------
+    Optional[UsiError]
+        The cached error, or None if the USI didn't fail recently.
+    """
+    key = _negative_key(usi)
+    client = get_redis()
+    if client is not None:
+        try:
+            value = client.get(key)
+        except redis.exceptions.RedisError:
+            redis_unavailable()
+        else:
+            if value is None:
+                return None
+            error = json.loads(value)
+            return UsiError(error["message"], error["code"])
+    with _negative_cache_lock:
+        expiry, error_code, message = _negative_cache.get(key, (0, 0, ""))
+        if expiry < time.time():
+            _negative_cache.pop(key, None)
+            return None
+    return UsiError(message, error_code)
+
+
+def set_negative(usi: str, error: UsiError) -> None:
+    """
+    Remember that a USI failed to resolve.
+
+    Errors are cached for a duration that depends on their error code, as
+    specified by `config.NEGATIVE_CACHE_TTL`. Other errors are not cached.
+
+    Parameters
+    ----------
+    usi : str
+        The USI of the spectrum that failed to resolve.
+    error : UsiError
+        The error that was raised while resolving the USI.
+    """
+    ttl = config.NEGATIVE_CACHE_TTL.get(error.error_code)
+    if ttl is None:
+        return
+    key = _negative_key(usi)
+    client = get_redis()
+    if client is not None:
+        value = json.dumps(
+            {"code": error.error_code, "message": error.message}
+        )
+        try:
+            client.setex(key, ttl, value)
+            return
+        except redis.exceptions.RedisError:
+            redis_unavailable()
+    with _negative_cache_lock:
+        _negative_cache[key] = (
+            time.time() + ttl,
+            error.error_code,
+            error.message,
+        )
+        _negative_cache.move_to_end(key)
+        while len(_negative_cache) > config.NEGATIVE_CACHE_MAX_LOCAL:
+            _negative_cache.popitem(last=False)
+
+
+def _negative_key(usi: str) -> str:
+    return f"usi:negative:{parsing.canonicalize_usi(usi)}"
+
+
+def get_msv_files(dataset: str, ms_run: str) -> Dict[str, bool]:
+    """
+    Get the MassIVE files that previously did or didn't contain the scans of
+    an msRun.
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset identifier (e.g. "MSV000082791" or "PXD000561").
+    ms_run : str
+        The msRun name.
+
+    Returns
+    -------
+    Dict[str, bool]
+        The MassIVE file descriptors that were probed for scans of the msRun,
+        and whether they contained the scans.
+    """
+    key = _msv_files_key(dataset, ms_run)
+    client = get_redis()
+    if client is not None:
+        try:
+            files = client.hgetall(key)
+        except redis.exceptions.RedisError:
+            redis_unavailable()
+        else:
+            return {
+                file_descriptor.decode(): found == b"1"
+                for file_descriptor, found in files.items()
+            }
+    with _msv_files_lock:
+        expiry, files = _msv_files.get(key, (0, {}))
+        if expiry < time.time():
+            _msv_files.pop(key, None)
+            return {}
+        return dict(files)
+
+
+def set_msv_files(dataset: str, ms_run: str, files: Dict[str, bool]) -> None:
+    """
+    Remember which MassIVE files did or didn't contain a scan of an msRun.
+
+    Files are remembered for `config.MSV_FILE_CACHE_TTL` seconds after they
+    were last probed.
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset identifier (e.g. "MSV000082791" or "PXD000561").
+    ms_run : str
+        The msRun name.
+    files : Dict[str, bool]
+        The MassIVE file descriptors that were probed for a scan of the
+        msRun, and whether they contained the scan.
+    """
+    if not files:
+        return
+    key = _msv_files_key(dataset, ms_run)
+    client = get_redis()
+    if client is not None:
+        try:
+            pipeline = client.pipeline()
+            pipeline.hset(
+                key,
+                mapping={
+                    file_descriptor: int(found)
+                    for file_descriptor, found in files.items()
+                },
+            )
+            pipeline.expire(key, config.MSV_FILE_CACHE_TTL)
+            pipeline.execute()
+            return
+        except redis.exceptions.RedisError:
+            redis_unavailable()
+    with _msv_files_lock:
+        expiry, cached_files = _msv_files.get(key, (0, {}))
+        if expiry < time.time():
+            cached_files = {}
+        _msv_files[key] = (
+            time.time() + config.MSV_FILE_CACHE_TTL,
+            {**cached_files, **files},
+        )
+        _msv_files.move_to_end(key)
+        while len(_msv_files) > config.MSV_FILE_CACHE_MAX_LOCAL:
+            _msv_files.popitem(last=False)
+
+
+def _msv_files_key(dataset: str, ms_run: str) -> str:
+    return f"msv:files:{dataset.upper()}:{ms_run}"
+
+
+def _schedule_refresh(
+    cached_func: joblib.memory.MemorizedFunc,
+    key: str,
+    *args: Any,
+    **kwargs: Any,
+) -> None:
+    # Refresh at most once per interval across all processes.
+    with _refreshes_lock:
+        if time.time() - _refreshes.get(key, 0) < (
+            config.CACHE_REFRESH_INTERVAL
+        ):
+            return
+        _refreshes[key] = time.time()
+        # Forget old refreshes.
+        for old_key in [
+            old_key
+            for old_key, refresh_time in _refreshes.items()
+            if time.time() - refresh_time >= config.CACHE_REFRESH_INTERVAL
+        ]:
+            del _refreshes[old_key]
+    client = get_redis()
+    if client is not None:
+        try:
+            if not client.set(
+                f"cache:refresh:{key}",
+                1,
+                nx=True,
+                ex=config.CACHE_REFRESH_INTERVAL,
+            ):
+                return
+        except redis.exceptions.RedisError:
+            redis_unavailable()
+    upstream.executor("refresh").submit(
+        _refresh, cached_func, key, *args, **kwargs
+    )
+
+
+def _refresh(
+    cached_func: joblib.memory.MemorizedFunc,
+    key: str,
+    *args: Any,
+    **kwargs: Any,
+) -> None:
+    try:
+        # Recompute the result and overwrite the cached result.
+        cached_func.call(*args, **kwargs)
+        logger.debug("Refreshed cached %s", key)
+    except Exception:
+        # Keep serving the stale result.
+        logger.warning("Failed to refresh cached %s", key, exc_info=True)
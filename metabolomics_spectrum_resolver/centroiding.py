@@ -0,0 +1,104 @@
+from typing import Tuple
+
+import numba as nb
+import numpy as np
+import spectrum_utils.spectrum as sus
+
+from metabolomics_spectrum_resolver import config
+
+
+def centroid_spectrum(spectrum: sus.MsmsSpectrum) -> sus.MsmsSpectrum:
+    """
+    Convert a profile-mode spectrum to a centroided spectrum.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum to be centroided.
+
+    Returns
+    -------
+    sus.MsmsSpectrum
+        A new spectrum with a single peak per profile peak. Its other
+        properties are copied from the given spectrum.
+    """
+    mz, intensity = centroid(spectrum.mz, spectrum.intensity)
+    return sus.MsmsSpectrum(
+        spectrum.identifier,
+        spectrum.precursor_mz,
+        spectrum.precursor_charge,
+        mz,
+        intensity,
+        retention_time=spectrum.retention_time,
+        peptide=spectrum.peptide,
+        modifications=spectrum.modifications,
+        is_decoy=spectrum.is_decoy,
+    )
+
+
+def centroid(
+    mz: np.ndarray, intensity: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Centroid profile-mode peaks by picking the local intensity maxima.
+
+    Consecutive points that are at most `config.CENTROID_MAX_MZ_GAP` apart
+    belong to the same profile. Each local maximum becomes a peak with the
+    apex of a parabola through the maximum and its neighbors. Isolated points
+    are kept unchanged, so already centroided peaks are retained. Points
+    without intensity are removed.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The m/z values of the profile points, in ascending order.
+    intensity : np.ndarray
+        The intensities of the profile points.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Contiguous float32 arrays of the m/z values and intensities of the
+        centroided peaks.
+    """
+    return _centroid(
+        np.asarray(mz, np.float64),
+        np.asarray(intensity, np.float64),
+        config.CENTROID_MAX_MZ_GAP,
+    )
+
+
+@nb.njit
+def _centroid(
+    mz: np.ndarray, intensity: np.ndarray, max_mz_gap: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    centroid_mz = np.empty(len(mz), np.float32)
+    centroid_intensity = np.empty(len(mz), np.float32)
+    n = 0
+    for i in range(len(mz)):
+        has_left = i > 0 and mz[i] - mz[i - 1] <= max_mz_gap
+        has_right = i < len(mz) - 1 and mz[i + 1] - mz[i] <= max_mz_gap
+        # Plateaus are assigned to their first point.
+        if (
+            intensity[i] <= 0
+            or (has_left and intensity[i - 1] >= intensity[i])
+            or (has_right and intensity[i + 1] > intensity[i])
+        ):
+            continue
+        centroid_mz[n], centroid_intensity[n] = mz[i], intensity[i]
+        if has_left and has_right:
+            # Parabola through the neighbors, relative to the maximum.
+            d_left, d_right = mz[i - 1] - mz[i], mz[i + 1] - mz[i]
+            e_left = intensity[i - 1] - intensity[i]
+            e_right = intensity[i + 1] - intensity[i]
+            det = d_left * d_right * (d_left - d_right)
+            a = (e_left * d_right - e_right * d_left) / det
+            b = (d_left ** 2 * e_right - d_right ** 2 * e_left) / det
+            if a < 0:
+                offset = min(max(-b / (2 * a), d_left), d_right)
+                centroid_mz[n] = mz[i] + offset
+                centroid_intensity[n] = intensity[i] + offset * (
+                    a * offset + b
+                )
+        n += 1
+    return centroid_mz[:n].copy(), centroid_intensity[:n].copy()
@@ -1 +1,217 @@
 USI_SERVER = "https://metabolomics-usi.ucsd.edu/"
+
+# Redis instance to share state between the web and worker processes.
+REDIS_URL = "redis://metabolomicsusi-redis:6379/0"
+# Connect and read timeout (in seconds) for Redis commands.
+REDIS_TIMEOUT = 0.5
+# Interval (in seconds) during which Redis isn't used after it failed.
+REDIS_RETRY_INTERVAL = 30
+
+# Duration (in seconds) within which requests are answered. Upstream lookups
+# for a request only get the remaining time and are abandoned afterwards.
+REQUEST_TIMEOUT = 30
+
+# Maximum number of parsed USIs that are memoized per process.
+USI_PARSE_CACHE_SIZE = 65536
+
+# Duration (in seconds) after which cached spectra are stale. Stale spectra
+# are still served while they're refreshed in the background.
+CACHE_SOFT_TTL = 7 * 24 * 60 * 60
+# Tendency to refresh cached spectra early (XFetch), relative to their
+# computation time. Use 0 to only refresh after the soft TTL.
+CACHE_XFETCH_BETA = 1.0
+# Tendency to refresh cached spectra early, relative to the soft TTL.
+# Computations take seconds, which is negligible against a soft TTL of days,
+# so this spreads the refreshes of spectra that were cached at the same time
+# over several hours instead (the expected head start is 5% of the soft TTL).
+# Use 0 to only refresh early based on the computation time.
+CACHE_SOFT_TTL_JITTER = 0.05
+# Minimum interval (in seconds) between background refreshes of the same
+# cached spectrum.
+CACHE_REFRESH_INTERVAL = 300
+
+# Duration (in seconds) that USIs which failed to resolve are remembered per
+# error code. Other errors are not cached.
+NEGATIVE_CACHE_TTL = {
+    404: 3600,
+    502: 60,
+    503: 30,
+    413: 3600,
+    504: 60,
+}
+# Maximum number of failed USIs remembered per process if Redis is
+# unavailable.
+NEGATIVE_CACHE_MAX_LOCAL = 65536
+
+# Maximum number of peaks and response size (in bytes) of upstream spectra.
+# Larger spectra are rejected while they're being downloaded.
+MAX_SPECTRUM_PEAKS = 2 ** 20
+MAX_SPECTRUM_BYTES = 2 ** 26
+# Size (in bytes) of the chunks in which upstream spectra are read.
+STREAM_CHUNK_SIZE = 2 ** 16
+
+# Maximum m/z difference between consecutive points of the same profile
+# peak when centroiding profile-mode spectra.
+CENTROID_MAX_MZ_GAP = 0.05
+
+# Connection pool settings for the upstream resources. Each backend gets its
+# own keep-alive session; per-backend values override the defaults.
+UPSTREAM_POOL_DEFAULTS = {
+    "pool_connections": 4,
+    "pool_maxsize": 16,
+    "retries": 2,
+    "backoff_factor": 0.3,
+}
+UPSTREAM_POOLS = {
+    "gnps": {"pool_maxsize": 64},
+    "massive": {"pool_maxsize": 64},
+    "massbank": {},
+    "ms2lda": {},
+}
+# Number of consecutive connection errors, timeouts, or gateway errors after
+# which requests to an upstream backend fail immediately.
+CIRCUIT_BREAKER_THRESHOLD = 5
+# Duration (in seconds) that requests fail immediately before a probe request
+# checks whether the backend has recovered.
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+# Duration (in seconds) after which an unfinished probe request is
+# considered to have failed.
+CIRCUIT_BREAKER_PROBE_TIMEOUT = 60
+# Limits per upstream backend on the number of concurrent requests, and the
+# sustained request rate (per second) and burst size of requests, across all
+# processes. Backends without limits are not limited. Background GNPS task
+# file downloads have separate limits so that they don't take the slots of
+# interactive lookups, with a minimum lease (in seconds) that covers the
+# whole download.
+UPSTREAM_LIMITS = {
+    "gnps": {"concurrency": 32, "rate": 50, "burst": 100},
+    "gnps_download": {
+        "concurrency": 4,
+        "rate": 1,
+        "burst": 4,
+        "lease": 3600,
+    },
+    "massive": {"concurrency": 16, "rate": 20, "burst": 40},
+    "massbank": {"concurrency": 8, "rate": 10, "burst": 20},
+    "ms2lda": {"concurrency": 8, "rate": 10, "burst": 20},
+}
+# Maximum duration (in seconds) that a request waits to be admitted by the
+# upstream limits before failing.
+UPSTREAM_LIMIT_QUEUE_TIMEOUT = 5
+# Duration (in seconds) beyond a request's deadline or timeout after which
+# the concurrency slot of an unfinished request (e.g. from a crashed process)
+# is released.
+UPSTREAM_LIMIT_LEASE_GRACE = 30
+# Number of recent requests per upstream backend from which latency
+# percentiles are computed, and the minimum number of requests required.
+LATENCY_WINDOW = 1000
+LATENCY_MIN_SAMPLES = 50
+# Connect and read timeouts (in seconds) of upstream requests are derived
+# from the recently observed latencies per backend endpoint: the latency
+# percentile times the multiplier, bounded by the minimum and maximum
+# timeouts. Per-backend bounds override the defaults. Requests don't wait
+# beyond the REQUEST_TIMEOUT deadline, so maximum timeouts should leave time
+# within it.
+UPSTREAM_TIMEOUT_PERCENTILES = {"connect": 50, "read": 99}
+UPSTREAM_TIMEOUT_MULTIPLIER = 3
+UPSTREAM_TIMEOUT_DEFAULTS = {"connect": (1, 10), "read": (2, 25)}
+UPSTREAM_TIMEOUTS = {
+    "massbank": {"read": (1, 15)},
+    "massive": {"read": (5, 25)},
+}
+# Slow requests to an upstream backend are hedged by a second identical
+# request after the backend's latency percentile. The budget per backend is
+# the maximum fraction of requests that are hedged; backends without a budget
+# are not hedged.
+HEDGE_PERCENTILE = 95
+HEDGE_BUDGET = {
+    "gnps": 0.02,
+    "massive": 0.05,
+}
+# Maximum number of hedged requests per backend in a burst.
+HEDGE_MAX_TOKENS = 10
+# Equivalent base URLs that serve the same content per upstream backend.
+# Lookups are sent to the healthiest and fastest mirror first, and raced
+# against the next mirror if they fail or are slower than the mirror's
+# `HEDGE_PERCENTILE` latency. Add hosts that serve the same ProteoSAFe API to
+# enable racing.
+UPSTREAM_MIRRORS = {
+    "gnps": ["https://gnps.ucsd.edu"],
+}
+# Delay (in seconds) before racing the next mirror if the latency of a
+# mirror is unknown.
+MIRROR_RACE_DELAY = 2
+# Maximum number of concurrent upstream lookups per process and I/O pool.
+UPSTREAM_EXECUTORS = {
+    "resolve": 256,
+    "probe": 64,
+    "download": 4,
+    "refresh": 8,
+    "hedge": 64,
+}
+# Maximum number of candidate MassIVE files probed concurrently per USI.
+MSV_MAX_CONCURRENT_PROBES = 4
+# Duration (in seconds) that the MassIVE files which did or didn't contain
+# the scans of an msRun are remembered. Later scans of the msRun are
+# retrieved directly from the file that contained earlier scans.
+MSV_FILE_CACHE_TTL = 24 * 60 * 60
+# Maximum number of msRuns whose MassIVE files are remembered per process if
+# Redis is unavailable.
+MSV_FILE_CACHE_MAX_LOCAL = 65536
+# Maximum number of concurrent lookups per upstream backend when resolving
+# a batch of USIs.
+BATCH_MAX_CONCURRENT = {
+    "gnps": 16,
+    "massive": 8,
+    "massbank": 8,
+    "ms2lda": 4,
+}
+# Maximum number of USIs in a single batch request.
+BATCH_MAX_USIS = 1000
+
+# Local spectrum stores built with `python -m
+# metabolomics_spectrum_resolver.ingest`. Spectra missing from a store are
+# retrieved from the remote resource. Set to None to disable a store.
+GNPS_LIBRARY_STORE = "tmp/mirrors/gnps_library"
+MASSBANK_STORE = "tmp/mirrors/massbank"
+# MS2LDA experiments (one store per experiment) and the MotifDB snapshot are
+# also prefetched in the background when they're first used.
+MS2LDA_STORE = "tmp/mirrors/ms2lda"
+MOTIFDB_STORE = "tmp/mirrors/motifdb"
+# Minimum interval (in seconds) between background prefetches of the same
+# MS2LDA experiment or MotifDB.
+MS2LDA_PREFETCH_INTERVAL = 3600
+# Age (in seconds) after which MS2LDA experiment and MotifDB stores are
+# prefetched again. Outdated stores are served until they're replaced.
+MS2LDA_STORE_MAX_AGE = 7 * 24 * 60 * 60
+# Connect and read timeout (in seconds) for MS2LDA and MotifDB prefetches.
+MS2LDA_PREFETCH_TIMEOUT = (10, 300)
+# Maximum size (in bytes) of a prefetched MS2LDA experiment or MotifDB
+# response.
+MS2LDA_PREFETCH_MAX_BYTES = 2 ** 30
+# Local copies of public dataset peak files (mzML, mzXML, or MGF), organized
+# as <LOCAL_DATASET_ROOT>/<dataset identifier>/.../<msRun>.<extension>.
+# Spectra missing locally are retrieved from MassIVE. Set to None to disable.
+LOCAL_DATASET_ROOT = "tmp/mirrors/datasets"
+# Interval (in seconds) after which the dataset directories are rescanned
+# for new peak files.
+LOCAL_DATASET_RESCAN_INTERVAL = 300
+# Maximum number of local peak files memory-mapped per process.
+LOCAL_DATASET_MAX_OPEN = 32
+
+# GNPS task MGF files are downloaded once and indexed locally, so that
+# subsequent scans from the same file don't require a request to GNPS. Set
+# to None to disable.
+GNPS_TASK_FILE_CACHE = "tmp/gnps_task_files"
+# Maximum total size in bytes of the cached files. The least recently used
+# files are evicted first.
+GNPS_TASK_FILE_CACHE_SIZE = 20 * 2 ** 30
+# Files larger than this (in bytes) are not cached.
+GNPS_TASK_FILE_MAX_SIZE = 2 * 2 ** 30
+# Maximum number of cached files memory-mapped per process.
+GNPS_TASK_FILE_MAX_OPEN = 32
+# Connect and read timeout (in seconds) to download a file.
+GNPS_TASK_FILE_TIMEOUT = (10, 60)
+# Minimum interval (in seconds) between download attempts of a file that
+# failed or was too large to cache.
+GNPS_TASK_FILE_RETRY_INTERVAL = 3600
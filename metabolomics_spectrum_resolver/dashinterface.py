@@ -13,7 +13,7 @@ from dash_table import DataTable, FormatTemplate
 from dash_table.Format import Format, Scheme
 from flask import request
 
-from metabolomics_spectrum_resolver import tasks, views
+from metabolomics_spectrum_resolver import splashing, tasks, views
 from metabolomics_spectrum_resolver.app import app
 
 
@@ -771,7 +771,8 @@ def _process_usi(
         in which the spectrum plot is shown, and (ii) the HTML img for the
         spectrum plot.
     """
-    _, source_link, splash_key = tasks.parse_usi(usi)
+    spectrum, source_link = tasks.parse_usi(usi)
+    splash_key = splashing.get_spectrum_splash(spectrum)
 
     usi_url = f"/svg/?{urlencode(drawing_controls, quote_via=quote)}"
     # Pre-fetch the spectrum plot to warm the cache.
@@ -872,8 +873,10 @@ def _process_mirror_usi(
         in which the spectrum plot is shown, (ii) the HTML img for the mirror
         plot, and (iii) a line break.
     """
-    _, source_link1, splash_key1 = tasks.parse_usi(usi1)
-    _, source_link2, splash_key2 = tasks.parse_usi(usi2)
+    spectrum1, source_link1 = tasks.parse_usi(usi1)
+    spectrum2, source_link2 = tasks.parse_usi(usi2)
+    splash_key1 = splashing.get_spectrum_splash(spectrum1)
+    splash_key2 = splashing.get_spectrum_splash(spectrum2)
 
     mirror_url = f"/svg/mirror/?{urlencode(drawing_controls, quote_via=quote)}"
     # Pre-fetch the mirror plot to warm the cache.
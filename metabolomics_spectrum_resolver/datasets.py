@@ -0,0 +1,167 @@
+import collections
+import io
+import mmap
+import os
+import re
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from metabolomics_spectrum_resolver import caching, config, peakfiles
+
+
+PeakFile = collections.namedtuple(
+    "PeakFile", ["mtime", "data", "index", "read"]
+)
+
+# Supported peak file formats in order of preference.
+_EXTENSIONS = (".mzml", ".mzxml", ".mgf")
+
+_mgf_end_pattern = re.compile(rb"END IONS", re.IGNORECASE)
+
+_listings: Dict[str, Tuple[float, Dict[str, str]]] = {}
+_listings_lock = threading.Lock()
+_open_files: "collections.OrderedDict[str, PeakFile]" = (
+    collections.OrderedDict()
+)
+_open_files_lock = threading.Lock()
+
+
+def get_spectrum(
+    dataset: str, ms_run: str, scan: str
+) -> Optional[Tuple[float, int, np.ndarray, np.ndarray]]:
+    """
+    Get a spectrum from a local copy of a public dataset's peak files.
+
+    Peak files are looked up in the dataset's directory below
+    `config.LOCAL_DATASET_ROOT` by their msRun name. mzML, mzXML, and MGF
+    files are supported; the file is indexed once and only the requested
+    spectrum is read from it.
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset identifier (e.g. "MSV000082791" or "PXD000561").
+    ms_run : str
+        The msRun name, i.e. the peak file name without extension.
+    scan : str
+        The scan number of the spectrum.
+
+    Returns
+    -------
+    Optional[Tuple[float, int, np.ndarray, np.ndarray]]
+        A tuple of the spectrum's precursor m/z (0 if unknown), precursor
+        charge (0 if unknown), m/z values, and intensities, or None if no
+        local peak file contains the spectrum.
+    """
+    if config.LOCAL_DATASET_ROOT is None:
+        return None
+    filename = _find_file(dataset, ms_run)
+    if filename is None:
+        return None
+    peak_file = _open(filename)
+    if peak_file is None or scan not in peak_file.index:
+        return None
+    try:
+        return peak_file.read(peak_file.data, peak_file.index[scan])
+    except ValueError:
+        # Fall back to the remote resource for unsupported spectra.
+        return None
+
+
+def _find_file(dataset: str, ms_run: str) -> Optional[str]:
+    with _listings_lock:
+        listing_time, listing = _listings.get(dataset, (0, {}))
+    if time.time() - listing_time > config.LOCAL_DATASET_RESCAN_INTERVAL:
+        # Concurrent lookups share a single scan per dataset, without waiting
+        # for scans of other datasets.
+        listing = caching.singleflight(
+            ("datasets:list", dataset), _rescan, dataset
+        )
+    return listing.get(ms_run)
+
+
+def _rescan(dataset: str) -> Dict[str, str]:
+    listing = _list_files(os.path.join(config.LOCAL_DATASET_ROOT, dataset))
+    with _listings_lock:
+        _listings[dataset] = time.time(), listing
+    return listing
+
+
+def _list_files(directory: str) -> Dict[str, str]:
+    # Map all msRun names to their peak file with the preferred format.
+    listing, preference = {}, {}
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            ms_run, extension = os.path.splitext(filename)
+            extension = extension.lower()
+            if extension not in _EXTENSIONS:
+                continue
+            rank = _EXTENSIONS.index(extension)
+            if rank < preference.get(ms_run, len(_EXTENSIONS)):
+                listing[ms_run] = os.path.join(dirpath, filename)
+                preference[ms_run] = rank
+    return listing
+
+
+def _open(filename: str) -> Optional[PeakFile]:
+    try:
+        mtime = os.path.getmtime(filename)
+    except FileNotFoundError:
+        return None
+    with _open_files_lock:
+        peak_file = _open_files.get(filename)
+        if peak_file is not None and peak_file.mtime == mtime:
+            _open_files.move_to_end(filename)
+            return peak_file
+    # Concurrent lookups share a single index of each file.
+    return caching.singleflight(
+        ("datasets:index", filename, mtime), _index, filename, mtime
+    )
+
+
+def _index(filename: str, mtime: float) -> Optional[PeakFile]:
+    with _open_files_lock:
+        peak_file = _open_files.get(filename)
+        if peak_file is not None and peak_file.mtime == mtime:
+            return peak_file
+    extension = os.path.splitext(filename)[1].lower()
+    try:
+        with open(filename, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if extension == ".mgf":
+                index = peakfiles.index_mgf(f)
+    except (FileNotFoundError, ValueError):
+        # The file was removed or is empty.
+        return None
+    if extension == ".mzml":
+        index = peakfiles.index_mzml(data)
+        read = peakfiles.read_mzml_spectrum
+    elif extension == ".mzxml":
+        index = peakfiles.index_mzxml(data)
+        read = peakfiles.read_mzxml_spectrum
+    else:
+        read = _read_mgf_spectrum
+    peak_file = PeakFile(mtime, data, index, read)
+    with _open_files_lock:
+        _open_files[filename] = peak_file
+        while len(_open_files) > config.LOCAL_DATASET_MAX_OPEN:
+            _open_files.popitem(last=False)
+    return peak_file
+
+
+def _read_mgf_spectrum(
+    data: peakfiles.Buffer, offset: int
+) -> Tuple[float, int, np.ndarray, np.ndarray]:
+    end = _mgf_end_pattern.search(data, offset)
+    params, mz, intensity = peakfiles.read_mgf_spectrum(
+        io.BytesIO(data[offset : end.end() if end else len(data)]), 0
+    )
+    return (
+        float(params.get("PEPMASS", "0").split()[0]),
+        peakfiles.parse_mgf_charge(params.get("CHARGE", "")),
+        mz,
+        intensity,
+    )
@@ -0,0 +1,201 @@
+import contextlib
+import contextvars
+import functools
+import time
+from typing import Any, Callable, Iterator, Optional, Tuple, Union
+
+from metabolomics_spectrum_resolver.error import UsiError
+
+
+# Time (in seconds since the epoch) by which the current request should be
+# answered. Wall-clock time is used so that the deadline can be passed to the
+# Celery workers.
+_deadline: "contextvars.ContextVar[Optional[float]]" = contextvars.ContextVar(
+    "deadline", default=None
+)
+
+
+def push(deadline: Optional[float]) -> contextvars.Token:
+    """
+    Set the deadline of the current context.
+
+    The deadline can only be shortened: a later deadline than the current one
+    is ignored.
+
+    Parameters
+    ----------
+    deadline : Optional[float]
+        The time (in seconds since the epoch) by which the work in the current
+        context should be finished, or None for no additional deadline.
+
+    Returns
+    -------
+    contextvars.Token
+        A token to restore the previous deadline using `pop`.
+    """
+    current = _deadline.get()
+    if deadline is None or (current is not None and current < deadline):
+        deadline = current
+    return _deadline.set(deadline)
+
+
+def pop(token: contextvars.Token) -> None:
+    """
+    Restore the deadline that was in effect before the corresponding `push`.
+
+    Parameters
+    ----------
+    token : contextvars.Token
+        The token returned by `push`.
+    """
+    _deadline.reset(token)
+
+
+@contextlib.contextmanager
+def scope(deadline: Optional[float]) -> Iterator[None]:
+    """
+    Set the deadline for the work within the context manager.
+
+    Parameters
+    ----------
+    deadline : Optional[float]
+        The time (in seconds since the epoch) by which the work should be
+        finished, or None for no additional deadline.
+    """
+    token = push(deadline)
+    try:
+        yield
+    finally:
+        pop(token)
+
+
+def get() -> Optional[float]:
+    """
+    Get the deadline of the current context.
+
+    Returns
+    -------
+    Optional[float]
+        The time (in seconds since the epoch) by which the current request
+        should be answered, or None if there is no deadline.
+    """
+    return _deadline.get()
+
+
+def remaining() -> Optional[float]:
+    """
+    Get the time left until the deadline of the current context.
+
+    Returns
+    -------
+    Optional[float]
+        The remaining time in seconds, or None if there is no deadline.
+
+    Raises
+    ------
+    UsiError
+        If the deadline has passed.
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise exceeded()
+    return left
+
+
+def check() -> None:
+    """
+    Abandon work for a caller that has already given up.
+
+    Raises
+    ------
+    UsiError
+        If the deadline of the current context has passed.
+    """
+    remaining()
+
+
+def expired() -> bool:
+    """
+    Check whether the deadline of the current context has passed.
+
+    Returns
+    -------
+    bool
+        True if the deadline has passed, False if it hasn't or if there is no
+        deadline.
+    """
+    deadline = _deadline.get()
+    return deadline is not None and deadline <= time.time()
+
+
+def exceeded() -> UsiError:
+    """
+    Get the error to raise when the deadline has passed.
+
+    Returns
+    -------
+    UsiError
+        The 504 timeout error.
+    """
+    return UsiError("Timeout while processing the request", 504)
+
+
+def limit_timeout(
+    timeout: Union[None, float, Tuple[float, float]],
+) -> Union[None, float, Tuple[float, float]]:
+    """
+    Limit a `requests` timeout to the time left until the deadline.
+
+    Parameters
+    ----------
+    timeout : Union[None, float, Tuple[float, float]]
+        The timeout (in seconds), or a tuple of the connect and read timeouts.
+
+    Returns
+    -------
+    Union[None, float, Tuple[float, float]]
+        The timeout, limited to the remaining time.
+
+    Raises
+    ------
+    UsiError
+        If the deadline has passed.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    elif timeout is None:
+        return left
+    elif isinstance(timeout, tuple):
+        return tuple(min(t, left) if t is not None else left for t in timeout)
+    else:
+        return min(timeout, left)
+
+
+def bind(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Callable:
+    """
+    Bind a function call to the deadline of the current context, so that it
+    keeps the deadline when it's run on a different thread (e.g. in a thread
+    pool).
+
+    Parameters
+    ----------
+    func : Callable[..., Any]
+        The function to be called.
+    args : Any
+        The function arguments.
+    kwargs : Any
+        The function keyword arguments.
+
+    Returns
+    -------
+    Callable
+        A function without arguments that performs the function call in a
+        copy of the current context.
+    """
+    return functools.partial(
+        contextvars.copy_context().run, func, *args, **kwargs
+    )
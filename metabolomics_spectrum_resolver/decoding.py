@@ -0,0 +1,314 @@
+import contextlib
+import json
+import re
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import requests
+
+from metabolomics_spectrum_resolver import config, deadlines
+from metabolomics_spectrum_resolver.error import UsiError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Characters in a JSON peak array other than the numbers.
+_PEAK_DELIMITERS = bytes.maketrans(b'[],"', b"    ")
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Deserialize JSON, using orjson if available.
+
+    Parameters
+    ----------
+    data : Union[bytes, str]
+        The JSON document.
+
+    Returns
+    -------
+    Any
+        The deserialized JSON document.
+
+    Raises
+    ------
+    json.JSONDecodeError
+        If the JSON document is invalid.
+    """
+    if orjson is not None:
+        # orjson.JSONDecodeError is a subclass of json.JSONDecodeError.
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def response_json(
+    response: requests.Response, max_bytes: Optional[int] = None
+) -> Any:
+    """
+    Deserialize the JSON body of an upstream response.
+
+    The raw response bytes are decoded directly, without first decoding them
+    to text.
+
+    Parameters
+    ----------
+    response : requests.Response
+        The upstream response.
+    max_bytes : Optional[int]
+        The maximum size (in bytes) of the response body. If specified, the
+        body is read incrementally, preferably from a response requested with
+        `stream=True`, and the response is closed afterwards. Larger
+        responses, and responses that are still being read when the deadline
+        of the current request passes, are aborted early.
+
+    Returns
+    -------
+    Any
+        The deserialized JSON body.
+
+    Raises
+    ------
+    UsiError
+        If the response exceeds the maximum size, or the deadline of the
+        current request has passed.
+    json.JSONDecodeError
+        If the response body is not valid JSON.
+    """
+    if max_bytes is None:
+        return loads(response.content)
+    with contextlib.closing(response):
+        return loads(b"".join(_iter_content(response, max_bytes, "response")))
+
+
+def response_spectrum_json(
+    response: requests.Response, peaks_key: str = "peaks"
+) -> Dict[str, Any]:
+    """
+    Deserialize the JSON body of an upstream spectrum response, streaming its
+    peaks directly into arrays.
+
+    The response body is read incrementally and the numbers of the peak array
+    are parsed into a preallocated buffer, so the peaks are never converted to
+    Python objects. Responses with more than `config.MAX_SPECTRUM_PEAKS`
+    peaks or `config.MAX_SPECTRUM_BYTES` bytes are aborted early, as are
+    responses that are still being read when the deadline of the current
+    request passes. The response is closed afterwards.
+
+    Parameters
+    ----------
+    response : requests.Response
+        The upstream response, preferably requested with `stream=True`.
+    peaks_key : str
+        The key of the peak array in the JSON object.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The deserialized JSON body, with the peaks replaced by contiguous
+        float32 arrays of the m/z values and intensities (see
+        `peak_arrays`).
+
+    Raises
+    ------
+    UsiError
+        If the spectrum exceeds the maximum number of peaks or bytes, or the
+        deadline of the current request has passed.
+    json.JSONDecodeError
+        If the response body is not valid JSON.
+    ValueError
+        If there are no peaks or they are not formatted as pairs.
+    """
+    with contextlib.closing(response):
+        stream = _PeakStream(peaks_key)
+        for chunk in _iter_content(
+            response, config.MAX_SPECTRUM_BYTES, "spectrum"
+        ):
+            stream.feed(chunk)
+        return stream.close()
+
+
+def peak_arrays(
+    peaks: Union[Sequence[Sequence[float]], str, bytes],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert a list of [m/z, intensity] pairs to m/z and intensity arrays.
+
+    Parameters
+    ----------
+    peaks : Union[Sequence[Sequence[float]], str, bytes]
+        The peaks as [m/z, intensity] pairs, or as a JSON document of those
+        pairs.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Contiguous float32 arrays of the m/z values and intensities, as used
+        by `sus.MsmsSpectrum`.
+
+    Raises
+    ------
+    ValueError
+        If there are no peaks or they are not formatted as pairs.
+    """
+    if isinstance(peaks, (str, bytes)):
+        peaks = loads(peaks)
+    return _split_peaks(np.asarray(peaks, np.float32))
+
+
+def peak_arrays_text(
+    peaks: str, separator: str = ":"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert whitespace-separated m/z-intensity pairs (e.g. "100.1:10 200.2:20")
+    to m/z and intensity arrays.
+
+    Parameters
+    ----------
+    peaks : str
+        The peaks as text.
+    separator : str
+        The separator between the m/z and intensity of each peak.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Contiguous float32 arrays of the m/z values and intensities, as used
+        by `sus.MsmsSpectrum`.
+
+    Raises
+    ------
+    ValueError
+        If there are no peaks or they are not formatted as pairs.
+    """
+    return _split_peaks(
+        np.array(peaks.replace(separator, " ").split(), np.float32)
+    )
+
+
+def _split_peaks(peaks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if peaks.size == 0:
+        raise ValueError("No peaks found")
+    if peaks.ndim == 1:
+        peaks = peaks.reshape(-1, 2)
+    elif peaks.ndim != 2 or peaks.shape[1] != 2:
+        raise ValueError("Peaks should be m/z-intensity pairs")
+    # Both rows of the transposed copy are contiguous.
+    mz, intensity = np.ascontiguousarray(peaks.T)
+    return mz, intensity
+
+
+def _iter_content(
+    response: requests.Response, max_bytes: int, name: str
+) -> Iterator[bytes]:
+    # Abort as soon as the body is known to be too large.
+    too_large = UsiError(
+        f"The {name} exceeds the maximum size of {max_bytes} bytes", 413
+    )
+    if int(response.headers.get("Content-Length") or 0) > max_bytes:
+        raise too_large
+    n_bytes = 0
+    for chunk in response.iter_content(config.STREAM_CHUNK_SIZE):
+        n_bytes += len(chunk)
+        if n_bytes > max_bytes:
+            raise too_large
+        deadlines.check()
+        yield chunk
+
+
+def _spectrum_too_large(max_size: str) -> UsiError:
+    return UsiError(
+        f"The spectrum exceeds the maximum size of {max_size}", 413
+    )
+
+
+class _PeakStream:
+    """
+    Incremental parser of a JSON object with a peak array.
+
+    The numbers in the peak array are parsed into a float32 buffer, while
+    the rest of the JSON object is kept as text with an empty peak array.
+    """
+
+    def __init__(self, peaks_key: str):
+        self._start = re.compile(
+            rb'"%s"\s*:\s*\[' % re.escape(peaks_key.encode())
+        )
+        self._peaks_key = peaks_key
+        self._document = bytearray()
+        # Whether the peak array has started/ended.
+        self._in_peaks, self._after_peaks = False, False
+        self._searched = 0
+        # Nesting depth within the peak array and the number that was split
+        # over chunks.
+        self._depth = 0
+        self._token = b""
+        self._values = np.empty(4096, np.float32)
+        self._n_values = 0
+
+    def feed(self, chunk: bytes) -> None:
+        if self._in_peaks:
+            self._feed_peaks(chunk)
+        elif self._after_peaks:
+            self._document += chunk
+        else:
+            self._document += chunk
+            # Only search the new data, with overlap for a split key.
+            match = self._start.search(
+                self._document, max(0, self._searched - 64)
+            )
+            self._searched = len(self._document)
+            if match is not None:
+                rest = bytes(self._document[match.end() :])
+                del self._document[match.end() :]
+                self._document += b"]"
+                self._in_peaks = True
+                self._feed_peaks(rest)
+
+    def close(self) -> Dict[str, Any]:
+        document = loads(bytes(self._document))
+        if self._after_peaks:
+            document[self._peaks_key] = _split_peaks(
+                self._values[: self._n_values]
+            )
+        return document
+
+    def _feed_peaks(self, data: bytes) -> None:
+        # Find the end of the peak array from the bracket nesting depth.
+        characters = np.frombuffer(data, np.uint8)
+        depth = self._depth + np.cumsum(
+            (characters == ord("[")).astype(np.int64)
+            - (characters == ord("]"))
+        )
+        end = np.flatnonzero(depth < 0)
+        if len(end) > 0:
+            rest, data = data[end[0] + 1 :], data[: end[0]]
+        elif len(depth) > 0:
+            self._depth = depth[-1]
+        text = (self._token + data).translate(_PEAK_DELIMITERS)
+        numbers = text.split()
+        # Keep a number that continues in the next chunk.
+        self._token = b""
+        if len(end) == 0 and text[-1:].strip():
+            self._token = numbers.pop()
+        self._append(np.asarray(numbers, np.float32))
+        if len(end) > 0:
+            self._in_peaks, self._after_peaks = False, True
+            self._document += rest
+
+    def _append(self, values: np.ndarray) -> None:
+        n_values = self._n_values + len(values)
+        if n_values > 2 * config.MAX_SPECTRUM_PEAKS:
+            raise _spectrum_too_large(f"{config.MAX_SPECTRUM_PEAKS} peaks")
+        if n_values > len(self._values):
+            self._values = np.resize(
+                self._values,
+                min(
+                    max(n_values, 2 * len(self._values)),
+                    2 * config.MAX_SPECTRUM_PEAKS,
+                ),
+            )
+        self._values[self._n_values : n_values] = values
+        self._n_values = n_values
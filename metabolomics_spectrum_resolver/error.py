@@ -2,3 +2,9 @@ class UsiError(Exception):
     def __init__(self, message, error_code):
         self.message = message
         self.error_code = error_code
+
+
+# Raised when requests are shed locally (e.g. an open circuit breaker)
+# instead of failing upstream.
+class UsiUnavailableError(UsiError):
+    pass
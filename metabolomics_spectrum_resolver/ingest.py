@@ -0,0 +1,195 @@
+import argparse
+import glob
+import json
+import logging
+import os
+from typing import Dict, Iterator
+
+import numpy as np
+
+from metabolomics_spectrum_resolver import (
+    config,
+    ms2lda,
+    parsing,
+    peakfiles,
+    store,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def ingest_gnps_library(filename: str, store_path: str) -> int:
+    """
+    Build the local GNPS spectral library store from a GNPS library dump.
+
+    Parameters
+    ----------
+    filename : str
+        The GNPS library dump in MGF or JSON format (e.g. ALL_GNPS.mgf or
+        ALL_GNPS.json).
+    store_path : str
+        The path of the spectrum store to build. A previous store at this path
+        is replaced.
+
+    Returns
+    -------
+    int
+        The number of spectra in the store.
+    """
+    if filename.lower().endswith(".json"):
+        spectra = _read_gnps_library_json(filename)
+    else:
+        spectra = _read_gnps_library_mgf(filename)
+    with store.SpectrumStoreWriter(store_path) as writer:
+        for spectrum in spectra:
+            writer.add(
+                [spectrum["accession"]],
+                spectrum["precursor_mz"],
+                spectrum["charge"],
+                spectrum["mz"],
+                spectrum["intensity"],
+            )
+    return writer.n_spectra
+
+
+def ingest_massbank(directory: str, store_path: str) -> int:
+    """
+    Build the local MassBank store from MassBank record files.
+
+    Records can be retrieved by their full accession and by the normalized
+    accession used by the MassBank API (e.g. both "MSBNK-AAFC-AC000646" and
+    "AC000646").
+
+    Parameters
+    ----------
+    directory : str
+        Directory with MassBank record files (e.g. a clone of the
+        MassBank-data repository). Record files in all subdirectories are
+        included.
+    store_path : str
+        The path of the spectrum store to build. A previous store at this path
+        is replaced.
+
+    Returns
+    -------
+    int
+        The number of spectra in the store.
+    """
+    with store.SpectrumStoreWriter(store_path) as writer:
+        for filename in sorted(
+            glob.glob(os.path.join(directory, "**", "*.txt"), recursive=True)
+        ):
+            with open(filename, encoding="utf-8", errors="replace") as f:
+                record = peakfiles.parse_massbank_record(f.read())
+            if record is None or len(record[2]) == 0:
+                continue
+            accession, precursor_mz, mz, intensity = record
+            writer.add(
+                {accession, parsing.normalize_massbank_accession(accession)},
+                precursor_mz,
+                0,
+                mz,
+                intensity,
+            )
+    return writer.n_spectra
+
+
+def _read_gnps_library_mgf(filename: str) -> Iterator[Dict]:
+    with open(filename, "rb") as mgf_file:
+        for _, params, mz, intensity in peakfiles.iter_mgf(mgf_file):
+            if "SPECTRUMID" not in params or len(mz) == 0:
+                continue
+            yield {
+                "accession": params["SPECTRUMID"],
+                "precursor_mz": float(params.get("PEPMASS", "0").split()[0]),
+                "charge": peakfiles.parse_mgf_charge(params.get("CHARGE", "")),
+                "mz": mz,
+                "intensity": intensity,
+            }
+
+
+def _read_gnps_library_json(filename: str) -> Iterator[Dict]:
+    with open(filename) as json_file:
+        library = json.load(json_file)
+    for library_spectrum in library:
+        accession = library_spectrum.get(
+            "spectrum_id", library_spectrum.get("SpectrumID")
+        )
+        peaks_json = library_spectrum.get("peaks_json", "null")
+        if accession is None or peaks_json == "null":
+            continue
+        peaks = np.asarray(json.loads(peaks_json), np.float64).reshape(-1, 2)
+        if len(peaks) == 0:
+            continue
+        yield {
+            "accession": accession,
+            "precursor_mz": float(library_spectrum.get("Precursor_MZ") or 0),
+            "charge": int(library_spectrum.get("Charge") or 0),
+            "mz": peaks[:, 0],
+            "intensity": peaks[:, 1],
+        }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Build local spectrum stores from public resource dumps."
+    )
+    subparsers = parser.add_subparsers(dest="resource", required=True)
+    gnps_parser = subparsers.add_parser(
+        "gnps-library", help="GNPS spectral library dump (MGF or JSON)."
+    )
+    gnps_parser.add_argument("filename", help="GNPS library dump file.")
+    gnps_parser.add_argument(
+        "--store",
+        default=config.GNPS_LIBRARY_STORE,
+        help="Path of the spectrum store (default: %(default)s).",
+    )
+    massbank_parser = subparsers.add_parser(
+        "massbank", help="MassBank record files (MassBank-data repository)."
+    )
+    massbank_parser.add_argument(
+        "directory", help="Directory with MassBank record files."
+    )
+    massbank_parser.add_argument(
+        "--store",
+        default=config.MASSBANK_STORE,
+        help="Path of the spectrum store (default: %(default)s).",
+    )
+    ms2lda_parser = subparsers.add_parser(
+        "ms2lda", help="All documents of an MS2LDA experiment (ms2lda.org)."
+    )
+    ms2lda_parser.add_argument("experiment_id", help="MS2LDA experiment ID.")
+    ms2lda_parser.add_argument(
+        "--store",
+        help="Path of the spectrum store (default: the experiment's store in "
+        "the MS2LDA_STORE directory).",
+    )
+    motifdb_parser = subparsers.add_parser(
+        "motifdb", help="All MotifDB motifs (ms2lda.org)."
+    )
+    motifdb_parser.add_argument(
+        "--store",
+        default=config.MOTIFDB_STORE,
+        help="Path of the spectrum store (default: %(default)s).",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s %(message)s", level=logging.INFO
+    )
+    if args.resource == "gnps-library":
+        n_spectra = ingest_gnps_library(args.filename, args.store)
+    elif args.resource == "massbank":
+        n_spectra = ingest_massbank(args.directory, args.store)
+    elif args.resource == "ms2lda":
+        if args.store is None:
+            args.store = os.path.join(config.MS2LDA_STORE, args.experiment_id)
+        n_spectra = ms2lda.prefetch_experiment(args.store, args.experiment_id)
+    elif args.resource == "motifdb":
+        n_spectra = ms2lda.prefetch_motifdb(args.store)
+    logger.info("Stored %d spectra in %s", n_spectra, args.store)
+
+
+if __name__ == "__main__":
+    main()
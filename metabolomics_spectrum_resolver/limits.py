@@ -0,0 +1,193 @@
+import contextlib
+import functools
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import redis
+
+from metabolomics_spectrum_resolver import caching, config, deadlines
+from metabolomics_spectrum_resolver.error import UsiError, UsiUnavailableError
+
+
+# Interval (in seconds) at which a full semaphore is polled.
+_POLL_INTERVAL = 0.05
+
+# Atomically acquire a semaphore lease and a rate limiting token. Semaphore
+# leases expire so that slots of crashed processes are recovered, and the
+# semaphore only expires after its longest lease. Returns 0 if both were
+# acquired, -1 if the semaphore is full, or the number of milliseconds until
+# a token is available.
+_ACQUIRE_SCRIPT = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local concurrency = tonumber(ARGV[2])
+local rate = tonumber(ARGV[3])
+local burst = tonumber(ARGV[4])
+local lease = tonumber(ARGV[5])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now)
+if redis.call("ZCARD", KEYS[1]) >= concurrency then
+    return -1
+end
+local bucket = redis.call("HMGET", KEYS[2], "tokens", "time")
+local tokens = tonumber(bucket[1]) or burst
+local last = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + (now - last) * rate)
+if tokens < 1 then
+    return math.ceil((1 - tokens) / rate * 1000)
+end
+redis.call("HSET", KEYS[2], "tokens", tokens - 1, "time", now)
+redis.call("EXPIRE", KEYS[2], math.ceil(burst / rate) + 1)
+redis.call("ZADD", KEYS[1], now + lease, ARGV[1])
+local lease_ms = math.ceil(lease * 1000)
+if redis.call("PTTL", KEYS[1]) < lease_ms then
+    redis.call("PEXPIRE", KEYS[1], lease_ms)
+end
+return 0
+"""
+# The script is executed with the shared Redis client (see
+# `caching.get_redis`).
+_acquire_script = redis.client.Script(None, _ACQUIRE_SCRIPT.encode())
+
+# Fallback semaphores and token buckets (tokens, time) if Redis is
+# unavailable.
+_semaphores: Dict[str, threading.BoundedSemaphore] = {}
+_buckets: Dict[str, List[float]] = {}
+_local_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def acquire(backend: str, lease: Optional[float] = None) -> Iterator[None]:
+    """
+    Limit the concurrency and rate of requests to an upstream backend.
+
+    Each backend's limits are specified in `config.UPSTREAM_LIMITS` as the
+    maximum number of concurrent requests, and a token bucket with the
+    maximum sustained number of requests per second and the maximum burst
+    size, optionally with a minimum lease duration. Limits are coordinated
+    through Redis, so they hold across all processes and nodes, with
+    per-process limits if Redis is unavailable.
+    Requests exceeding the limits wait for at most
+    `config.UPSTREAM_LIMIT_QUEUE_TIMEOUT` seconds, and not beyond the
+    deadline of the current request.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps", "massive"), or the name of separate
+        limits for some of its requests.
+    lease : Optional[float]
+        The maximum duration (in seconds) of the request, after which its
+        concurrency slot is released even if the request didn't finish (e.g.
+        because its process crashed), increased by
+        `config.UPSTREAM_LIMIT_LEASE_GRACE`. By default only the grace
+        duration is used.
+
+    Raises
+    ------
+    UsiError
+        If the request could not be admitted in time, or the deadline of the
+        current request has passed.
+    """
+    limits = config.UPSTREAM_LIMITS.get(backend)
+    if limits is None:
+        yield
+        return
+    queue_timeout = config.UPSTREAM_LIMIT_QUEUE_TIMEOUT
+    remaining = deadlines.remaining()
+    if remaining is not None:
+        queue_timeout = min(queue_timeout, remaining)
+    deadline = time.monotonic() + queue_timeout
+    lease = (
+        max(lease or 0, limits.get("lease", 0))
+        + config.UPSTREAM_LIMIT_LEASE_GRACE
+    )
+    release = _acquire(backend, limits, deadline, lease)
+    try:
+        yield
+    finally:
+        release()
+
+
+def _keys(backend: str) -> List[str]:
+    return [f"limit:{backend}:semaphore", f"limit:{backend}:bucket"]
+
+
+def _busy(backend: str) -> UsiError:
+    return UsiUnavailableError(
+        f"The {backend} resource is busy, please try again later", 503
+    )
+
+
+def _acquire(
+    backend: str, limits: Dict[str, Any], deadline: float, lease: float
+) -> Callable[[], None]:
+    lease_id = uuid.uuid4().hex
+    while True:
+        client = caching.get_redis()
+        if client is None:
+            return _acquire_local(backend, limits, deadline)
+        try:
+            wait = _acquire_script(
+                keys=_keys(backend),
+                args=[
+                    lease_id,
+                    limits["concurrency"],
+                    limits["rate"],
+                    limits["burst"],
+                    lease,
+                ],
+                client=client,
+            )
+        except redis.exceptions.RedisError:
+            caching.redis_unavailable()
+            return _acquire_local(backend, limits, deadline)
+        if wait == 0:
+            return functools.partial(_release, backend, lease_id)
+        wait = _POLL_INTERVAL if wait < 0 else wait / 1000
+        if time.monotonic() + wait > deadline:
+            raise _busy(backend)
+        time.sleep(wait)
+
+
+def _release(backend: str, lease_id: str) -> None:
+    client = caching.get_redis()
+    if client is not None:
+        try:
+            client.zrem(_keys(backend)[0], lease_id)
+        except redis.exceptions.RedisError:
+            # The lease expires.
+            caching.redis_unavailable()
+
+
+def _acquire_local(
+    backend: str, limits: Dict[str, Any], deadline: float
+) -> Callable[[], None]:
+    with _local_lock:
+        if backend not in _semaphores:
+            _semaphores[backend] = threading.BoundedSemaphore(
+                limits["concurrency"]
+            )
+        semaphore = _semaphores[backend]
+    if not semaphore.acquire(timeout=max(0.0, deadline - time.monotonic())):
+        raise _busy(backend)
+    try:
+        while True:
+            with _local_lock:
+                now = time.monotonic()
+                tokens, last = _buckets.get(backend, (limits["burst"], now))
+                tokens = min(
+                    limits["burst"], tokens + (now - last) * limits["rate"]
+                )
+                if tokens >= 1:
+                    _buckets[backend] = [tokens - 1, now]
+                    return semaphore.release
+                _buckets[backend] = [tokens, now]
+            wait = (1 - tokens) / limits["rate"]
+            if now + wait > deadline:
+                raise _busy(backend)
+            time.sleep(wait)
+    except UsiError:
+        semaphore.release()
+        raise
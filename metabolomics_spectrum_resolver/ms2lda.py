@@ -0,0 +1,247 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import numpy as np
+
+from metabolomics_spectrum_resolver import config, decoding, store, upstream
+
+
+logger = logging.getLogger(__name__)
+
+EXPERIMENT_URL = "http://ms2lda.org/basicviz/get_all_doc_data/{}/"
+MOTIFSETS_URL = "http://ms2lda.org/motifdb/list_motifsets/"
+MOTIFSET_URL = "http://ms2lda.org/motifdb/get_motifset/{}/"
+MOTIFSET_METADATA_URL = "http://ms2lda.org/motifdb/get_motifset_metadata/{}/"
+
+_prefetches: Dict[str, float] = {}
+_prefetches_lock = threading.Lock()
+
+
+def get_document(
+    experiment_id: str, document_id: str
+) -> Optional[store.StoredSpectrum]:
+    """
+    Get an MS2LDA document from the local store of its experiment.
+
+    If the experiment hasn't been stored yet, or its store is older than
+    `config.MS2LDA_STORE_MAX_AGE`, all of its documents are prefetched in the
+    background.
+
+    Parameters
+    ----------
+    experiment_id : str
+        The MS2LDA experiment identifier.
+    document_id : str
+        The MS2LDA document identifier.
+
+    Returns
+    -------
+    Optional[store.StoredSpectrum]
+        The document, or None if it isn't available locally (yet).
+    """
+    if config.MS2LDA_STORE is None:
+        return None
+    store_path = os.path.join(config.MS2LDA_STORE, experiment_id)
+    store_age = _get_store_age(store_path)
+    if store_age is None or store_age > config.MS2LDA_STORE_MAX_AGE:
+        _schedule_prefetch(store_path, prefetch_experiment, experiment_id)
+    if store_age is None:
+        return None
+    return store.lookup(store_path, document_id)
+
+
+def get_motif(motif_id: str) -> Optional[store.StoredSpectrum]:
+    """
+    Get a MotifDB motif from the local MotifDB snapshot.
+
+    If no snapshot exists yet, or it's older than
+    `config.MS2LDA_STORE_MAX_AGE`, MotifDB is prefetched in the background.
+
+    Parameters
+    ----------
+    motif_id : str
+        The MotifDB motif identifier.
+
+    Returns
+    -------
+    Optional[store.StoredSpectrum]
+        The motif, or None if it isn't available locally (yet).
+    """
+    if config.MOTIFDB_STORE is None:
+        return None
+    store_age = _get_store_age(config.MOTIFDB_STORE)
+    if store_age is None or store_age > config.MS2LDA_STORE_MAX_AGE:
+        _schedule_prefetch(config.MOTIFDB_STORE, prefetch_motifdb)
+    if store_age is None:
+        return None
+    return store.lookup(config.MOTIFDB_STORE, motif_id)
+
+
+def prefetch_experiment(store_path: str, experiment_id: str) -> int:
+    """
+    Store all documents of an MS2LDA experiment locally.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the spectrum store to build. A previous store at this path
+        is replaced.
+    experiment_id : str
+        The MS2LDA experiment identifier.
+
+    Returns
+    -------
+    int
+        The number of stored documents.
+
+    Raises
+    ------
+    ValueError
+        If the experiment isn't a list of documents, or doesn't contain any
+        documents with peaks.
+    """
+    with upstream.get(
+        "ms2lda",
+        EXPERIMENT_URL.format(experiment_id),
+        stream=True,
+        timeout=config.MS2LDA_PREFETCH_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        documents = decoding.response_json(
+            response, config.MS2LDA_PREFETCH_MAX_BYTES
+        )
+    # Documents are formatted as returned by the get_doc endpoint, with their
+    # identifier.
+    if not isinstance(documents, list) or not all(
+        isinstance(document, dict) for document in documents
+    ):
+        raise ValueError(f"Unexpected MS2LDA experiment {experiment_id}")
+    with store.SpectrumStoreWriter(store_path) as writer:
+        for document in documents:
+            document_id = document.get("document_id", document.get("id"))
+            if document_id is None or not document.get("peaks"):
+                continue
+            peaks = np.asarray(document["peaks"], np.float64).reshape(-1, 2)
+            writer.add(
+                [str(document_id)],
+                float(document.get("precursor_mz") or 0),
+                0,
+                peaks[:, 0],
+                peaks[:, 1],
+            )
+        # Don't replace a previous store with an empty one.
+        if writer.n_spectra == 0:
+            raise ValueError(f"Empty MS2LDA experiment {experiment_id}")
+    return writer.n_spectra
+
+
+def prefetch_motifdb(store_path: str) -> int:
+    """
+    Store all MotifDB motifs locally.
+
+    Motifs consist of their fragment features with the feature probabilities
+    as intensities.
+
+    Parameters
+    ----------
+    store_path : str
+        The path of the spectrum store to build. A previous store at this path
+        is replaced.
+
+    Returns
+    -------
+    int
+        The number of stored motifs.
+
+    Raises
+    ------
+    ValueError
+        If a MotifDB response isn't a JSON object, or MotifDB doesn't contain
+        any motifs with fragments.
+    """
+    with store.SpectrumStoreWriter(store_path) as writer:
+        for motifset_id in _get_json(MOTIFSETS_URL).values():
+            motifs = _get_json(MOTIFSET_URL.format(motifset_id))
+            metadata = _get_json(MOTIFSET_METADATA_URL.format(motifset_id))
+            for motif_name, features in motifs.items():
+                motif_id = metadata.get(motif_name, {}).get("motif_id")
+                if motif_id is None:
+                    continue
+                peaks = sorted(
+                    (float(feature.split("_", 1)[1]), probability)
+                    for feature, probability in features.items()
+                    if feature.startswith("fragment_")
+                )
+                if len(peaks) == 0:
+                    continue
+                mz, intensity = zip(*peaks)
+                writer.add([str(motif_id)], 0, 0, mz, intensity)
+        # Don't replace a previous snapshot with an empty one.
+        if writer.n_spectra == 0:
+            raise ValueError("Empty MotifDB")
+    return writer.n_spectra
+
+
+def _get_store_age(store_path: str) -> Optional[float]:
+    # Stores are replaced as a whole, so their age is their directory's.
+    try:
+        return time.time() - os.path.getmtime(store_path)
+    except FileNotFoundError:
+        return None
+
+
+def _get_json(url: str) -> Dict:
+    with upstream.get(
+        "ms2lda", url, stream=True, timeout=config.MS2LDA_PREFETCH_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        payload = decoding.response_json(
+            response, config.MS2LDA_PREFETCH_MAX_BYTES
+        )
+    if not isinstance(payload, dict):
+        raise ValueError(f"Unexpected MotifDB response from {url}")
+    return payload
+
+
+def _schedule_prefetch(
+    store_path: str, prefetch: Callable[..., int], *args: Any
+) -> None:
+    # Don't retry failed prefetches too often.
+    with _prefetches_lock:
+        last_prefetch = _prefetches.get(store_path, 0)
+        if time.time() - last_prefetch < config.MS2LDA_PREFETCH_INTERVAL:
+            return
+        _prefetches[store_path] = time.time()
+    upstream.executor("download").submit(
+        _prefetch, store_path, prefetch, *args
+    )
+
+
+def _prefetch(
+    store_path: str, prefetch: Callable[..., int], *args: Any
+) -> None:
+    # Only a single process builds the store.
+    lock_filename = f"{store_path}.lock"
+    try:
+        os.makedirs(os.path.dirname(lock_filename), exist_ok=True)
+        try:
+            if time.time() - os.path.getmtime(lock_filename) > (
+                config.MS2LDA_PREFETCH_INTERVAL
+            ):
+                os.remove(lock_filename)
+        except FileNotFoundError:
+            pass
+        fd = os.open(lock_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return
+    try:
+        n_spectra = prefetch(store_path, *args)
+        logger.info("Prefetched %d spectra to %s", n_spectra, store_path)
+    except Exception:
+        logger.exception("Failed to prefetch %s", store_path)
+    finally:
+        os.close(fd)
+        os.remove(lock_filename)
@@ -0,0 +1,178 @@
+from typing import Tuple
+
+import numba as nb
+import numpy as np
+
+
+# MS-Numpress decoders, ported from the reference implementation:
+# https://github.com/ms-numpress/ms-numpress
+
+
+def decode_linear(data: bytes) -> np.ndarray:
+    """
+    Decode MS-Numpress linear prediction compressed values (e.g. m/z values).
+
+    Parameters
+    ----------
+    data : bytes
+        The MS-Numpress linear encoded data.
+
+    Returns
+    -------
+    np.ndarray
+        The decoded values.
+
+    Raises
+    ------
+    ValueError
+        If the data is corrupt.
+    """
+    if len(data) == 8:
+        return np.zeros(0, np.float64)
+    if len(data) < 12:
+        raise ValueError("Corrupt MS-Numpress linear data")
+    return _check(_decode_linear(np.frombuffer(data, np.uint8)), "linear")
+
+
+def decode_pic(data: bytes) -> np.ndarray:
+    """
+    Decode MS-Numpress positive integer compressed values (e.g. ion counts).
+
+    Parameters
+    ----------
+    data : bytes
+        The MS-Numpress PIC encoded data.
+
+    Returns
+    -------
+    np.ndarray
+        The decoded values.
+
+    Raises
+    ------
+    ValueError
+        If the data is corrupt.
+    """
+    return _check(_decode_pic(np.frombuffer(data, np.uint8)), "PIC")
+
+
+def decode_slof(data: bytes) -> np.ndarray:
+    """
+    Decode MS-Numpress short logged float compressed values (e.g.
+    intensities).
+
+    Parameters
+    ----------
+    data : bytes
+        The MS-Numpress SLOF encoded data.
+
+    Returns
+    -------
+    np.ndarray
+        The decoded values.
+
+    Raises
+    ------
+    ValueError
+        If the data is corrupt.
+    """
+    if len(data) < 8 or len(data) % 2 != 0:
+        raise ValueError("Corrupt MS-Numpress SLOF data")
+    fixed_point = np.frombuffer(data[:8], ">f8")[0]
+    return np.expm1(np.frombuffer(data[8:], "<u2") / fixed_point)
+
+
+def _check(decoded: Tuple[np.ndarray, bool], encoding: str) -> np.ndarray:
+    values, corrupt = decoded
+    if corrupt:
+        raise ValueError(f"Corrupt MS-Numpress {encoding} data")
+    return values
+
+
+@nb.njit
+def _decode_int(
+    data: np.ndarray, di: int, half: int
+) -> Tuple[int, int, int, bool]:
+    # Decode a single integer encoded as a count of leading zero (or one)
+    # half bytes followed by the remaining half bytes, least significant
+    # first. Returns the integer, the next data index and half byte flag, and
+    # whether the data is corrupt.
+    if half == 0:
+        head = np.int64(data[di] >> 4)
+    else:
+        head = np.int64(data[di] & 0xF)
+        di += 1
+    half = 1 - half
+    res = np.int64(0)
+    if head <= 8:
+        n = head
+    else:
+        # Leading ones are filled with 0xF half bytes.
+        n = head - 8
+        for i in range(n):
+            res |= 0xF0000000 >> (4 * i)
+    if n == 8:
+        return res, di, half, False
+    if di + ((8 - n) - (1 - half)) // 2 >= len(data):
+        return 0, di, half, True
+    for i in range(n, 8):
+        if half == 0:
+            hb = np.int64(data[di] >> 4)
+        else:
+            hb = np.int64(data[di] & 0xF)
+            di += 1
+        res |= hb << ((i - n) * 4)
+        half = 1 - half
+    return res, di, half, False
+
+
+@nb.njit
+def _decode_fixed_point(data: np.ndarray) -> float:
+    return data[:8][::-1].copy().view(np.float64)[0]
+
+
+@nb.njit
+def _decode_linear(data: np.ndarray) -> Tuple[np.ndarray, bool]:
+    result = np.zeros(2 * len(data), np.float64)
+    fixed_point = _decode_fixed_point(data)
+    ints = np.zeros(3, np.int64)
+    for i in range(4):
+        ints[1] |= np.int64(data[8 + i]) << (i * 8)
+    result[0] = ints[1] / fixed_point
+    if len(data) == 12:
+        return result[:1], False
+    if len(data) < 16:
+        return result[:0], True
+    for i in range(4):
+        ints[2] |= np.int64(data[12 + i]) << (i * 8)
+    result[1] = ints[2] / fixed_point
+    ri, di, half = 2, 16, 0
+    while di < len(data):
+        if di == len(data) - 1 and half == 1 and (data[di] & 0xF) == 0:
+            break
+        ints[0] = ints[1]
+        ints[1] = ints[2]
+        buff, di, half, corrupt = _decode_int(data, di, half)
+        if corrupt:
+            return result[:ri], True
+        # Reinterpret as a signed 32-bit difference.
+        diff = np.int64(buff) - (np.int64(buff >> 31) << 32)
+        ints[2] = 2 * ints[1] - ints[0] + diff
+        result[ri] = ints[2] / fixed_point
+        ri += 1
+    return result[:ri], False
+
+
+@nb.njit
+def _decode_pic(data: np.ndarray) -> Tuple[np.ndarray, bool]:
+    result = np.zeros(2 * len(data), np.float64)
+    ri, di, half = 0, 0, 0
+    while di < len(data):
+        if di == len(data) - 1 and half == 1 and (data[di] & 0xF) == 0:
+            break
+        buff, di, half, corrupt = _decode_int(data, di, half)
+        if corrupt:
+            return result[:ri], True
+        result[ri] = buff
+        ri += 1
+    return result[:ri], False
@@ -1,17 +1,30 @@
+import collections
+import concurrent.futures
 import datetime
+import functools
+import itertools
 import json
 import re
-from typing import Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import requests
 import urllib.parse
 import spectrum_utils.spectrum as sus
-import splash
 
+from metabolomics_spectrum_resolver import (
+    caching,
+    config,
+    datasets,
+    deadlines,
+    decoding,
+    ms2lda,
+    peakfiles,
+    store,
+    taskfiles,
+    upstream,
+)
 from metabolomics_spectrum_resolver.error import UsiError
 
-timeout = 45  # seconds
-
 MS2LDA_SERVER = "http://ms2lda.org/basicviz/"
 MOTIFDB_SERVER = "http://ms2lda.org/motifdb/"
 MASSBANK_SERVER = "https://massbank.us/rest/spectra/"
@@ -72,11 +85,56 @@ gnps_task_pattern = re.compile(
     r"^TASK-([a-z0-9]{32})-(.+)$", flags=re.IGNORECASE
 )
 ms2lda_task_pattern = re.compile(r"^TASK-(\d+)$", flags=re.IGNORECASE)
-
-splash_builder = splash.Splash()
+# Conversions from legacy metabolomics USIs to proper metabolomics USIs.
+legacy_usi_conversions = [
+    # GNPS task.
+    (
+        re.compile(
+            r"^(?:mzspec|mzdraft):GNPSTASK-([a-z0-9]{32}):(.+):scan:(\d+)$",
+            flags=re.IGNORECASE,
+        ),
+        "mzspec:GNPS:TASK-{0}-{1}:scan:{2}",
+    ),
+    # GNPS library.
+    (
+        re.compile(
+            r"^(?:mzspec|mzdraft):GNPSLIBRARY:(CCMSLIB\d+)$",
+            flags=re.IGNORECASE,
+        ),
+        "mzspec:GNPS:GNPS-LIBRARY:accession:{0}",
+    ),
+    # MassBank.
+    (
+        re.compile(
+            r"^(?:mzspec|mzdraft):MASSBANK:([^:]+)$", flags=re.IGNORECASE
+        ),
+        "mzspec:MASSBANK::accession:{0}",
+    ),
+    # MotifDB.
+    (
+        re.compile(
+            r"^(?:mzspec|mzdraft):MOTIFDB:motif:([^:]+)$",
+            flags=re.IGNORECASE,
+        ),
+        "mzspec:MOTIFDB::accession:{0}",
+    ),
+    # MS2LDA.
+    (
+        re.compile(
+            r"^(?:mzspec|mzdraft):MS2LDATASK-([^:]+):document:([^:]+)$",
+            flags=re.IGNORECASE,
+        ),
+        "mzspec:MS2LDA:TASK-{0}:accession:{1}",
+    ),
+]
+
+UsiComponents = collections.namedtuple(
+    "UsiComponents",
+    ["collection", "ms_run", "index_flag", "index", "interpretation"],
+)
 
 
-def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str, str]:
+def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
     """
     Retrieve the spectrum associated with the given USI.
 
@@ -87,26 +145,13 @@ def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str, str]:
 
     Returns
     -------
-    Tuple[sus.MsmsSpectrum, str, str]
-        A tuple of the `MsmsSpectrum`, its source link, and its SPLASH.
+    Tuple[sus.MsmsSpectrum, str]
+        A tuple of the `MsmsSpectrum` and its source link.
     """
-    match = _match_usi(usi)
+    components = parse_usi_components(usi)
     try:
-        collection = match.group(1).lower()
-        annotation = match.group(5)
-        # Send all proteomics USIs (by definition all annotated USIs) to
-        # MassIVE.
-        # mzdraft USIs are assumed to also use ProForma notation. If this
-        # changes, be sure to change this logic.
-        if (
-            annotation is not None
-            or collection.startswith("msv")
-            or collection.startswith("pxd")
-            or collection.startswith("pxl")
-            or collection.startswith("rpxd")
-            or collection == "massivekb"
-            or collection == "massive"
-        ):
+        collection = components.collection.lower()
+        if _is_massive_usi(components):
             spectrum, source_link = _parse_msv_pxd(usi)
         elif collection == "gnps":
             spectrum, source_link = _parse_gnps(usi)
@@ -117,14 +162,10 @@ def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str, str]:
         elif collection == "motifdb":
             spectrum, source_link = _parse_motifdb(usi)
         else:
-            raise UsiError(f"Unknown USI collection: {match.group(1)}", 400)
-        splash_key = splash_builder.splash(
-            splash.Spectrum(
-                list(zip(spectrum.mz, spectrum.intensity)),
-                splash.SpectrumType.MS,
+            raise UsiError(
+                f"Unknown USI collection: {components.collection}", 400
             )
-        )
-        return spectrum, source_link, splash_key
+        return spectrum, source_link
     except requests.exceptions.Timeout:
         raise UsiError(
             "Timeout while retrieving the USI from an external " "resource",
@@ -132,7 +173,56 @@ def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str, str]:
         )
 
 
-def parse_spectrum(spectrum: dict) -> Tuple[sus.MsmsSpectrum, str, str]:
+def get_backend(usi: str) -> str:
+    """
+    Get the upstream backend that resolves the given USI.
+
+    Parameters
+    ----------
+    usi : str
+        The USI of the spectrum to be retrieved from its resource.
+
+    Returns
+    -------
+    str
+        The upstream backend: "massive", "gnps", "massbank", or "ms2lda".
+
+    Raises
+    ------
+    UsiError
+        If the USI is incorrectly formatted or its collection is unknown.
+    """
+    components = parse_usi_components(usi)
+    collection = components.collection.lower()
+    if _is_massive_usi(components):
+        return "massive"
+    elif collection in ("gnps", "massbank"):
+        return collection
+    elif collection in ("ms2lda", "motifdb"):
+        return "ms2lda"
+    else:
+        raise UsiError(f"Unknown USI collection: {components.collection}", 400)
+
+
+def _is_massive_usi(components: UsiComponents) -> bool:
+    collection = components.collection.lower()
+    annotation = components.interpretation
+    # Send all proteomics USIs (by definition all annotated USIs) to
+    # MassIVE.
+    # mzdraft USIs are assumed to also use ProForma notation. If this
+    # changes, be sure to change this logic.
+    return (
+        annotation is not None
+        or collection.startswith("msv")
+        or collection.startswith("pxd")
+        or collection.startswith("pxl")
+        or collection.startswith("rpxd")
+        or collection == "massivekb"
+        or collection == "massive"
+    )
+
+
+def parse_spectrum(spectrum: dict) -> Tuple[sus.MsmsSpectrum, str]:
     """
     Parse the spectrum PROXI object into a MsmsSpectrum object.
 
@@ -143,8 +233,8 @@ def parse_spectrum(spectrum: dict) -> Tuple[sus.MsmsSpectrum, str, str]:
 
     Returns
     -------
-    Tuple[sus.MsmsSpectrum, str, str]
-        A tuple of the `MsmsSpectrum`, its source link, and its SPLASH.
+    Tuple[sus.MsmsSpectrum, str]
+        A tuple of the `MsmsSpectrum` and its source link.
     """
 
     source_link = "Peak Input"
@@ -198,19 +288,12 @@ def parse_spectrum(spectrum: dict) -> Tuple[sus.MsmsSpectrum, str, str]:
             intensity,
         )
 
-    splash_key = splash_builder.splash(
-        splash.Spectrum(
-            list(zip(spectrum.mz, spectrum.intensity)),
-            splash.SpectrumType.MS,
-        )
-    )
-
-    return spectrum, source_link, splash_key
+    return spectrum, source_link
 
 
 def parse_usi_or_spectrum(
     usi: str, spectrum_dict: dict
-) -> Tuple[sus.MsmsSpectrum, str, str]:
+) -> Tuple[sus.MsmsSpectrum, str]:
 
     if usi and usi != "":
         spectrum_output = parse_usi(usi)
@@ -222,10 +305,14 @@ def parse_usi_or_spectrum(
     return spectrum_output
 
 
-def _match_usi(usi: str) -> re.Match:
+@functools.lru_cache(maxsize=config.USI_PARSE_CACHE_SIZE)
+def parse_usi_components(usi: str) -> UsiComponents:
     """
     Parse a USI into its constituent parts.
 
+    Parsed USIs are memoized, so this is cheap enough to validate USIs
+    before they're resolved.
+
     Parameters
     ----------
     usi : str
@@ -233,24 +320,62 @@ def _match_usi(usi: str) -> re.Match:
 
     Returns
     -------
-    re.Match
-        The parsed USI.
+    UsiComponents
+        The collection, msRun, index flag, index, and (optional)
+        interpretation of the USI.
 
     Raises
     ------
     UsiError
         If the USI could not be parsed because it is incorrectly formatted.
     """
-    # Translate legacy USIs if necessary.
-    if usi_legacy_pattern.match(usi) is not None:
-        usi = _convert_legacy_usi(usi)
     # First try matching as an official USI, then as a metabolomics USI.
-    match = usi_pattern.match(usi)
-    if match is None:
-        match = usi_metabolomics_pattern.match(usi)
+    match = usi_pattern.match(usi) or usi_metabolomics_pattern.match(usi)
+    # Translate legacy USIs if necessary.
+    if match is None and usi_legacy_pattern.match(usi) is not None:
+        converted_usi = _convert_legacy_usi(usi)
+        match = usi_metabolomics_pattern.match(converted_usi)
     if match is None:
         raise UsiError(f"Incorrectly formatted USI: {usi}", 400)
-    return match
+    collection, ms_run, index_flag, index, interpretation = match.groups()
+    if interpretation is not None:
+        interpretation = interpretation[1:]
+    return UsiComponents(collection, ms_run, index_flag, index, interpretation)
+
+
+def canonicalize_usi(usi: str) -> str:
+    """
+    Convert a USI to a canonical form, so that equivalent USIs (e.g. a legacy
+    USI and its converted form) are identical.
+
+    Parameters
+    ----------
+    usi : str
+        The USI to be canonicalized.
+
+    Returns
+    -------
+    str
+        The canonical USI.
+
+    Raises
+    ------
+    UsiError
+        If the USI could not be parsed because it is incorrectly formatted.
+    """
+    components = parse_usi_components(usi)
+    canonical_usi = ":".join(
+        [
+            "mzspec",
+            components.collection.upper(),
+            components.ms_run,
+            components.index_flag.lower(),
+            components.index,
+        ]
+    )
+    if components.interpretation is not None:
+        canonical_usi = f"{canonical_usi}:{components.interpretation}"
+    return canonical_usi
 
 
 def _convert_legacy_usi(usi: str) -> str:
@@ -273,47 +398,17 @@ def _convert_legacy_usi(usi: str) -> str:
     UsiError
         If the legacy USI is incorrectly formatted.
     """
-    # Convert GNPS task legacy USI.
-    match = re.compile(
-        r"^(?:mzspec|mzdraft):GNPSTASK-([a-z0-9]{32}):(.+):scan:(\d+)$",
-        flags=re.IGNORECASE,
-    ).match(usi)
-    if match is not None:
-        return f"mzspec:GNPS:TASK-{match[1]}-{match[2]}:scan:{match[3]}"
-    # Convert GNPS library legacy USI.
-    match = re.compile(
-        r"^(?:mzspec|mzdraft):GNPSLIBRARY:(CCMSLIB\d+)$", flags=re.IGNORECASE
-    ).match(usi)
-    if match is not None:
-        return f"mzspec:GNPS:GNPS-LIBRARY:accession:{match[1]}"
-    # Convert MassBank legacy USI.
-    match = re.compile(
-        r"^(?:mzspec|mzdraft):MASSBANK:([^:]+)$", flags=re.IGNORECASE
-    ).match(usi)
-    if match is not None:
-        return f"mzspec:MASSBANK::accession:{match[1]}"
-    # Convert MotifDB legacy USI.
-    match = re.compile(
-        r"^(?:mzspec|mzdraft):MOTIFDB:motif:([^:]+)$", flags=re.IGNORECASE
-    ).match(usi)
-    if match is not None:
-        return f"mzspec:MOTIFDB::accession:{match[1]}"
-    # Convert MS2LDA legacy USI.
-    match = re.compile(
-        r"^(?:mzspec|mzdraft):MS2LDATASK-([^:]+):document:([^:]+)$",
-        flags=re.IGNORECASE,
-    ).match(usi)
-    if match is not None:
-        return f"mzspec:MS2LDA:TASK-{match[1]}:accession:{match[2]}"
+    for legacy_pattern, usi_format in legacy_usi_conversions:
+        match = legacy_pattern.match(usi)
+        if match is not None:
+            return usi_format.format(*match.groups())
     # Give an error on unknown legacy USI.
     raise UsiError(f"Incorrectly formatted legacy USI: {usi}", 400)
 
 
 # Parse GNPS tasks or library spectra.
 def _parse_gnps(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    ms_run = match.group(2)
-    if ms_run.lower().startswith("task"):
+    if parse_usi_components(usi).ms_run.lower().startswith("task"):
         return _parse_gnps_task(usi)
     else:
         return _parse_gnps_library(usi)
@@ -321,31 +416,43 @@ def _parse_gnps(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
 
 # Parse GNPS clustered spectra in Molecular Networking.
 def _parse_gnps_task(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    gnps_task_match = gnps_task_pattern.match(match.group(2))
+    components = parse_usi_components(usi)
+    gnps_task_match = gnps_task_pattern.match(components.ms_run)
     if gnps_task_match is None:
         raise UsiError("Incorrectly formatted GNPS task", 400)
     task = gnps_task_match.group(1)
     filename = gnps_task_match.group(2)
-    index_flag = match.group(3)
+    index_flag = components.index_flag
     if index_flag.lower() != "scan":
         raise UsiError("Currently supported GNPS TASK index flags: scan", 400)
-    scan = match.group(4)
-
+    scan = components.index
+    source_link = f"https://gnps.ucsd.edu/ProteoSAFe/status.jsp?task={task}"
+    # Use the locally cached task file if available (the first request for a
+    # file triggers its download in the background).
+    task_spectrum = taskfiles.get_spectrum(task, filename, scan)
+    if task_spectrum is not None:
+        params, mz, intensity = task_spectrum
+        spectrum = sus.MsmsSpectrum(
+            usi,
+            float(params.get("PEPMASS", "0").split()[0]),
+            peakfiles.parse_mgf_charge(params.get("CHARGE", "")),
+            mz,
+            intensity,
+        )
+        return spectrum, source_link
     try:
-        request_url = (
-            f"https://gnps.ucsd.edu/ProteoSAFe/DownloadResultFile?"
+        request_path = (
+            f"/ProteoSAFe/DownloadResultFile?"
             f"task={task}&invoke=annotatedSpectrumImageText&block=0"
             f"&file=FILE->{filename}&scan={scan}&peptide=*..*&"
             f"force=false&_=1561457932129&format=JSON"
         )
-        lookup_request = requests.get(request_url, timeout=timeout)
-        lookup_request.raise_for_status()
-        spectrum_dict = lookup_request.json()
-        mz, intensity = zip(*spectrum_dict["peaks"])
-        source_link = (
-            f"https://gnps.ucsd.edu/ProteoSAFe/status.jsp?" f"task={task}"
-        )
+        with upstream.get_mirrored(
+            "gnps", request_path, "DownloadResultFile", stream=True
+        ) as lookup_request:
+            lookup_request.raise_for_status()
+            spectrum_dict = decoding.response_spectrum_json(lookup_request)
+        mz, intensity = spectrum_dict["peaks"]
         if "precursor" in spectrum_dict:
             precursor_mz = float(spectrum_dict["precursor"].get("mz", 0))
             charge = int(spectrum_dict["precursor"].get("charge", 0))
@@ -360,29 +467,39 @@ def _parse_gnps_task(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
 
 # Parse GNPS library.
 def _parse_gnps_library(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    index_flag = match.group(3)
+    components = parse_usi_components(usi)
+    index_flag = components.index_flag
     if index_flag.lower() != "accession":
         raise UsiError(
             "Currently supported GNPS library index flags: accession", 400
         )
-    index = match.group(4)
+    index = components.index
+    source_link = (
+        f"https://gnps.ucsd.edu/ProteoSAFe/"
+        f"gnpslibraryspectrum.jsp?SpectrumID={index}"
+    )
+    # Use the local library mirror if it contains the spectrum.
+    library_spectrum = store.lookup(config.GNPS_LIBRARY_STORE, index)
+    if library_spectrum is not None:
+        spectrum = sus.MsmsSpectrum(
+            usi,
+            library_spectrum.precursor_mz,
+            library_spectrum.charge,
+            library_spectrum.mz,
+            library_spectrum.intensity,
+        )
+        return spectrum, source_link
     try:
-        request_url = (
-            f"https://gnps.ucsd.edu/ProteoSAFe/"
-            f"SpectrumCommentServlet?SpectrumID={index}"
+        request_path = f"/ProteoSAFe/SpectrumCommentServlet?SpectrumID={index}"
+        lookup_request = upstream.get_mirrored(
+            "gnps", request_path, "SpectrumCommentServlet"
         )
-        lookup_request = requests.get(request_url, timeout=timeout)
         lookup_request.raise_for_status()
-        spectrum_dict = lookup_request.json()
+        spectrum_dict = decoding.response_json(lookup_request)
         if spectrum_dict["spectruminfo"]["peaks_json"] == "null":
             raise UsiError("Unknown GNPS library USI", 404)
-        mz, intensity = zip(
-            *json.loads(spectrum_dict["spectruminfo"]["peaks_json"])
-        )
-        source_link = (
-            f"https://gnps.ucsd.edu/ProteoSAFe/"
-            f"gnpslibraryspectrum.jsp?SpectrumID={index}"
+        mz, intensity = decoding.peak_arrays(
+            spectrum_dict["spectruminfo"]["peaks_json"]
         )
 
         # Use the most up-to-date spectrum annotation.
@@ -407,39 +524,39 @@ def _parse_gnps_library(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
 
 # Parse MassBank entry.
 def _parse_massbank(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    index_flag = match.group(3)
+    components = parse_usi_components(usi)
+    index_flag = components.index_flag
     if index_flag.lower() != "accession":
         raise UsiError(
             "Currently supported MassBank index flags: accession", 400
         )
-    index = match.group(4)
-    # Clean up the new MassBank accessions if necessary.
-    massbank_accession = re.match(
-        # See https://github.com/MassBank/MassBank-web/blob/main/Documentation/MassBankRecordFormat.md#211-accession
-        r"MSBNK-[A-Za-z0–9_]{1,32}-([A-Z0–9_]{1,64})", index
+    index = normalize_massbank_accession(components.index)
+    source_link = (
+        f"https://massbank.eu/MassBank/" f"RecordDisplay.jsp?id={index}"
     )
-    if massbank_accession is not None:
-        index = massbank_accession.group(1)
+    # Use the local MassBank mirror if it contains the record.
+    massbank_spectrum = store.lookup(config.MASSBANK_STORE, index)
+    if massbank_spectrum is not None:
+        spectrum = sus.MsmsSpectrum(
+            usi,
+            massbank_spectrum.precursor_mz,
+            0,
+            massbank_spectrum.mz,
+            massbank_spectrum.intensity,
+        )
+        return spectrum, source_link
     try:
-        lookup_request = requests.get(
-            f"{MASSBANK_SERVER}{index}", timeout=timeout
+        lookup_request = upstream.get(
+            "massbank", f"{MASSBANK_SERVER}{index}", "spectra"
         )
         lookup_request.raise_for_status()
-        spectrum_dict = lookup_request.json()
-        mz, intensity = [], []
-        for peak in spectrum_dict["spectrum"].split():
-            peak_mz, peak_intensity = peak.split(":")
-            mz.append(float(peak_mz))
-            intensity.append(float(peak_intensity))
+        spectrum_dict = decoding.response_json(lookup_request)
+        mz, intensity = decoding.peak_arrays_text(spectrum_dict["spectrum"])
         precursor_mz = 0
         for metadata in spectrum_dict["metaData"]:
             if metadata["name"] == "precursor m/z":
                 precursor_mz = float(metadata["value"])
                 break
-        source_link = (
-            f"https://massbank.eu/MassBank/" f"RecordDisplay.jsp?id={index}"
-        )
 
         spectrum = sus.MsmsSpectrum(usi, precursor_mz, 0, mz, intensity)
         return spectrum, source_link
@@ -447,31 +564,69 @@ def _parse_massbank(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
         raise UsiError("Unknown MassBank USI", 404)
 
 
+def normalize_massbank_accession(accession: str) -> str:
+    """
+    Convert a MassBank accession to the identifier used by the MassBank API.
+
+    New style "MSBNK-<contributor>-<identifier>" accessions are reduced to
+    their identifier, other accessions are returned unchanged.
+
+    Parameters
+    ----------
+    accession : str
+        The MassBank accession.
+
+    Returns
+    -------
+    str
+        The normalized MassBank accession.
+    """
+    # Clean up the new MassBank accessions if necessary.
+    massbank_accession = re.match(
+        # See https://github.com/MassBank/MassBank-web/blob/main/Documentation/MassBankRecordFormat.md#211-accession
+        r"MSBNK-[A-Za-z0-9_]{1,32}-([A-Z0-9_]{1,64})$",
+        accession,
+    )
+    if massbank_accession is not None:
+        return massbank_accession.group(1)
+    return accession
+
+
 # Parse MS2LDA from ms2lda.org.
 def _parse_ms2lda(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    ms2lda_task_match = ms2lda_task_pattern.match(match.group(2))
+    components = parse_usi_components(usi)
+    ms2lda_task_match = ms2lda_task_pattern.match(components.ms_run)
     if ms2lda_task_match is None:
         raise UsiError("Incorrectly formatted MS2LDA task", 400)
     experiment_id = ms2lda_task_match.group(1)
-    index_flag = match.group(3)
+    index_flag = components.index_flag
     if index_flag.lower() != "accession":
         raise UsiError(
             "Currently supported MS2LDA index flags: accession", 400
         )
-    index = match.group(4)
+    index = components.index
+    source_link = f"http://ms2lda.org/basicviz/show_doc/{index}/"
+    # Use the local copy of the experiment if available (the first request
+    # for an experiment triggers its prefetch in the background).
+    document = ms2lda.get_document(experiment_id, index)
+    if document is not None:
+        spectrum = sus.MsmsSpectrum(
+            usi, document.precursor_mz, 0, document.mz, document.intensity
+        )
+        return spectrum, source_link
     try:
-        lookup_request = requests.get(
+        with upstream.get(
+            "ms2lda",
             f"{MS2LDA_SERVER}get_doc/?experiment_id={experiment_id}"
             f"&document_id={index}",
-            timeout=timeout,
-        )
-        lookup_request.raise_for_status()
-        spectrum_dict = json.loads(lookup_request.text)
+            "get_doc",
+            stream=True,
+        ) as lookup_request:
+            lookup_request.raise_for_status()
+            spectrum_dict = decoding.response_spectrum_json(lookup_request)
         if "error" in spectrum_dict:
             raise UsiError(f'MS2LDA error: {spectrum_dict["error"]}', 404)
-        mz, intensity = zip(*spectrum_dict["peaks"])
-        source_link = f"http://ms2lda.org/basicviz/show_doc/{index}/"
+        mz, intensity = spectrum_dict["peaks"]
 
         spectrum = sus.MsmsSpectrum(
             usi, float(spectrum_dict["precursor_mz"]), 0, mz, intensity
@@ -483,113 +638,304 @@ def _parse_ms2lda(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
 
 # Parse MSV or PXD library.
 def _parse_msv_pxd(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    dataset_identifier = match.group(1)
-    index_flag = match.group(3)
+    components = parse_usi_components(usi)
+    dataset_identifier = components.collection
+    index_flag = components.index_flag
     if index_flag.lower() != "scan":
         raise UsiError("Currently supported MassIVE index flags: scan", 400)
-    scan = match.group(4)
-    try:
-        lookup_url = (
+    scan = components.index
+    if dataset_identifier.lower().startswith("pxd"):
+        source_link = (
+            f"http://proteomecentral.proteomexchange.org/"
+            f"cgi/GetDataset?ID={dataset_identifier}"
+        )
+    else:
+        source_link = (
             f"https://massive.ucsd.edu/ProteoSAFe/"
-            f"QuerySpectrum?id={urllib.parse.quote_plus(usi)}"
+            f"QueryMSV?id={dataset_identifier}"
         )
-        lookup_request = requests.get(lookup_url, timeout=timeout)
-        lookup_request.raise_for_status()
-        lookup_json = lookup_request.json()
-        for spectrum_file in lookup_json["row_data"]:
-            if any(
-                spectrum_file["file_descriptor"].lower().endswith(extension)
-                for extension in ["mzml", "mzxml", "mgf"]
-            ):
-                request_url = (
-                    f"https://massive.ucsd.edu/ProteoSAFe/"
-                    f"DownloadResultFile?"
-                    f"task=4f2ac74ea114401787a7e96e143bb4a1&"
-                    f"invoke=annotatedSpectrumImageText&block=0&file=FILE->"
-                    f"{urllib.parse.quote(spectrum_file['file_descriptor'])}"
-                    f"&scan={scan}&peptide=*..*&force=false&"
-                    f"format=JSON&uploadfile=True"
-                )
-                try:
-                    spectrum_request = requests.get(
-                        request_url, timeout=timeout
-                    )
-                    spectrum_request.raise_for_status()
-                    spectrum_dict = spectrum_request.json()
-                except (
-                    requests.exceptions.HTTPError,
-                    json.decoder.JSONDecodeError,
-                ):
-                    continue
-                if len(spectrum_dict["peaks"]) == 0:
-                    continue
-                mz, intensity = zip(*spectrum_dict["peaks"])
-                if "precursor" in spectrum_dict:
-                    precursor_mz = float(
-                        spectrum_dict["precursor"].get("mz", 0)
-                    )
-                    charge = int(spectrum_dict["precursor"].get("charge", 0))
-                else:
-                    precursor_mz, charge = 0, 0
-                if dataset_identifier.lower().startswith("pxd"):
-                    source_link = (
-                        f"http://proteomecentral.proteomexchange.org/"
-                        f"cgi/GetDataset?ID={dataset_identifier}"
-                    )
-                else:
-                    source_link = (
-                        f"https://massive.ucsd.edu/ProteoSAFe/"
-                        f"QueryMSV?id={dataset_identifier}"
-                    )
-
-                # Parse the peptide if available.
-                try:
-                    # Get the peptide information from resolution,
-                    # this dereferences proforma.
-                    peptide_clean = lookup_json["usi_components"]["peptide"]
-                    peptide = lookup_json["usi_components"]["variant"]
-                    charge = int(lookup_json["usi_components"]["charge"])
-
-                    peptide, peptide_clean, modifications = _parse_sequence(
-                        peptide, peptide_clean
-                    )
-                    spectrum = sus.MsmsSpectrum(
-                        usi,
-                        precursor_mz,
-                        charge,
-                        mz,
-                        intensity,
-                        peptide=peptide_clean,
-                        modifications=modifications,
-                    )
-                except (TypeError, KeyError):
-                    spectrum = sus.MsmsSpectrum(
-                        usi, precursor_mz, charge, mz, intensity
+    # Use the local copy of the peak file if available.
+    local_spectrum = datasets.get_spectrum(
+        dataset_identifier, components.ms_run, scan
+    )
+    if local_spectrum is not None and components.interpretation is None:
+        spectrum = sus.MsmsSpectrum(usi, *local_spectrum)
+        return spectrum, source_link
+    msv_files = caching.get_msv_files(dataset_identifier, components.ms_run)
+    # Without an interpretation the lookup only provides the candidate files,
+    # so the files that contained scans of the msRun before are tried first.
+    known_files = [
+        file_descriptor
+        for file_descriptor, found in msv_files.items()
+        if found
+        and local_spectrum is None
+        and components.interpretation is None
+    ]
+    try:
+        lookup_json, spectrum_dict = {}, None
+        if known_files:
+            spectrum_dict = _probe_msv_run(
+                dataset_identifier,
+                components.ms_run,
+                known_files,
+                scan,
+                msv_files,
+            )
+        if spectrum_dict is None:
+            lookup_url = (
+                f"https://massive.ucsd.edu/ProteoSAFe/"
+                f"QuerySpectrum?id={urllib.parse.quote_plus(usi)}"
+            )
+            lookup_request = upstream.get_hedged(
+                "massive", lookup_url, "QuerySpectrum"
+            )
+            lookup_request.raise_for_status()
+            lookup_json = decoding.response_json(lookup_request)
+        if local_spectrum is not None:
+            # Only the peptide interpretation is retrieved from MassIVE.
+            precursor_mz, charge, mz, intensity = local_spectrum
+        else:
+            if spectrum_dict is None:
+                # Known files that were tried already are skipped.
+                file_descriptors = [
+                    spectrum_file["file_descriptor"]
+                    for spectrum_file in lookup_json["row_data"]
+                    if any(
+                        spectrum_file["file_descriptor"]
+                        .lower()
+                        .endswith(extension)
+                        for extension in ["mzml", "mzxml", "mgf"]
                     )
+                    and spectrum_file["file_descriptor"] not in known_files
+                ]
+                spectrum_dict = _probe_msv_run(
+                    dataset_identifier,
+                    components.ms_run,
+                    file_descriptors,
+                    scan,
+                    msv_files,
+                )
+            if spectrum_dict is None:
+                raise UsiError("Unsupported/unknown USI", 404)
+            mz, intensity = spectrum_dict["peaks"]
+            if "precursor" in spectrum_dict:
+                precursor_mz = float(spectrum_dict["precursor"].get("mz", 0))
+                charge = int(spectrum_dict["precursor"].get("charge", 0))
+            else:
+                precursor_mz, charge = 0, 0
+
+        # Parse the peptide if available.
+        try:
+            # Get the peptide information from resolution,
+            # this dereferences proforma.
+            peptide_clean = lookup_json["usi_components"]["peptide"]
+            peptide = lookup_json["usi_components"]["variant"]
+            charge = int(lookup_json["usi_components"]["charge"])
+
+            peptide, peptide_clean, modifications = _parse_sequence(
+                peptide, peptide_clean
+            )
+            spectrum = sus.MsmsSpectrum(
+                usi,
+                precursor_mz,
+                charge,
+                mz,
+                intensity,
+                peptide=peptide_clean,
+                modifications=modifications,
+            )
+        except (TypeError, KeyError):
+            spectrum = sus.MsmsSpectrum(
+                usi, precursor_mz, charge, mz, intensity
+            )
 
-                return spectrum, source_link
+        return spectrum, source_link
     except requests.exceptions.HTTPError:
         pass
     raise UsiError("Unsupported/unknown USI", 404)
 
 
+def _probe_msv_run(
+    dataset: str,
+    ms_run: str,
+    file_descriptors: List[str],
+    scan: str,
+    msv_files: Dict[str, bool],
+) -> Optional[Dict[str, Any]]:
+    """
+    Retrieve a scan from the candidate MassIVE files of an msRun.
+
+    Files that contained scans of the msRun before are probed first. Files
+    that didn't contain them are only probed if none of the other candidates
+    contain the scan. Which files did and didn't contain the scan is
+    remembered for later scans of the msRun. Probes that failed don't tell
+    whether a file contains the scan, so those files aren't remembered.
+
+    Parameters
+    ----------
+    dataset : str
+        The dataset identifier.
+    ms_run : str
+        The msRun name.
+    file_descriptors : List[str]
+        The candidate MassIVE file descriptors, in order of preference.
+    scan : str
+        The scan number of the spectrum to retrieve.
+    msv_files : Dict[str, bool]
+        The MassIVE files that previously did or didn't contain scans of the
+        msRun (see `caching.get_msv_files`).
+
+    Returns
+    -------
+    Optional[Dict[str, Any]]
+        The spectrum JSON dict with the peaks as arrays (see
+        `decoding.response_spectrum_json`), or None if none of the candidates
+        contain the scan.
+    """
+    for candidates in [
+        sorted(
+            [
+                file_descriptor
+                for file_descriptor in file_descriptors
+                if msv_files.get(file_descriptor, True)
+            ],
+            key=lambda file_descriptor: not msv_files.get(file_descriptor),
+        ),
+        [
+            file_descriptor
+            for file_descriptor in file_descriptors
+            if not msv_files.get(file_descriptor, True)
+        ],
+    ]:
+        probed = {}
+        probe = _probe_msv_files(candidates, scan, probed)
+        if probe is not None:
+            # All earlier candidates that were probed successfully didn't
+            # contain the scan.
+            caching.set_msv_files(dataset, ms_run, probed)
+            return probe[1]
+    return None
+
+
+def _probe_msv_files(
+    file_descriptors: List[str],
+    scan: str,
+    probed: Optional[Dict[str, bool]] = None,
+) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """
+    Retrieve a scan from the first candidate MassIVE file that contains it.
+
+    Candidate files are probed concurrently with a bounded fan-out of
+    `config.MSV_MAX_CONCURRENT_PROBES`. The spectrum from the earliest
+    candidate in the given order is returned, so the preference order is
+    maintained when several candidates contain the scan. Pending probes are
+    cancelled as soon as a spectrum is found. Candidates whose probe failed
+    (e.g. a server error or an invalid response) are skipped.
+
+    Parameters
+    ----------
+    file_descriptors : List[str]
+        The candidate MassIVE file descriptors, in order of preference.
+    scan : str
+        The scan number of the spectrum to retrieve.
+    probed : Optional[Dict[str, bool]]
+        If given, the candidates that were probed successfully are added to
+        it, with whether they contained the scan.
+
+    Returns
+    -------
+    Optional[Tuple[str, Dict[str, Any]]]
+        A tuple of (i) the file descriptor of the file that contains the scan,
+        and (ii) the spectrum JSON dict with the peaks as arrays (see
+        `decoding.response_spectrum_json`), or None if none of the candidates
+        contain the scan.
+    """
+    pool = upstream.executor("probe")
+    candidates = iter(file_descriptors)
+    if probed is None:
+        probed = {}
+
+    def submit(file_descriptor: str) -> Tuple[str, concurrent.futures.Future]:
+        return file_descriptor, pool.submit(
+            deadlines.bind(_fetch_msv_file_spectrum, file_descriptor, scan)
+        )
+
+    probes = collections.deque(
+        submit(file_descriptor)
+        for file_descriptor in itertools.islice(
+            candidates, config.MSV_MAX_CONCURRENT_PROBES
+        )
+    )
+    try:
+        while probes:
+            file_descriptor, probe = probes.popleft()
+            try:
+                spectrum_dict = probe.result()
+            except (requests.exceptions.HTTPError, json.JSONDecodeError):
+                spectrum_dict = None
+            else:
+                probed[file_descriptor] = spectrum_dict is not None
+            if spectrum_dict is not None:
+                return file_descriptor, spectrum_dict
+            file_descriptor = next(candidates, None)
+            if file_descriptor is not None:
+                probes.append(submit(file_descriptor))
+    finally:
+        for _, probe in probes:
+            probe.cancel()
+    return None
+
+
+def _fetch_msv_file_spectrum(
+    file_descriptor: str, scan: str
+) -> Optional[Dict[str, Any]]:
+    request_url = (
+        f"https://massive.ucsd.edu/ProteoSAFe/"
+        f"DownloadResultFile?"
+        f"task=4f2ac74ea114401787a7e96e143bb4a1&"
+        f"invoke=annotatedSpectrumImageText&block=0&file=FILE->"
+        f"{urllib.parse.quote(file_descriptor)}"
+        f"&scan={scan}&peptide=*..*&force=false&"
+        f"format=JSON&uploadfile=True"
+    )
+    # Only responses that show that the file doesn't contain the scan give
+    # None, other failures are raised.
+    with upstream.get_hedged(
+        "massive", request_url, "DownloadResultFile", stream=True
+    ) as spectrum_request:
+        if spectrum_request.status_code == 404:
+            return None
+        spectrum_request.raise_for_status()
+        try:
+            return decoding.response_spectrum_json(spectrum_request)
+        except json.JSONDecodeError:
+            raise
+        except ValueError:
+            # Files that don't contain the scan give an empty peak list.
+            return None
+
+
 # Parse MOTIFDB from ms2lda.org.
 def _parse_motifdb(usi: str) -> Tuple[sus.MsmsSpectrum, str]:
-    match = _match_usi(usi)
-    index_flag = match.group(3)
+    components = parse_usi_components(usi)
+    index_flag = components.index_flag
     if index_flag.lower() != "accession":
         raise UsiError(
             "Currently supported MOTIFDB index flags: accession", 400
         )
-    index = match.group(4)
+    index = components.index
+    source_link = f"http://ms2lda.org/motifdb/motif/{index}/"
+    # Use the local MotifDB snapshot if available.
+    motif = ms2lda.get_motif(index)
+    if motif is not None:
+        spectrum = sus.MsmsSpectrum(usi, 0, 0, motif.mz, motif.intensity)
+        return spectrum, source_link
     try:
-        lookup_request = requests.get(
-            f"{MOTIFDB_SERVER}get_motif/{index}", timeout=timeout
+        lookup_request = upstream.get(
+            "ms2lda", f"{MOTIFDB_SERVER}get_motif/{index}", "get_motif"
         )
         lookup_request.raise_for_status()
-        mz, intensity = zip(*json.loads(lookup_request.text))
-        source_link = f"http://ms2lda.org/motifdb/motif/{index}/"
+        mz, intensity = decoding.peak_arrays(lookup_request.content)
 
         spectrum = sus.MsmsSpectrum(usi, 0, 0, mz, intensity)
         return spectrum, source_link
@@ -0,0 +1,454 @@
+import base64
+import mmap
+import re
+import xml.etree.ElementTree as ElementTree
+import zlib
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+
+from metabolomics_spectrum_resolver import numpress
+
+
+# mzML binary data array controlled vocabulary terms.
+_MZML_MZ_ARRAY = "MS:1000514"
+_MZML_INTENSITY_ARRAY = "MS:1000515"
+_MZML_SELECTED_ION_MZ = "MS:1000744"
+_MZML_CHARGE_STATE = "MS:1000041"
+_MZML_DTYPES = {
+    "MS:1000521": "<f4",
+    "MS:1000523": "<f8",
+    "MS:1000519": "<i4",
+    "MS:1000522": "<i8",
+}
+_MZML_ZLIB = {"MS:1000574", "MS:1002746", "MS:1002747", "MS:1002748"}
+_MZML_NUMPRESS = {
+    "MS:1002312": numpress.decode_linear,
+    "MS:1002746": numpress.decode_linear,
+    "MS:1002313": numpress.decode_pic,
+    "MS:1002747": numpress.decode_pic,
+    "MS:1002314": numpress.decode_slof,
+    "MS:1002748": numpress.decode_slof,
+}
+
+Buffer = Union[bytes, mmap.mmap]
+
+
+def iter_mgf(
+    mgf_file: BinaryIO,
+) -> Iterator[Tuple[int, Dict[str, str], np.ndarray, np.ndarray]]:
+    """
+    Read all spectra from an MGF file.
+
+    Parameters
+    ----------
+    mgf_file : BinaryIO
+        The MGF file opened in binary mode.
+
+    Returns
+    -------
+    Iterator[Tuple[int, Dict[str, str], np.ndarray, np.ndarray]]
+        For each spectrum a tuple of (i) the byte offset of its "BEGIN IONS"
+        line, (ii) its parameters with upper case keys, (iii) its m/z values,
+        and (iv) its intensities.
+    """
+    offset = mgf_file.tell()
+    for line in mgf_file:
+        if line.strip().upper() == b"BEGIN IONS":
+            params, mz, intensity = _read_mgf_ions(mgf_file)
+            yield offset, params, mz, intensity
+        offset = mgf_file.tell()
+
+
+def read_mgf_spectrum(
+    mgf_file: BinaryIO, offset: int
+) -> Tuple[Dict[str, str], np.ndarray, np.ndarray]:
+    """
+    Read the spectrum at the given byte offset from an MGF file.
+
+    Parameters
+    ----------
+    mgf_file : BinaryIO
+        The MGF file opened in binary mode.
+    offset : int
+        The byte offset of the spectrum's "BEGIN IONS" line.
+
+    Returns
+    -------
+    Tuple[Dict[str, str], np.ndarray, np.ndarray]
+        A tuple of the spectrum's parameters with upper case keys, its m/z
+        values, and its intensities.
+
+    Raises
+    ------
+    ValueError
+        If no spectrum starts at the given offset.
+    """
+    mgf_file.seek(offset)
+    if mgf_file.readline().strip().upper() != b"BEGIN IONS":
+        raise ValueError(f"No MGF spectrum at offset {offset}")
+    return _read_mgf_ions(mgf_file)
+
+
+def parse_mgf_charge(charge: str) -> int:
+    """
+    Convert an MGF charge (e.g. "2+", "1-", "3") to an integer.
+
+    Multiple charges (e.g. "2+ and 3+") are resolved to the first charge.
+
+    Parameters
+    ----------
+    charge : str
+        The MGF charge.
+
+    Returns
+    -------
+    int
+        The charge, or 0 if the charge is unknown.
+    """
+    charge = charge.split()[0].split(",")[0] if charge.strip() else "0"
+    try:
+        if charge.endswith("-"):
+            return -int(charge[:-1])
+        return int(charge.rstrip("+"))
+    except ValueError:
+        return 0
+
+
+def index_mgf(mgf_file: BinaryIO) -> Dict[str, int]:
+    """
+    Index the spectra in an MGF file by their scan number.
+
+    Parameters
+    ----------
+    mgf_file : BinaryIO
+        The MGF file opened in binary mode.
+
+    Returns
+    -------
+    Dict[str, int]
+        A mapping from scan numbers to the byte offsets of the spectra's
+        "BEGIN IONS" lines. Spectra without a SCANS parameter are identified
+        by their (one-based) position in the file.
+    """
+    index = {}
+    for i, (offset, params, _, _) in enumerate(iter_mgf(mgf_file), 1):
+        index[params.get("SCANS", str(i)).strip()] = offset
+    return index
+
+
+def index_mzml(data: Buffer) -> Dict[str, int]:
+    """
+    Index the spectra in an mzML file by their scan number.
+
+    The offset list of indexed mzML files is used if available, otherwise
+    the file is scanned for spectra.
+
+    Parameters
+    ----------
+    data : Buffer
+        The contents of the mzML file (e.g. memory-mapped).
+
+    Returns
+    -------
+    Dict[str, int]
+        A mapping from scan numbers to the byte offsets of the spectra.
+        Spectra without a scan number in their native identifier are
+        identified by their (one-based) position in the file.
+    """
+    entries = _read_index(
+        data,
+        rb"<indexListOffset>(\d+)</indexListOffset>",
+        rb'<index\s+name="spectrum"\s*>(.*?)</index>',
+        rb'<offset\s+idRef="([^"]*)"[^>]*>(\d+)</offset>',
+        b"<spectrum",
+    )
+    if entries is None:
+        entries = [
+            (match.group(1), match.start())
+            for match in re.finditer(
+                rb'<spectrum\s[^>]*?\bid="([^"]*)"', data, re.DOTALL
+            )
+        ]
+    index = {}
+    for i, (native_id, offset) in enumerate(entries, 1):
+        scan = re.search(rb"\bscan=(\d+)", native_id)
+        index[scan.group(1).decode() if scan else str(i)] = offset
+    return index
+
+
+def index_mzxml(data: Buffer) -> Dict[str, int]:
+    """
+    Index the spectra in an mzXML file by their scan number.
+
+    The scan index of the mzXML file is used if available, otherwise the file
+    is scanned for spectra.
+
+    Parameters
+    ----------
+    data : Buffer
+        The contents of the mzXML file (e.g. memory-mapped).
+
+    Returns
+    -------
+    Dict[str, int]
+        A mapping from scan numbers to the byte offsets of the spectra.
+    """
+    entries = _read_index(
+        data,
+        rb"<indexOffset>(\d+)</indexOffset>",
+        rb'<index\s+name="scan"\s*>(.*?)</index>',
+        rb'<offset\s+id="(\d+)"\s*>(\d+)</offset>',
+        b"<scan",
+    )
+    if entries is None:
+        entries = [
+            (match.group(1), match.start())
+            for match in re.finditer(
+                rb'<scan\s[^>]*?\bnum="(\d+)"', data, re.DOTALL
+            )
+        ]
+    return {scan.decode(): offset for scan, offset in entries}
+
+
+def read_mzml_spectrum(
+    data: Buffer, offset: int
+) -> Tuple[float, int, np.ndarray, np.ndarray]:
+    """
+    Read the spectrum at the given byte offset from an mzML file.
+
+    Only the requested spectrum is parsed. Binary data arrays can be zlib
+    and/or MS-Numpress compressed.
+
+    Parameters
+    ----------
+    data : Buffer
+        The contents of the mzML file (e.g. memory-mapped).
+    offset : int
+        The byte offset of the spectrum's "spectrum" element.
+
+    Returns
+    -------
+    Tuple[float, int, np.ndarray, np.ndarray]
+        A tuple of the spectrum's precursor m/z (0 if unknown), precursor
+        charge (0 if unknown), m/z values, and intensities.
+
+    Raises
+    ------
+    ValueError
+        If no spectrum starts at the given offset or its binary data arrays
+        can't be decoded.
+    """
+    spectrum = _read_element(data, offset, b"<spectrum", b"</spectrum>")
+    precursor_mz, charge = 0.0, 0
+    for selected_ion in spectrum.iter("selectedIon"):
+        for cv_param in selected_ion.iter("cvParam"):
+            if cv_param.get("accession") == _MZML_SELECTED_ION_MZ:
+                precursor_mz = float(cv_param.get("value"))
+            elif cv_param.get("accession") == _MZML_CHARGE_STATE:
+                charge = int(cv_param.get("value"))
+        break
+    mz = intensity = None
+    for binary_data_array in spectrum.iter("binaryDataArray"):
+        accessions = {
+            cv_param.get("accession")
+            for cv_param in binary_data_array.iter("cvParam")
+        }
+        if _MZML_MZ_ARRAY in accessions:
+            mz = _decode_mzml_array(binary_data_array, accessions)
+        elif _MZML_INTENSITY_ARRAY in accessions:
+            intensity = _decode_mzml_array(binary_data_array, accessions)
+    if mz is None or intensity is None or len(mz) != len(intensity):
+        raise ValueError(f"Invalid mzML peaks at offset {offset}")
+    return precursor_mz, charge, mz, intensity
+
+
+def read_mzxml_spectrum(
+    data: Buffer, offset: int
+) -> Tuple[float, int, np.ndarray, np.ndarray]:
+    """
+    Read the spectrum at the given byte offset from an mzXML file.
+
+    Only the requested spectrum is parsed.
+
+    Parameters
+    ----------
+    data : Buffer
+        The contents of the mzXML file (e.g. memory-mapped).
+    offset : int
+        The byte offset of the spectrum's "scan" element.
+
+    Returns
+    -------
+    Tuple[float, int, np.ndarray, np.ndarray]
+        A tuple of the spectrum's precursor m/z (0 if unknown), precursor
+        charge (0 if unknown), m/z values, and intensities.
+
+    Raises
+    ------
+    ValueError
+        If no spectrum starts at the given offset or its peaks can't be
+        decoded.
+    """
+    # Scans can contain nested scans after their peaks, so only read up to
+    # the peaks.
+    scan = _read_element(data, offset, b"<scan", b"</peaks>", b"</scan>")
+    precursor_mz, charge = 0.0, 0
+    precursor = scan.find("precursorMz")
+    if precursor is not None:
+        precursor_mz = float(precursor.text)
+        charge = int(precursor.get("precursorCharge", 0))
+    peaks = scan.find("peaks")
+    if peaks is None:
+        raise ValueError(f"No mzXML peaks at offset {offset}")
+    values = base64.b64decode(peaks.text or "")
+    if peaks.get("compressionType", "none") == "zlib" and values:
+        values = zlib.decompress(values)
+    if peaks.get("byteOrder", "network") != "network":
+        raise ValueError("Unsupported mzXML byte order")
+    values = np.frombuffer(
+        values, ">f8" if peaks.get("precision") == "64" else ">f4"
+    ).reshape(-1, 2)
+    return (
+        precursor_mz,
+        charge,
+        values[:, 0].astype(np.float64),
+        values[:, 1].astype(np.float64),
+    )
+
+
+def parse_massbank_record(
+    record: str,
+) -> Optional[Tuple[str, float, np.ndarray, np.ndarray]]:
+    """
+    Parse a MassBank record file.
+
+    See https://github.com/MassBank/MassBank-web/blob/main/Documentation/MassBankRecordFormat.md
+
+    Parameters
+    ----------
+    record : str
+        The contents of the MassBank record file.
+
+    Returns
+    -------
+    Optional[Tuple[str, float, np.ndarray, np.ndarray]]
+        A tuple of the record's accession, precursor m/z (0 if unknown), m/z
+        values, and intensities, or None if the record doesn't have an
+        accession.
+    """
+    accession, precursor_mz, peaks = None, 0.0, []
+    in_peaks = False
+    for line in record.splitlines():
+        if in_peaks:
+            if line.startswith("  "):
+                peaks.extend(line.split()[:2])
+                continue
+            in_peaks = False
+        if line.startswith("ACCESSION:"):
+            accession = line.split(":", 1)[1].strip()
+        elif line.startswith("MS$FOCUSED_ION: PRECURSOR_M/Z"):
+            try:
+                precursor_mz = float(line.split()[2].split("/")[0])
+            except (IndexError, ValueError):
+                pass
+        elif line.startswith("PK$PEAK:"):
+            in_peaks = True
+    if accession is None:
+        return None
+    peaks = np.array(peaks, np.float64).reshape(-1, 2)
+    return (
+        accession,
+        precursor_mz,
+        np.ascontiguousarray(peaks[:, 0]),
+        np.ascontiguousarray(peaks[:, 1]),
+    )
+
+
+def _read_index(
+    data: Buffer,
+    index_offset_pattern: bytes,
+    index_pattern: bytes,
+    offset_pattern: bytes,
+    element_start: bytes,
+) -> Optional[List[Tuple[bytes, int]]]:
+    # Read the offset list at the end of indexed mzML and mzXML files.
+    index_offset = re.search(index_offset_pattern, data[-1024:])
+    if index_offset is None:
+        return None
+    index = re.search(
+        index_pattern, data[int(index_offset.group(1)) :], re.DOTALL
+    )
+    if index is None:
+        return None
+    entries = [
+        (native_id, int(offset))
+        for native_id, offset in re.findall(offset_pattern, index.group(1))
+    ]
+    # Don't trust incorrect offsets written by some converters.
+    for _, offset in entries[:1]:
+        if data[offset : offset + len(element_start)] != element_start:
+            return None
+    return entries
+
+
+def _read_element(
+    data: Buffer, offset: int, start: bytes, end: bytes, suffix: bytes = b""
+) -> ElementTree.Element:
+    if data[offset : offset + len(start)] != start:
+        raise ValueError(f"No spectrum at offset {offset}")
+    end_offset = data.find(end, offset)
+    if end_offset == -1:
+        raise ValueError(f"Truncated spectrum at offset {offset}")
+    try:
+        element = ElementTree.fromstring(
+            data[offset : end_offset + len(end)] + suffix
+        )
+    except ElementTree.ParseError as e:
+        raise ValueError(f"Invalid spectrum at offset {offset}") from e
+    # Strip namespaces.
+    for child in element.iter():
+        child.tag = child.tag.rsplit("}", 1)[-1]
+    return element
+
+
+def _decode_mzml_array(
+    binary_data_array: ElementTree.Element, accessions: set
+) -> np.ndarray:
+    values = base64.b64decode(binary_data_array.findtext("binary") or "")
+    if not values:
+        return np.zeros(0, np.float64)
+    if accessions & _MZML_ZLIB:
+        values = zlib.decompress(values)
+    for accession in accessions:
+        if accession in _MZML_NUMPRESS:
+            return _MZML_NUMPRESS[accession](values)
+    for accession in accessions:
+        if accession in _MZML_DTYPES:
+            return np.frombuffer(values, _MZML_DTYPES[accession]).astype(
+                np.float64
+            )
+    raise ValueError("Unsupported mzML binary data array encoding")
+
+
+def _read_mgf_ions(
+    mgf_file: BinaryIO,
+) -> Tuple[Dict[str, str], np.ndarray, np.ndarray]:
+    params, peaks = {}, []
+    for line in mgf_file:
+        line = line.strip()
+        if not line:
+            continue
+        elif line.upper() == b"END IONS":
+            break
+        elif line[:1].isdigit():
+            peaks.extend(line.split()[:2])
+        elif b"=" in line:
+            key, value = line.decode().split("=", 1)
+            params[key.upper()] = value
+    peaks = np.array(peaks, np.float64).reshape(-1, 2)
+    return (
+        params,
+        np.ascontiguousarray(peaks[:, 0]),
+        np.ascontiguousarray(peaks[:, 1]),
+    )
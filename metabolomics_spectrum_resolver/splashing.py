@@ -0,0 +1,201 @@
+import hashlib
+import threading
+import weakref
+from typing import Tuple
+
+import numba as nb
+import numpy as np
+import spectrum_utils.spectrum as sus
+import splash
+
+
+# SPLASH (https://splash.fiehnlab.ucdavis.edu/) settings, as used by the
+# reference implementation.
+_EPS = 1.0e-7
+_BASE_36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+_RELATIVE_INTENSITY_SCALE = 100
+_PREFILTER_TOP_IONS = 10
+_PREFILTER_BASE_PEAK_FRACTION = 0.1
+_PREFILTER_HISTOGRAM = 3, 10, 5  # base, length, bin size
+_SIMILARITY_HISTOGRAM = 10, 10, 100  # base, length, bin size
+_MZ_PRECISION_FACTOR = 10 ** 6
+_SPECTRUM_HASH_LENGTH = 20
+
+_reference_builder = splash.Splash()
+
+# SPLASHes of previously processed spectra, which are forgotten when the
+# spectra are garbage collected.
+_spectrum_splashes: "weakref.WeakKeyDictionary[sus.MsmsSpectrum, str]" = (
+    weakref.WeakKeyDictionary()
+)
+_spectrum_splashes_lock = threading.Lock()
+
+
+def get_spectrum_splash(spectrum: sus.MsmsSpectrum) -> str:
+    """
+    Get the SPLASH of a spectrum.
+
+    The SPLASH is only computed on first use and is remembered for as long as
+    the spectrum exists.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum.
+
+    Returns
+    -------
+    str
+        The SPLASH.
+    """
+    with _spectrum_splashes_lock:
+        splash_key = _spectrum_splashes.get(spectrum)
+    if splash_key is None:
+        splash_key = get_splash(spectrum.mz, spectrum.intensity)
+        with _spectrum_splashes_lock:
+            _spectrum_splashes[spectrum] = splash_key
+    return splash_key
+
+
+def get_splash(mz: np.ndarray, intensity: np.ndarray) -> str:
+    """
+    Compute the SPLASH of an MS spectrum.
+
+    The SPLASH is computed directly from the peak arrays and is identical to
+    the SPLASH computed by the reference implementation from the same peaks.
+
+    Parameters
+    ----------
+    mz : np.ndarray
+        The m/z values of the peaks, in ascending order.
+    intensity : np.ndarray
+        The intensities of the peaks.
+
+    Returns
+    -------
+    str
+        The SPLASH.
+    """
+    mz = np.asarray(mz, np.float64)
+    intensity = np.asarray(intensity, np.float64)
+    if len(mz) == 0 or intensity.max() <= 0 or mz.min() < 0:
+        # Let the reference implementation handle degenerate spectra.
+        return _reference_builder.splash(
+            splash.Spectrum(
+                list(zip(mz.tolist(), intensity.tolist())),
+                splash.SpectrumType.MS,
+            )
+        )
+    intensity = intensity / intensity.max() * _RELATIVE_INTENSITY_SCALE
+    prefilter_mz, prefilter_intensity = _get_top_ions(
+        mz,
+        intensity,
+        _PREFILTER_TOP_IONS,
+        _PREFILTER_BASE_PEAK_FRACTION,
+    )
+    prefilter_histogram = _get_histogram(
+        prefilter_mz, prefilter_intensity, *_PREFILTER_HISTOGRAM
+    )
+    similarity_histogram = _get_histogram(
+        mz, intensity, *_SIMILARITY_HISTOGRAM
+    )
+    spectrum_hash = hashlib.sha256(
+        _encode_ions(mz, intensity, _EPS, _MZ_PRECISION_FACTOR).tobytes()
+    ).hexdigest()
+    return "-".join(
+        [
+            f"splash{splash.SpectrumType.MS.value}0",
+            _to_base_36(
+                int(_to_digits(prefilter_histogram), _PREFILTER_HISTOGRAM[0])
+            ).rjust(4, "0"),
+            _to_digits(similarity_histogram),
+            spectrum_hash[:_SPECTRUM_HASH_LENGTH],
+        ]
+    )
+
+
+def _to_digits(histogram: np.ndarray) -> str:
+    return "".join([_BASE_36[i] for i in histogram])
+
+
+def _to_base_36(number: int) -> str:
+    digits = ""
+    while number > 0:
+        number, digit = divmod(number, 36)
+        digits = _BASE_36[digit] + digits
+    return digits
+
+
+@nb.njit
+def _get_top_ions(
+    mz: np.ndarray, intensity: np.ndarray, top_ions: int, fraction: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    # Most intense ions above the base peak fraction, by decreasing intensity
+    # and increasing m/z.
+    mask = intensity + _EPS >= fraction * intensity.max()
+    mz, intensity = mz[mask], intensity[mask]
+    order = _argsort(-intensity, _argsort(mz, np.arange(len(mz))))
+    order = order[:top_ions]
+    return mz[order], intensity[order]
+
+
+@nb.njit
+def _argsort(keys: np.ndarray, order: np.ndarray) -> np.ndarray:
+    # Stable sort of the given order by the keys, so that ties retain their
+    # previous order.
+    return order[np.argsort(keys[order], kind="mergesort")]
+
+
+@nb.njit
+def _get_histogram(
+    mz: np.ndarray,
+    intensity: np.ndarray,
+    base: int,
+    length: int,
+    bin_size: int,
+) -> np.ndarray:
+    # Histogram of the intensities in m/z bins that wrap around, scaled to
+    # digits in the given base.
+    histogram = np.zeros(length, np.float64)
+    for i in range(len(mz)):
+        histogram[int(mz[i] / bin_size) % length] += intensity[i]
+    max_intensity = histogram.max()
+    digits = np.empty(length, np.int64)
+    for i in range(length):
+        digits[i] = int(_EPS + (base - 1) * histogram[i] / max_intensity)
+    return digits
+
+
+@nb.njit
+def _encode_ions(
+    mz: np.ndarray, intensity: np.ndarray, eps: float, mz_factor: int
+) -> np.ndarray:
+    # Encode the ions as "mz:intensity" pairs of truncated integers, separated
+    # by spaces, by increasing m/z and decreasing intensity.
+    order = _argsort(mz, _argsort(-intensity, np.arange(len(mz))))
+    # Each ion takes at most 2 * 20 digits and 2 separators.
+    encoded = np.empty(len(mz) * 42, np.uint8)
+    n = 0
+    for i in order:
+        if n > 0:
+            encoded[n] = ord(" ")
+            n += 1
+        n = _encode_int(encoded, n, int((mz[i] + eps) * mz_factor))
+        encoded[n] = ord(":")
+        n += 1
+        n = _encode_int(encoded, n, int(intensity[i] + eps))
+    return encoded[:n]
+
+
+@nb.njit
+def _encode_int(encoded: np.ndarray, n: int, value: int) -> int:
+    # Write the decimal digits of a non-negative integer.
+    start = n
+    while True:
+        encoded[n] = ord("0") + value % 10
+        n += 1
+        value //= 10
+        if value == 0:
+            break
+    encoded[start:n] = encoded[start:n][::-1].copy()
+    return n
@@ -0,0 +1,268 @@
+import collections
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+
+StoredSpectrum = collections.namedtuple(
+    "StoredSpectrum", ["precursor_mz", "charge", "mz", "intensity", "metadata"]
+)
+
+_INDEX_FILENAME = "index.sqlite"
+_PEAKS_FILENAME = "peaks.bin"
+# Each build of a store is a separate directory named <path>.v<version>.
+_VERSION_SEPARATOR = ".v"
+
+_stores: Dict[str, "SpectrumStore"] = {}
+_stores_pid = None
+_stores_lock = threading.Lock()
+
+
+class SpectrumStore:
+    """
+    Read-only on-disk spectrum store.
+
+    Spectra are indexed by accession in an SQLite table, and their peaks are
+    stored contiguously in a binary file that is memory-mapped, so a lookup
+    only reads the requested spectrum's peaks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        # Versions of the store aren't modified after they're built.
+        self._version_path = os.path.realpath(path)
+        self._index_filename = os.path.join(
+            self._version_path, _INDEX_FILENAME
+        )
+        self._index_inode = os.stat(self._index_filename).st_ino
+        peaks_filename = os.path.join(self._version_path, _PEAKS_FILENAME)
+        if os.path.getsize(peaks_filename) > 0:
+            self._peaks = np.memmap(peaks_filename, np.float64, "r")
+        else:
+            self._peaks = np.zeros(0, np.float64)
+        self._local = threading.local()
+
+    def get(self, key: str) -> Optional[StoredSpectrum]:
+        """
+        Get the spectrum with the given accession.
+
+        Parameters
+        ----------
+        key : str
+            The accession of the spectrum.
+
+        Returns
+        -------
+        Optional[StoredSpectrum]
+            The spectrum, or None if the accession is not in the store.
+        """
+        row = (
+            self._get_connection()
+            .execute(
+                "SELECT offset, n_peaks, precursor_mz, charge, metadata "
+                "FROM spectra WHERE key = ?",
+                (key,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        offset, n_peaks, precursor_mz, charge, metadata = row
+        return StoredSpectrum(
+            precursor_mz,
+            charge,
+            np.array(self._peaks[offset : offset + n_peaks]),
+            np.array(self._peaks[offset + n_peaks : offset + 2 * n_peaks]),
+            json.loads(metadata),
+        )
+
+    def is_current(self) -> bool:
+        """
+        Check whether the store was replaced on disk since it was opened.
+
+        Returns
+        -------
+        bool
+            False if the store was rebuilt or removed, True otherwise.
+        """
+        try:
+            return (
+                os.path.realpath(self.path) == self._version_path
+                and os.stat(self._index_filename).st_ino == self._index_inode
+            )
+        except FileNotFoundError:
+            return False
+
+    def _get_connection(self) -> sqlite3.Connection:
+        # SQLite connections can't be shared between threads.
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect(
+                f"file:{self._index_filename}?mode=ro",
+                uri=True,
+                check_same_thread=False,
+            )
+        return self._local.connection
+
+
+class SpectrumStoreWriter:
+    """
+    Build a spectrum store from scratch.
+
+    The store's path is a symbolic link to the directory of its current
+    version. Each build is written to a new version directory, and closing
+    the writer atomically replaces the link, so lookups always find a
+    complete store. The previous version is kept until the next build, so
+    that processes that still have it open can keep reading it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._version_path = f"{path}{_VERSION_SEPARATOR}{time.time_ns()}"
+        os.makedirs(self._version_path)
+        self._peaks_file = open(
+            os.path.join(self._version_path, _PEAKS_FILENAME), "wb"
+        )
+        self._connection = sqlite3.connect(
+            os.path.join(self._version_path, _INDEX_FILENAME)
+        )
+        self._connection.execute(
+            "CREATE TABLE spectra (key TEXT PRIMARY KEY, offset INTEGER, "
+            "n_peaks INTEGER, precursor_mz REAL, charge INTEGER, "
+            "metadata TEXT)"
+        )
+        self._offset = 0
+        self.n_spectra = 0
+
+    def __enter__(self) -> "SpectrumStoreWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._peaks_file.close()
+            self._connection.close()
+            shutil.rmtree(self._version_path, ignore_errors=True)
+
+    def add(
+        self,
+        keys: Iterable[str],
+        precursor_mz: float,
+        charge: int,
+        mz: np.ndarray,
+        intensity: np.ndarray,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """
+        Add a spectrum to the store.
+
+        Parameters
+        ----------
+        keys : Iterable[str]
+            The accession(s) under which the spectrum can be retrieved. If an
+            accession was already added, the previous spectrum is replaced.
+        precursor_mz : float
+            The spectrum's precursor m/z.
+        charge : int
+            The spectrum's precursor charge.
+        mz : np.ndarray
+            The spectrum's peak m/z values.
+        intensity : np.ndarray
+            The spectrum's peak intensities.
+        metadata : Optional[Dict[str, Any]]
+            Additional JSON-serializable information about the spectrum.
+        """
+        mz = np.asarray(mz, np.float64)
+        intensity = np.asarray(intensity, np.float64)
+        self._peaks_file.write(mz.tobytes())
+        self._peaks_file.write(intensity.tobytes())
+        self._connection.executemany(
+            "INSERT OR REPLACE INTO spectra VALUES (?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    key,
+                    self._offset,
+                    len(mz),
+                    float(precursor_mz),
+                    int(charge),
+                    json.dumps(metadata or {}),
+                )
+                for key in keys
+            ],
+        )
+        self._offset += 2 * len(mz)
+        self.n_spectra += 1
+
+    def close(self) -> None:
+        """
+        Finalize the store and atomically make it the current version.
+        """
+        self._peaks_file.close()
+        self._connection.commit()
+        self._connection.close()
+        previous_path = os.path.realpath(self.path)
+        if not os.path.islink(self.path) and os.path.isdir(self.path):
+            # Convert a store that was built before stores were versioned.
+            previous_path = f"{self.path}{_VERSION_SEPARATOR}0"
+            os.rename(self.path, previous_path)
+        link_path = f"{self._version_path}.link"
+        os.symlink(os.path.basename(self._version_path), link_path)
+        os.replace(link_path, self.path)
+        _remove_versions(self.path, [self._version_path, previous_path])
+
+
+def _remove_versions(path: str, keep: Iterable[str]) -> None:
+    # Remove older versions and abandoned builds of a store.
+    keep = {os.path.realpath(version_path) for version_path in keep}
+    directory, name = os.path.split(os.path.abspath(path))
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if not entry.name.startswith(f"{name}{_VERSION_SEPARATOR}"):
+                continue
+            if entry.is_symlink():
+                os.remove(entry.path)
+            elif os.path.realpath(entry.path) not in keep:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def lookup(path: Optional[str], key: str) -> Optional[StoredSpectrum]:
+    """
+    Look up a spectrum in the store at the given path.
+
+    Stores are opened once per process and reopened when they are rebuilt.
+
+    Parameters
+    ----------
+    path : Optional[str]
+        The path of the store. If None, or if no store exists at the path, no
+        spectrum is returned.
+    key : str
+        The accession of the spectrum.
+
+    Returns
+    -------
+    Optional[StoredSpectrum]
+        The spectrum, or None if it's not available in the store.
+    """
+    global _stores_pid
+    if path is None:
+        return None
+    with _stores_lock:
+        # Don't share SQLite connections with a parent process.
+        if _stores_pid != os.getpid():
+            _stores.clear()
+            _stores_pid = os.getpid()
+        spectrum_store = _stores.get(path)
+        if spectrum_store is None or not spectrum_store.is_current():
+            try:
+                spectrum_store = _stores[path] = SpectrumStore(path)
+            except FileNotFoundError:
+                _stores.pop(path, None)
+                return None
+    return spectrum_store.get(key)
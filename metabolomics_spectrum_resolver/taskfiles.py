@@ -0,0 +1,236 @@
+import collections
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from metabolomics_spectrum_resolver import config, peakfiles, upstream
+
+
+logger = logging.getLogger(__name__)
+
+MgfFile = collections.namedtuple("MgfFile", ["inode", "data", "index"])
+
+# Download and indexing of a file that takes longer than this is considered
+# to have failed.
+_STALE_DOWNLOAD_AGE = 3600  # seconds
+
+_open_files: "collections.OrderedDict[str, MgfFile]" = (
+    collections.OrderedDict()
+)
+_open_files_lock = threading.Lock()
+_downloads: Dict[str, float] = {}
+_downloads_lock = threading.Lock()
+
+
+def get_spectrum(
+    task: str, filename: str, scan: str
+) -> Optional[Tuple[Dict[str, str], np.ndarray, np.ndarray]]:
+    """
+    Get a spectrum from a locally cached GNPS task MGF file.
+
+    If the file isn't cached yet, it is downloaded and indexed in the
+    background so that subsequent scans from the same file can be served
+    locally.
+
+    Parameters
+    ----------
+    task : str
+        The GNPS task identifier.
+    filename : str
+        The MGF file in the task's results (e.g. "spectra/specs_ms.mgf").
+    scan : str
+        The scan number of the spectrum.
+
+    Returns
+    -------
+    Optional[Tuple[Dict[str, str], np.ndarray, np.ndarray]]
+        A tuple of the spectrum's MGF parameters with upper case keys, its m/z
+        values, and its intensities, or None if the file isn't cached (yet) or
+        doesn't contain the scan.
+    """
+    is_mgf = filename.lower().endswith(".mgf")
+    if config.GNPS_TASK_FILE_CACHE is None or not is_mgf:
+        return None
+    key = hashlib.sha1(f"{task}:{filename}".encode()).hexdigest()
+    mgf_file = _open(key)
+    if mgf_file is None:
+        _schedule_download(key, task, filename)
+        return None
+    offsets = mgf_file.index.get(scan)
+    if offsets is None:
+        return None
+    # Copy only the spectrum's bytes so that concurrent reads don't share a
+    # file position.
+    start, end = offsets
+    return peakfiles.read_mgf_spectrum(io.BytesIO(mgf_file.data[start:end]), 0)
+
+
+def _get_filenames(key: str) -> Tuple[str, str]:
+    path = os.path.join(config.GNPS_TASK_FILE_CACHE, key)
+    return f"{path}.mgf", f"{path}.index.json"
+
+
+def _open(key: str) -> Optional[MgfFile]:
+    mgf_filename, index_filename = _get_filenames(key)
+    try:
+        index_stat = os.stat(index_filename)
+    except FileNotFoundError:
+        return None
+    # Record accesses (at most once per minute) for the least recently used
+    # eviction.
+    if time.time() - index_stat.st_mtime > 60:
+        os.utime(index_filename)
+    inode = index_stat.st_ino
+    with _open_files_lock:
+        mgf_file = _open_files.get(key)
+        if mgf_file is not None and mgf_file.inode == inode:
+            _open_files.move_to_end(key)
+            return mgf_file
+    try:
+        with open(index_filename) as f:
+            index = json.load(f)
+        with open(mgf_filename, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # The file was evicted or is empty.
+        return None
+    mgf_file = MgfFile(inode, data, index)
+    with _open_files_lock:
+        _open_files[key] = mgf_file
+        while len(_open_files) > config.GNPS_TASK_FILE_MAX_OPEN:
+            _open_files.popitem(last=False)
+    return mgf_file
+
+
+def _schedule_download(key: str, task: str, filename: str) -> None:
+    # Don't retry failed downloads too often.
+    with _downloads_lock:
+        last_download = _downloads.get(key, 0)
+        if time.time() - last_download < config.GNPS_TASK_FILE_RETRY_INTERVAL:
+            return
+        _downloads[key] = time.time()
+    upstream.executor("download").submit(_download, key, task, filename)
+
+
+def _download(key: str, task: str, filename: str) -> None:
+    mgf_filename, index_filename = _get_filenames(key)
+    part_filename = f"{mgf_filename}.part"
+    # Failed downloads are remembered until they can be retried.
+    failed = True
+    try:
+        os.makedirs(config.GNPS_TASK_FILE_CACHE, exist_ok=True)
+        # Only a single process downloads the file.
+        try:
+            if time.time() - os.path.getmtime(part_filename) > (
+                _STALE_DOWNLOAD_AGE
+            ):
+                os.remove(part_filename)
+        except FileNotFoundError:
+            pass
+        try:
+            fd = os.open(part_filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            failed = False
+            return
+        with os.fdopen(fd, "wb") as part_file:
+            if not _fetch(task, filename, part_file):
+                os.remove(part_filename)
+                return
+        with open(part_filename, "rb") as part_file:
+            index = _build_index(part_file)
+        os.replace(part_filename, mgf_filename)
+        with open(f"{index_filename}.part", "w") as f:
+            json.dump(index, f)
+        os.replace(f"{index_filename}.part", index_filename)
+        logger.info(
+            "Cached GNPS task %s file %s with %d spectra",
+            task,
+            filename,
+            len(index),
+        )
+        failed = False
+        _evict()
+    except Exception:
+        logger.exception(
+            "Failed to cache GNPS task %s file %s", task, filename
+        )
+        for leftover_filename in (part_filename, f"{index_filename}.part"):
+            try:
+                os.remove(leftover_filename)
+            except FileNotFoundError:
+                pass
+    finally:
+        if not failed:
+            with _downloads_lock:
+                _downloads.pop(key, None)
+
+
+def _fetch(task: str, filename: str, part_file: io.BufferedWriter) -> bool:
+    path = (
+        f"/ProteoSAFe/DownloadResultFile?"
+        f"task={task}&file={filename}&block=main"
+    )
+    with upstream.get_mirrored(
+        "gnps",
+        path,
+        "TaskFile",
+        limit="gnps_download",
+        stream=True,
+        timeout=config.GNPS_TASK_FILE_TIMEOUT,
+    ) as response:
+        if response.status_code != 200:
+            return False
+        size = 0
+        for chunk in response.iter_content(2 ** 20):
+            size += len(chunk)
+            if size > config.GNPS_TASK_FILE_MAX_SIZE:
+                logger.warning(
+                    "Not caching GNPS task %s file %s larger than %d bytes",
+                    task,
+                    filename,
+                    config.GNPS_TASK_FILE_MAX_SIZE,
+                )
+                return False
+            part_file.write(chunk)
+    return size > 0
+
+
+def _build_index(mgf_file: io.BufferedReader) -> Dict[str, List[int]]:
+    index = peakfiles.index_mgf(mgf_file)
+    # Each spectrum ends where the next one starts.
+    offsets = sorted(index.values()) + [mgf_file.seek(0, io.SEEK_END)]
+    ends = dict(zip(offsets[:-1], offsets[1:]))
+    return {scan: [start, ends[start]] for scan, start in index.items()}
+
+
+def _evict() -> None:
+    files = collections.defaultdict(lambda: [0, 0.0])
+    with os.scandir(config.GNPS_TASK_FILE_CACHE) as entries:
+        for entry in entries:
+            if entry.name.endswith(".part"):
+                continue
+            key = entry.name.split(".", 1)[0]
+            stat = entry.stat()
+            files[key][0] += stat.st_size
+            if entry.name.endswith(".index.json"):
+                files[key][1] = stat.st_mtime
+    total_size = sum(size for size, _ in files.values())
+    for key, (size, _) in sorted(files.items(), key=lambda item: item[1][1]):
+        if total_size <= config.GNPS_TASK_FILE_CACHE_SIZE:
+            break
+        # Remove the index first so the file is no longer considered cached.
+        for filename in reversed(_get_filenames(key)):
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+        total_size -= size
+        logger.info("Evicted cached GNPS task file %s", key)
@@ -1,22 +1,71 @@
+import collections
+import concurrent.futures
+import hashlib
 import io
 import sys
-from typing import Any, Tuple
+import time
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
 
 import celery
+import celery.exceptions
+import celery.result
 import celery_once
 import joblib
 import redis
 import spectrum_utils.spectrum as sus
 
-from metabolomics_spectrum_resolver import drawing, parsing
+from metabolomics_spectrum_resolver import (
+    caching,
+    centroiding,
+    config,
+    deadlines,
+    drawing,
+    parsing,
+    upstream,
+)
+from metabolomics_spectrum_resolver.error import UsiError, UsiUnavailableError
 
 
 memory = joblib.Memory("tmp/joblibcache", verbose=0)
-cached_parse_usi = memory.cache(parsing.parse_usi)
 cached_parse_usi_or_spectrum = memory.cache(parsing.parse_usi_or_spectrum)
 cached_generate_figure = memory.cache(drawing.generate_figure)
 cached_generate_mirror_figure = memory.cache(drawing.generate_mirror_figure)
 
+
+# Cached spectra record when they were retrieved, so that stale spectra can be
+# refreshed.
+def _parse_usi_timestamped(
+    usi: str,
+) -> Tuple[float, float, Tuple[sus.MsmsSpectrum, str]]:
+    return caching.timestamped(parsing.parse_usi, usi)
+
+
+cached_parse_usi = memory.cache(_parse_usi_timestamped)
+
+
+# Centroided spectra are derived from the cached raw spectra and cached
+# separately. Refreshes centroid a newly retrieved spectrum instead, because
+# the cached raw spectrum can be as stale as the centroided spectrum.
+def _centroid_usi(
+    usi: str, refresh: bool = False
+) -> Tuple[sus.MsmsSpectrum, str]:
+    if refresh:
+        spectrum, source_link = parsing.parse_usi(usi)
+    else:
+        spectrum, source_link = _get_cached_usi(usi)
+    return centroiding.centroid_spectrum(spectrum), source_link
+
+
+def _centroid_usi_timestamped(
+    usi: str, refresh: bool = False
+) -> Tuple[float, float, Tuple[sus.MsmsSpectrum, str]]:
+    return caching.timestamped(_centroid_usi, usi, refresh)
+
+
+cached_centroid_usi = memory.cache(
+    _centroid_usi_timestamped, ignore=["refresh"]
+)
+
 celery_instance = celery.Celery(
     "tasks",
     backend="redis://metabolomicsusi-redis",
@@ -59,13 +108,14 @@ celery_instance.conf.task_routes = {
 
 
 def parse_usi_or_spectrum(
-    usi: str, spectrum: dict
-) -> Tuple[sus.MsmsSpectrum, str, str]:
+    usi: str, spectrum: dict, centroid: bool = False
+) -> Tuple[sus.MsmsSpectrum, str]:
     """
     Retrieve the spectrum associated with the given USI or spectrum PROXI object.
 
-    The first attempt to parse the USI is via a Celery task. Alternatively, as
-    a fallback option the USI can be parsed directly in this thread.
+    USIs are retrieved using `parse_usi`. The first attempt to parse the
+    spectrum is via a Celery task. Alternatively, as a fallback option the
+    spectrum can be parsed directly in this thread.
 
     Parameters
     ----------
@@ -73,57 +123,185 @@ def parse_usi_or_spectrum(
         The USI of the spectrum to be retrieved from its resource.
     spectrum : dict
         The JSON dict for a spectrum in PROXI format.
+    centroid : bool
+        Whether to centroid the spectrum (see `centroiding.centroid`).
 
     Returns
     -------
-    Tuple[sus.MsmsSpectrum, str, str]
-        A tuple of (i) the `MsmsSpectrum`, (ii) its source link, and (iii) its
-        SPLASH.
+    Tuple[sus.MsmsSpectrum, str]
+        A tuple of (i) the `MsmsSpectrum` and (ii) its source link.
     """
+    if usi:
+        return parse_usi(usi, centroid)
     # First attempt to schedule with Celery.
     try:
-        return _task_parse_usi_or_spectrum.apply_async(
-            args=(usi, spectrum)
-        ).get()
+        spectrum, source_link = _get_result(
+            _task_parse_usi_or_spectrum.apply_async(args=(usi, spectrum))
+        )
     except redis.exceptions.ConnectionError:
         # Fallback in case scheduling via Celery fails.
         # Mostly used for testing.
         # noinspection PyTypeChecker
-        return parsing.parse_usi_or_spectrum(usi, spectrum)
+        spectrum, source_link = parsing.parse_usi_or_spectrum(usi, spectrum)
+    if centroid:
+        spectrum = centroiding.centroid_spectrum(spectrum)
+    return spectrum, source_link
 
 
-def parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str, str]:
+def parse_usi(
+    usi: str, centroid: bool = False
+) -> Tuple[sus.MsmsSpectrum, str]:
     """
     Retrieve the spectrum associated with the given USI.
 
     The first attempt to parse the USI is via a Celery task. Alternatively, as
-    a fallback option the USI can be parsed directly in this thread.
+    a fallback option the USI can be parsed directly in this thread. USIs that
+    failed to resolve are remembered for a while and fail immediately.
+    Concurrent calls for the same USI in this process share a single lookup.
+    The lookup is abandoned when the deadline of the current request passes.
 
     Parameters
     ----------
     usi : str
         The USI of the spectrum to be retrieved from its resource.
+    centroid : bool
+        Whether to centroid the spectrum (see `centroiding.centroid`).
+        Centroided spectra are cached separately from the raw spectra.
 
     Returns
     -------
-    Tuple[sus.MsmsSpectrum, str, str]
-        A tuple of (i) the `MsmsSpectrum`, (ii) its source link, and (iii) its
-        SPLASH.
+    Tuple[sus.MsmsSpectrum, str]
+        A tuple of (i) the `MsmsSpectrum` and (ii) its source link.
+
+    Raises
+    ------
+    UsiError
+        If the USI is invalid or could not be resolved (recently), or the
+        deadline of the current request has passed.
     """
-    # First attempt to schedule with Celery.
+    # Reject invalid USIs and USIs that recently failed to resolve without a
+    # round-trip to the Celery workers.
+    parsing.get_backend(usi)
+    error = caching.get_negative(usi)
+    if error is not None:
+        raise error
+    # Share the lookup with concurrent requests for the same USI.
+    return caching.singleflight(
+        ("parse_usi", parsing.canonicalize_usi(usi), centroid),
+        _parse_usi,
+        usi,
+        centroid,
+    )
+
+
+def _parse_usi(usi: str, centroid: bool) -> Tuple[sus.MsmsSpectrum, str]:
     try:
-        return _task_parse_usi.apply_async(args=(usi,)).get()
-    except redis.exceptions.ConnectionError:
-        # Fallback in case scheduling via Celery fails.
-        # Mostly used for testing.
-        # noinspection PyTypeChecker
-        return parsing.parse_usi(usi)
+        # First attempt to schedule with Celery.
+        try:
+            return _get_result(
+                _task_parse_usi.apply_async(
+                    args=(usi,),
+                    kwargs={"deadline": deadlines.get(), "centroid": centroid},
+                )
+            )
+        except redis.exceptions.ConnectionError:
+            # Fallback in case scheduling via Celery fails.
+            # Mostly used for testing.
+            # noinspection PyTypeChecker
+            spectrum, source_link = parsing.parse_usi(usi)
+            if centroid:
+                spectrum = centroiding.centroid_spectrum(spectrum)
+            return spectrum, source_link
+    except UsiError as e:
+        # Don't remember failures caused by the caller's lack of time or by
+        # locally shedding load.
+        if not deadlines.expired() and not isinstance(
+            e, UsiUnavailableError
+        ):
+            caching.set_negative(usi, e)
+        raise
+
+
+def _get_result(result: celery.result.AsyncResult) -> Any:
+    # Wait for a Celery task until the deadline of the current request.
+    try:
+        return result.get(timeout=deadlines.remaining())
+    except celery.exceptions.TimeoutError:
+        raise deadlines.exceeded()
+
+
+def parse_usis(
+    usis: List[str], centroid: bool = False
+) -> Iterator[Tuple[str, Any]]:
+    """
+    Retrieve the spectra associated with the given USIs concurrently.
+
+    USIs are grouped by their upstream backend and each backend has at most
+    `config.BATCH_MAX_CONCURRENT` lookups in flight. Each lookup uses
+    `parse_usi`, so previously resolved spectra are retrieved from the cache.
+    Each lookup has its own deadline of `config.REQUEST_TIMEOUT` seconds from
+    when it starts, so that a slow USI fails without holding up the others.
+
+    Parameters
+    ----------
+    usis : List[str]
+        The USIs of the spectra to be retrieved from their resources.
+        Duplicate USIs are resolved only once.
+    centroid : bool
+        Whether to centroid the spectra (see `centroiding.centroid`).
+
+    Returns
+    -------
+    Iterator[Tuple[str, Any]]
+        Tuples of each USI and either (i) a tuple of the `MsmsSpectrum` and
+        its source link, or (ii) the exception that prevented its resolution,
+        in completion order.
+    """
+    backend_usis = collections.defaultdict(collections.deque)
+    for usi in dict.fromkeys(usis):
+        try:
+            backend_usis[parsing.get_backend(usi)].append(usi)
+        except UsiError as e:
+            yield usi, e
+    pool = upstream.executor("resolve")
+    pending = {}
+
+    def submit(backend: str) -> None:
+        usi = backend_usis[backend].popleft()
+        future = pool.submit(deadlines.bind(_parse_batch_usi, usi, centroid))
+        pending[future] = usi, backend
+
+    for backend, queued in backend_usis.items():
+        for _ in range(min(len(queued), config.BATCH_MAX_CONCURRENT[backend])):
+            submit(backend)
+    try:
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                usi, backend = pending.pop(future)
+                if backend_usis[backend]:
+                    submit(backend)
+                try:
+                    yield usi, future.result()
+                except Exception as e:
+                    yield usi, e
+    finally:
+        # Abandon queued lookups if the consumer stops early.
+        for future in pending:
+            future.cancel()
+
+
+def _parse_batch_usi(usi: str, centroid: bool) -> Tuple[sus.MsmsSpectrum, str]:
+    with deadlines.scope(time.time() + config.REQUEST_TIMEOUT):
+        return parse_usi(usi, centroid)
 
 
 @celery_instance.task(time_limit=30, base=celery_once.QueueOnce)
 def _task_parse_usi_or_spectrum(
     usi: str, spectrum: dict
-) -> Tuple[sus.MsmsSpectrum, str, str]:
+) -> Tuple[sus.MsmsSpectrum, str]:
     """
     Retrieve the spectrum associated with the given USI or spectrum PROXI object.
 
@@ -138,34 +316,61 @@ def _task_parse_usi_or_spectrum(
 
     Returns
     -------
-    Tuple[sus.MsmsSpectrum, str, str]
-        A tuple of (i) the `MsmsSpectrum`, (ii) its source link, and (iii) its
-        SPLASH.
+    Tuple[sus.MsmsSpectrum, str]
+        A tuple of (i) the `MsmsSpectrum` and (ii) its source link.
     """
+    if usi:
+        return _get_cached_usi(usi)
     # noinspection PyTypeChecker
     return cached_parse_usi_or_spectrum(usi, spectrum)
 
 
-@celery_instance.task(time_limit=30, base=celery_once.QueueOnce)
-def _task_parse_usi(usi: str) -> Tuple[sus.MsmsSpectrum, str, str]:
+@celery_instance.task(
+    time_limit=30,
+    base=celery_once.QueueOnce,
+    once={"keys": ["usi", "centroid"]},
+)
+def _task_parse_usi(
+    usi: str, deadline: Optional[float] = None, centroid: bool = False
+) -> Tuple[sus.MsmsSpectrum, str]:
     """
     Retrieve the spectrum associated with the given USI.
 
-    Previously computed results will be retrieved from the cache.
+    Previously computed results will be retrieved from the cache. Stale
+    results are refreshed in the background.
 
     Parameters
     ----------
     usi : str
         The USI of the spectrum to be retrieved from its resource.
+    deadline : Optional[float]
+        The time (in seconds since the epoch) by which the caller needs the
+        spectrum, or None if there is no deadline. Upstream requests only get
+        the remaining time, and the lookup is abandoned if the caller has
+        already given up.
+    centroid : bool
+        Whether to centroid the spectrum (see `centroiding.centroid`).
 
     Returns
     -------
-    Tuple[sus.MsmsSpectrum, str, str]
-        A tuple of (i) the `MsmsSpectrum`, (ii) its source link, and (iii) its
-        SPLASH.
+    Tuple[sus.MsmsSpectrum, str]
+        A tuple of (i) the `MsmsSpectrum` and (ii) its source link.
     """
+    with deadlines.scope(deadline):
+        deadlines.check()
+        return _get_cached_usi(usi, centroid)
+
+
+def _get_cached_usi(
+    usi: str, centroid: bool = False
+) -> Tuple[sus.MsmsSpectrum, str]:
+    if centroid:
+        # noinspection PyTypeChecker
+        return caching.get_revalidated(
+            cached_centroid_usi, f"usi:centroid:{usi}", usi, refresh=True
+        )
     # noinspection PyTypeChecker
-    return cached_parse_usi(usi)
+    return caching.get_revalidated(cached_parse_usi, f"usi:{usi}", usi)
 
 
 def generate_figure(
@@ -188,10 +393,28 @@ def generate_figure(
     io.BytesIO
         Bytes buffer containing the spectrum plot.
     """
+    # Share the plot with concurrent requests for the same plot.
+    key = _get_figure_key([spectrum], extension, kwargs)
+    buf = caching.singleflight(
+        ("generate_figure", key),
+        _generate_figure,
+        spectrum,
+        extension,
+        kwargs,
+    )
+    # Each caller reads its own buffer.
+    return io.BytesIO(buf.getvalue())
+
+
+def _generate_figure(
+    spectrum: sus.MsmsSpectrum, extension: str, kwargs: Dict[str, Any]
+) -> io.BytesIO:
     try:
-        return _task_generate_figure.apply_async(
-            args=(spectrum, extension), kwargs=kwargs
-        ).get()
+        return _get_result(
+            _task_generate_figure.apply_async(
+                args=(spectrum, extension), kwargs=kwargs
+            )
+        )
     except redis.exceptions.ConnectionError:
         return drawing.generate_figure(spectrum, extension, **kwargs)
 
@@ -247,16 +470,59 @@ def generate_mirror_figure(
     io.BytesIO
         Bytes buffer containing the mirror plot.
     """
+    # Share the plot with concurrent requests for the same plot.
+    key = _get_figure_key([spectrum_top, spectrum_bottom], extension, kwargs)
+    buf = caching.singleflight(
+        ("generate_mirror_figure", key),
+        _generate_mirror_figure,
+        spectrum_top,
+        spectrum_bottom,
+        extension,
+        kwargs,
+    )
+    # Each caller reads its own buffer.
+    return io.BytesIO(buf.getvalue())
+
+
+def _generate_mirror_figure(
+    spectrum_top: sus.MsmsSpectrum,
+    spectrum_bottom: sus.MsmsSpectrum,
+    extension: str,
+    kwargs: Dict[str, Any],
+) -> io.BytesIO:
     try:
-        return _task_generate_mirror_figure.apply_async(
-            args=(spectrum_top, spectrum_bottom, extension), kwargs=kwargs
-        ).get()
+        return _get_result(
+            _task_generate_mirror_figure.apply_async(
+                args=(spectrum_top, spectrum_bottom, extension), kwargs=kwargs
+            )
+        )
     except redis.exceptions.ConnectionError:
         return drawing.generate_mirror_figure(
             spectrum_top, spectrum_bottom, extension, **kwargs
         )
 
 
+def _get_figure_key(
+    spectra: List[sus.MsmsSpectrum], extension: str, kwargs: Dict[str, Any]
+) -> Hashable:
+    # Plots are identified by the spectra's peaks and the plotting settings,
+    # which determine the peak annotations.
+    spectrum_hash = hashlib.sha1()
+    for spectrum in spectra:
+        spectrum_hash.update(
+            repr(
+                (
+                    spectrum.identifier,
+                    spectrum.precursor_mz,
+                    spectrum.precursor_charge,
+                )
+            ).encode()
+        )
+        spectrum_hash.update(spectrum.mz.tobytes())
+        spectrum_hash.update(spectrum.intensity.tobytes())
+    return spectrum_hash.hexdigest(), extension, repr(sorted(kwargs.items()))
+
+
 @celery_instance.task(time_limit=30, base=celery_once.QueueOnce)
 def _task_generate_mirror_figure(
     spectrum_top: sus.MsmsSpectrum,
@@ -0,0 +1,736 @@
+import collections
+import concurrent.futures
+import contextlib
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import redis
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+from metabolomics_spectrum_resolver import caching, config, deadlines, limits
+from metabolomics_spectrum_resolver.error import UsiError, UsiUnavailableError
+
+
+logger = logging.getLogger(__name__)
+
+# Upstream status codes that indicate that the backend is unavailable.
+_UNAVAILABLE_STATUS_CODES = (502, 503, 504)
+
+_sessions: Dict[str, requests.Session] = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+_executors: Dict[str, concurrent.futures.ThreadPoolExecutor] = {}
+_executors_pid = None
+_executor_lock = threading.Lock()
+# Fallback circuit breaker state if Redis is unavailable.
+_breakers: Dict[str, Dict[str, float]] = collections.defaultdict(
+    lambda: {"failures": 0, "open_until": 0.0, "probe_until": 0.0}
+)
+_breakers_lock = threading.Lock()
+# Recent request durations (in seconds) per backend, and per backend and
+# endpoint.
+_latencies: Dict[str, Deque[float]] = collections.defaultdict(
+    lambda: collections.deque(maxlen=config.LATENCY_WINDOW)
+)
+_latencies_lock = threading.Lock()
+_hedge_tokens: Dict[str, float] = collections.defaultdict(float)
+_hedge_tokens_lock = threading.Lock()
+
+
+def get(
+    backend: str,
+    url: str,
+    endpoint: Optional[str] = None,
+    limit: Optional[str] = None,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    Perform a GET request to an upstream resource using a pooled session.
+
+    Unless a timeout is specified, the connect and read timeouts are derived
+    from the recently observed latencies of the endpoint (see
+    `get_timeout`).
+
+    Requests are guarded by a circuit breaker per backend (or per mirror,
+    for backends with multiple mirrors): after
+    `config.CIRCUIT_BREAKER_THRESHOLD` consecutive connection errors,
+    timeouts, or gateway errors, requests to the backend fail immediately
+    for `config.CIRCUIT_BREAKER_RESET_TIMEOUT` seconds. Afterwards, a single
+    probe request is allowed through to check whether the backend has
+    recovered. The breaker state is shared by all processes through Redis.
+
+    Requests are also limited in concurrency and rate per backend, or by
+    separate limits (see `limits.acquire`), and their timeout is limited to
+    the time left until the deadline of the current request (see
+    `deadlines`). Streamed responses hold their concurrency slot until
+    they're closed.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend that serves the URL (e.g. "gnps", "massive").
+    url : str
+        The URL to retrieve.
+    endpoint : Optional[str]
+        The name of the backend's endpoint that serves the URL (e.g.
+        "QuerySpectrum"), for which latencies are recorded separately.
+    limit : Optional[str]
+        The name of the limits in `config.UPSTREAM_LIMITS` that apply to the
+        request, by default the backend's.
+    kwargs : Any
+        Additional arguments for `requests.Session.get`.
+
+    Returns
+    -------
+    requests.Response
+        The upstream response.
+
+    Raises
+    ------
+    UsiError
+        If the backend's circuit breaker is open, the backend's request
+        limits are exceeded, or the deadline of the current request has
+        passed.
+    """
+    breaker = _get_breaker_name(backend, url)
+    failures = _check_breaker(breaker)
+    if "timeout" not in kwargs:
+        kwargs["timeout"] = get_timeout(backend, endpoint)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(
+            limits.acquire(limit or backend, _get_lease(kwargs["timeout"]))
+        )
+        timeout = kwargs["timeout"]
+        kwargs["timeout"] = deadlines.limit_timeout(timeout)
+        start = time.monotonic()
+        try:
+            response = get_session(backend).get(url, **kwargs)
+        except requests.exceptions.Timeout:
+            # Requests that ran out of the caller's time don't reflect on the
+            # backend.
+            if kwargs["timeout"] != timeout or deadlines.expired():
+                raise deadlines.exceeded()
+            # Timed out requests count as taking the full timeout, so that the
+            # timeouts increase for backends that become slower.
+            _record_latency(backend, endpoint, time.monotonic() - start)
+            _record_failure(breaker)
+            raise
+        except requests.exceptions.ConnectionError:
+            _record_failure(breaker)
+            raise
+        if kwargs.get("stream"):
+            _release_on_close(response, stack.pop_all())
+    _record_latency(backend, endpoint, time.monotonic() - start)
+    if response.status_code in _UNAVAILABLE_STATUS_CODES:
+        _record_failure(breaker)
+    elif failures > 0:
+        _record_success(breaker)
+    return response
+
+
+def get_hedged(
+    backend: str, url: str, endpoint: Optional[str] = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Perform an idempotent GET request to an upstream resource, hedged
+    against slow responses.
+
+    If the request hasn't been answered by the endpoint's recently observed
+    `config.HEDGE_PERCENTILE` latency, a second identical request is issued
+    and the first response is used. The fraction of hedged requests per
+    backend is limited by its budget in `config.HEDGE_BUDGET`; backends
+    without a budget are not hedged.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend that serves the URL (e.g. "gnps", "massive").
+    url : str
+        The URL to retrieve.
+    endpoint : Optional[str]
+        The name of the backend's endpoint that serves the URL (e.g.
+        "QuerySpectrum"), for which latencies are recorded separately.
+    kwargs : Any
+        Additional arguments for `requests.Session.get`.
+
+    Returns
+    -------
+    requests.Response
+        The upstream response.
+
+    Raises
+    ------
+    UsiError
+        If the backend's circuit breaker is open.
+    """
+    delay = _get_hedge_delay(backend, endpoint)
+    if delay is None:
+        return get(backend, url, endpoint, **kwargs)
+    pool = executor("hedge")
+    attempts = [
+        pool.submit(deadlines.bind(get, backend, url, endpoint, **kwargs))
+    ]
+    done, _ = concurrent.futures.wait(attempts, timeout=delay)
+    if not done and _take_hedge_token(backend):
+        attempts.append(
+            pool.submit(deadlines.bind(get, backend, url, endpoint, **kwargs))
+        )
+    pending = set(attempts)
+    try:
+        while True:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            # Fall back to the other request if the first one fails.
+            for attempt in done:
+                if attempt.exception() is None:
+                    return attempt.result()
+            if not pending:
+                return done.pop().result()
+    finally:
+        # Release the connection of the slower request when it finishes.
+        for attempt in pending:
+            attempt.add_done_callback(_close_response)
+
+
+def get_mirrored(
+    backend: str, path: str, endpoint: Optional[str] = None, **kwargs: Any
+) -> requests.Response:
+    """
+    Perform an idempotent GET request to the mirrors of an upstream backend.
+
+    The backend's equivalent base URLs are specified in
+    `config.UPSTREAM_MIRRORS`. The request is first sent to the best mirror,
+    preferring mirrors with a closed circuit breaker and a low median
+    latency. If the mirror fails or hasn't answered by its recently observed
+    `config.HEDGE_PERCENTILE` latency, the request is raced against the next
+    mirror, and so on. The first valid response is used. Backends with a
+    single mirror are requested using `get_hedged`.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps").
+    path : str
+        The path (and query) of the URL to retrieve, relative to the mirrors'
+        base URLs.
+    endpoint : Optional[str]
+        The name of the backend's endpoint that serves the URL (e.g.
+        "SpectrumCommentServlet"), for which latencies are recorded
+        separately per mirror.
+    kwargs : Any
+        Additional arguments for `requests.Session.get`.
+
+    Returns
+    -------
+    requests.Response
+        The first valid upstream response, or the last failed response if
+        none of the mirrors gave a valid response.
+
+    Raises
+    ------
+    UsiError
+        If the circuit breakers of all mirrors are open.
+    """
+    mirrors = _rank_mirrors(backend, endpoint)
+    if len(mirrors) == 1:
+        return get_hedged(backend, f"{mirrors[0]}{path}", endpoint, **kwargs)
+    pool = executor("hedge")
+    candidates = iter(mirrors)
+    pending, failed, result = set(), [], None
+
+    def race_next() -> Optional[float]:
+        # Request the next mirror and return how long to wait for it.
+        mirror = next(candidates, None)
+        if mirror is None:
+            return None
+        mirror_endpoint = _get_mirror_endpoint(endpoint, mirror)
+        pending.add(
+            pool.submit(
+                deadlines.bind(
+                    get, backend, f"{mirror}{path}", mirror_endpoint, **kwargs
+                )
+            )
+        )
+        delay = get_latency_percentile(
+            backend, config.HEDGE_PERCENTILE, mirror_endpoint
+        )
+        return delay if delay is not None else config.MIRROR_RACE_DELAY
+
+    try:
+        delay = race_next()
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=delay,
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for attempt in done:
+                if (
+                    attempt.exception() is None
+                    and attempt.result().status_code
+                    not in _UNAVAILABLE_STATUS_CODES
+                ):
+                    result = attempt
+                    return result.result()
+                failed.append(attempt)
+            # Race the next mirror if the current mirrors are slow or failed.
+            delay = race_next()
+        result = failed[-1]
+        return result.result()
+    finally:
+        # Release the connections of the other requests.
+        for attempt in pending:
+            attempt.add_done_callback(_close_response)
+        for attempt in failed:
+            if attempt is not result:
+                _close_response(attempt)
+
+
+def executor(name: str = "resolve") -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Get a process-wide I/O pool used for concurrent upstream lookups.
+
+    Separate pools are used for work that waits on other pooled work (e.g.
+    resolving a USI while probing its candidate files) to avoid exhausting a
+    single pool with waiting threads.
+
+    Parameters
+    ----------
+    name : str
+        The name of the pool, sized by `config.UPSTREAM_EXECUTORS`.
+
+    Returns
+    -------
+    concurrent.futures.ThreadPoolExecutor
+        The I/O pool.
+    """
+    global _executors_pid
+    with _executor_lock:
+        if _executors_pid != os.getpid():
+            _executors.clear()
+            _executors_pid = os.getpid()
+        if name not in _executors:
+            _executors[name] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.UPSTREAM_EXECUTORS[name],
+                thread_name_prefix=f"upstream-{name}",
+            )
+        return _executors[name]
+
+
+def get_breaker_state(backend: str) -> Tuple[str, int]:
+    """
+    Get the state of an upstream backend's circuit breaker.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps", "massive").
+
+    Returns
+    -------
+    Tuple[str, int]
+        A tuple of (i) the breaker state: "closed" if requests are allowed,
+        "open" if requests fail immediately, or "half-open" if a probe request
+        is allowed, and (ii) the number of consecutive failed requests.
+    """
+    failures, is_open = _read_breaker(backend)
+    if is_open:
+        return "open", failures
+    elif failures >= config.CIRCUIT_BREAKER_THRESHOLD:
+        return "half-open", failures
+    else:
+        return "closed", failures
+
+
+def get_mirror_breaker_states(backend: str) -> Dict[str, Tuple[str, int]]:
+    """
+    Get the state of the circuit breakers of an upstream backend's mirrors.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps").
+
+    Returns
+    -------
+    Dict[str, Tuple[str, int]]
+        The breaker state and number of consecutive failed requests (see
+        `get_breaker_state`) per mirror, or an empty dict if the backend
+        doesn't have multiple mirrors.
+    """
+    mirrors = config.UPSTREAM_MIRRORS.get(backend, [])
+    if len(mirrors) < 2:
+        return {}
+    return {
+        mirror: get_breaker_state(_get_breaker_name(backend, mirror))
+        for mirror in mirrors
+    }
+
+
+def get_latency_percentile(
+    backend: str, percentile: float, endpoint: Optional[str] = None
+) -> Optional[float]:
+    """
+    Get a percentile of an upstream backend's recent request latencies.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps", "massive").
+    percentile : float
+        The percentile (between 0 and 100).
+    endpoint : Optional[str]
+        The backend's endpoint, or None for all requests to the backend.
+
+    Returns
+    -------
+    Optional[float]
+        The latency percentile in seconds, or None if too few requests to the
+        backend were observed (`config.LATENCY_MIN_SAMPLES`).
+    """
+    with _latencies_lock:
+        latencies = list(_latencies[_latency_key(backend, endpoint)])
+    if len(latencies) < config.LATENCY_MIN_SAMPLES:
+        return None
+    return float(np.percentile(latencies, percentile))
+
+
+def get_timeout(
+    backend: str, endpoint: Optional[str] = None
+) -> Tuple[float, float]:
+    """
+    Get the connect and read timeouts for requests to an upstream endpoint.
+
+    The timeouts are the endpoint's recently observed latency percentiles
+    (`config.UPSTREAM_TIMEOUT_PERCENTILES`) times
+    `config.UPSTREAM_TIMEOUT_MULTIPLIER`, bounded by the backend's minimum
+    and maximum timeouts (`config.UPSTREAM_TIMEOUTS`). The maximum timeouts
+    are used until enough requests to the endpoint were observed.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps", "massive").
+    endpoint : Optional[str]
+        The backend's endpoint, or None for all requests to the backend.
+
+    Returns
+    -------
+    Tuple[float, float]
+        The connect and read timeouts in seconds.
+    """
+    bounds = {
+        **config.UPSTREAM_TIMEOUT_DEFAULTS,
+        **config.UPSTREAM_TIMEOUTS.get(backend, {}),
+    }
+    timeouts = []
+    for timeout in ("connect", "read"):
+        min_timeout, max_timeout = bounds[timeout]
+        latency = get_latency_percentile(
+            backend, config.UPSTREAM_TIMEOUT_PERCENTILES[timeout], endpoint
+        )
+        if latency is None:
+            timeouts.append(max_timeout)
+        else:
+            timeouts.append(
+                float(
+                    np.clip(
+                        latency * config.UPSTREAM_TIMEOUT_MULTIPLIER,
+                        min_timeout,
+                        max_timeout,
+                    )
+                )
+            )
+    return timeouts[0], timeouts[1]
+
+
+def get_timeouts(backend: str) -> Dict[str, Tuple[float, float]]:
+    """
+    Get the current connect and read timeouts for requests to an upstream
+    backend.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend (e.g. "gnps", "massive").
+
+    Returns
+    -------
+    Dict[str, Tuple[float, float]]
+        The connect and read timeouts in seconds per endpoint for which
+        requests were observed, and for requests to the backend without an
+        endpoint ("default").
+    """
+    with _latencies_lock:
+        endpoints = [
+            key.split(":", 1)[1]
+            for key in _latencies
+            if key.startswith(f"{backend}:")
+        ]
+    timeouts = {"default": get_timeout(backend)}
+    for endpoint in sorted(endpoints):
+        timeouts[endpoint] = get_timeout(backend, endpoint)
+    return timeouts
+
+
+def get_session(backend: str) -> requests.Session:
+    """
+    Get the keep-alive HTTP session for the given upstream backend.
+
+    Sessions are created lazily and reused by all threads of the current
+    process. After a fork (e.g. a Celery prefork child) new sessions are
+    created, so sockets are never shared between processes.
+
+    Parameters
+    ----------
+    backend : str
+        The upstream backend for which to get the session.
+
+    Returns
+    -------
+    requests.Session
+        The backend's session with a sized connection pool and retries.
+    """
+    global _sessions_pid
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        if backend not in _sessions:
+            _sessions[backend] = _create_session(backend)
+        return _sessions[backend]
+
+
+def _create_session(backend: str) -> requests.Session:
+    pool_settings = {
+        **config.UPSTREAM_POOL_DEFAULTS,
+        **config.UPSTREAM_POOLS.get(backend, {}),
+    }
+    retry = urllib3.util.retry.Retry(
+        total=pool_settings["retries"],
+        connect=pool_settings["retries"],
+        # Read timeouts are not retried to avoid multiplying the timeout.
+        read=0,
+        status=pool_settings["retries"],
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        backoff_factor=pool_settings["backoff_factor"],
+        raise_on_status=False,
+    )
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_settings["pool_connections"],
+        pool_maxsize=pool_settings["pool_maxsize"],
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _get_lease(
+    timeout: Union[None, float, Tuple[float, float]],
+) -> Optional[float]:
+    # Requests take at most their connect and read timeouts, limited to the
+    # deadline.
+    timeout = deadlines.limit_timeout(timeout)
+    if isinstance(timeout, tuple):
+        return sum(t for t in timeout if t is not None)
+    return timeout
+
+
+def _release_on_close(
+    response: requests.Response, stack: contextlib.ExitStack
+) -> None:
+    # Release the concurrency slot once the response body has been read and
+    # the response is closed, instead of when the headers arrive.
+    close = response.close
+
+    def close_and_release() -> None:
+        try:
+            close()
+        finally:
+            stack.close()
+
+    response.close = close_and_release
+
+
+def _get_breaker_name(backend: str, url: str) -> str:
+    # Mirrors have their own circuit breaker, so that a failing mirror
+    # doesn't block the other mirrors.
+    if len(config.UPSTREAM_MIRRORS.get(backend, [])) < 2:
+        return backend
+    return f"{backend}@{urllib.parse.urlsplit(url).netloc}"
+
+
+def _get_mirror_endpoint(endpoint: Optional[str], mirror: str) -> str:
+    return f"{endpoint or ''}@{urllib.parse.urlsplit(mirror).netloc}"
+
+
+def _rank_mirrors(backend: str, endpoint: Optional[str]) -> List[str]:
+    # Healthy mirrors first, then by increasing median latency. Mirrors with
+    # too few observed requests are tried first, and ties keep the configured
+    # order.
+    states = {"closed": 0, "half-open": 1, "open": 2}
+    mirrors = config.UPSTREAM_MIRRORS[backend]
+    if len(mirrors) < 2:
+        return mirrors
+    scores = {}
+    for mirror in mirrors:
+        state, _ = get_breaker_state(_get_breaker_name(backend, mirror))
+        latency = get_latency_percentile(
+            backend, 50, _get_mirror_endpoint(endpoint, mirror)
+        )
+        scores[mirror] = states[state], latency or 0.0
+    return sorted(mirrors, key=scores.get)
+
+
+def _latency_key(backend: str, endpoint: Optional[str]) -> str:
+    return backend if endpoint is None else f"{backend}:{endpoint}"
+
+
+def _record_latency(
+    backend: str, endpoint: Optional[str], latency: float
+) -> None:
+    with _latencies_lock:
+        _latencies[backend].append(latency)
+        if endpoint is not None:
+            _latencies[_latency_key(backend, endpoint)].append(latency)
+
+
+def _get_hedge_delay(backend: str, endpoint: Optional[str]) -> Optional[float]:
+    budget = config.HEDGE_BUDGET.get(backend)
+    if budget is None:
+        return None
+    # Each request earns a fraction of a hedge.
+    with _hedge_tokens_lock:
+        _hedge_tokens[backend] = min(
+            _hedge_tokens[backend] + budget, config.HEDGE_MAX_TOKENS
+        )
+    return get_latency_percentile(backend, config.HEDGE_PERCENTILE, endpoint)
+
+
+def _take_hedge_token(backend: str) -> bool:
+    with _hedge_tokens_lock:
+        if _hedge_tokens[backend] < 1:
+            return False
+        _hedge_tokens[backend] -= 1
+        return True
+
+
+def _close_response(attempt: concurrent.futures.Future) -> None:
+    if attempt.exception() is None:
+        attempt.result().close()
+
+
+def _breaker_keys(backend: str) -> Tuple[str, str, str]:
+    return (
+        f"circuit:{backend}:failures",
+        f"circuit:{backend}:open",
+        f"circuit:{backend}:probe",
+    )
+
+
+def _check_breaker(backend: str) -> int:
+    # Returns the number of consecutive failures if a request is allowed.
+    state, failures = get_breaker_state(backend)
+    if state == "closed" or (state == "half-open" and _acquire_probe(backend)):
+        return failures
+    raise UsiUnavailableError(
+        f"The {backend} resource is temporarily unavailable, please try "
+        f"again later",
+        503,
+    )
+
+
+def _read_breaker(backend: str) -> Tuple[int, bool]:
+    failures_key, open_key, _ = _breaker_keys(backend)
+    client = caching.get_redis()
+    if client is not None:
+        try:
+            failures, is_open = client.mget(failures_key, open_key)
+            return int(failures or 0), is_open is not None
+        except redis.exceptions.RedisError:
+            caching.redis_unavailable()
+    with _breakers_lock:
+        breaker = _breakers[backend]
+        return int(breaker["failures"]), breaker["open_until"] > time.time()
+
+
+def _acquire_probe(backend: str) -> bool:
+    _, _, probe_key = _breaker_keys(backend)
+    client = caching.get_redis()
+    if client is not None:
+        try:
+            return bool(
+                client.set(
+                    probe_key,
+                    1,
+                    nx=True,
+                    ex=config.CIRCUIT_BREAKER_PROBE_TIMEOUT,
+                )
+            )
+        except redis.exceptions.RedisError:
+            caching.redis_unavailable()
+    with _breakers_lock:
+        breaker = _breakers[backend]
+        if breaker["probe_until"] > time.time():
+            return False
+        breaker["probe_until"] = (
+            time.time() + config.CIRCUIT_BREAKER_PROBE_TIMEOUT
+        )
+        return True
+
+
+def _record_failure(backend: str) -> None:
+    failures_key, open_key, probe_key = _breaker_keys(backend)
+    client = caching.get_redis()
+    if client is not None:
+        try:
+            failures = client.incr(failures_key)
+            if failures >= config.CIRCUIT_BREAKER_THRESHOLD:
+                pipeline = client.pipeline()
+                pipeline.set(
+                    open_key, 1, ex=config.CIRCUIT_BREAKER_RESET_TIMEOUT
+                )
+                pipeline.delete(probe_key)
+                pipeline.execute()
+        except redis.exceptions.RedisError:
+            caching.redis_unavailable()
+        else:
+            if failures == config.CIRCUIT_BREAKER_THRESHOLD:
+                logger.warning("Circuit breaker for %s opened", backend)
+            return
+    with _breakers_lock:
+        breaker = _breakers[backend]
+        breaker["failures"] += 1
+        if breaker["failures"] >= config.CIRCUIT_BREAKER_THRESHOLD:
+            breaker["open_until"] = (
+                time.time() + config.CIRCUIT_BREAKER_RESET_TIMEOUT
+            )
+            breaker["probe_until"] = 0.0
+        if breaker["failures"] == config.CIRCUIT_BREAKER_THRESHOLD:
+            logger.warning("Circuit breaker for %s opened", backend)
+
+
+def _record_success(backend: str) -> None:
+    failures_key, open_key, probe_key = _breaker_keys(backend)
+    client = caching.get_redis()
+    if client is not None:
+        try:
+            client.delete(failures_key, open_key, probe_key)
+            return
+        except redis.exceptions.RedisError:
+            caching.redis_unavailable()
+    with _breakers_lock:
+        breaker = _breakers[backend]
+        breaker["failures"] = 0
+        breaker["open_until"] = breaker["probe_until"] = 0.0
@@ -2,6 +2,7 @@ import copy
 import csv
 import io
 import json
+import time
 import urllib.parse
 from typing import Any, Dict, List, Optional, Tuple, Union
 
@@ -10,7 +11,14 @@ import numpy as np
 import qrcode
 from spectrum_utils import spectrum as sus
 
-from metabolomics_spectrum_resolver import similarity, tasks
+from metabolomics_spectrum_resolver import (
+    config,
+    deadlines,
+    similarity,
+    splashing,
+    tasks,
+    upstream,
+)
 from metabolomics_spectrum_resolver.error import UsiError
 
 
@@ -35,6 +43,20 @@ default_drawing_controls = {
 blueprint = flask.Blueprint("ui", __name__)
 
 
+@blueprint.before_app_request
+def start_deadline():
+    # Batch requests stream their results for as long as the lookups take.
+    if flask.request.endpoint != "ui.peak_json_batch":
+        flask.g.deadline = deadlines.push(time.time() + config.REQUEST_TIMEOUT)
+
+
+@blueprint.teardown_app_request
+def end_deadline(_):
+    token = flask.g.pop("deadline", None)
+    if token is not None:
+        deadlines.pop(token)
+
+
 @blueprint.route("/", methods=["GET"])
 def render_homepage():
     return flask.render_template("homepage.html")
@@ -55,6 +77,34 @@ def render_heartbeat():
     return json.dumps({"status": "success"})
 
 
+@blueprint.route("/status/upstream", methods=["GET"])
+def render_upstream_status():
+    """
+    Report the circuit breaker state and the current request timeouts of each
+    upstream backend, and the circuit breaker state of their mirrors.
+    """
+    status = {}
+    for backend in config.UPSTREAM_POOLS:
+        state, failures = upstream.get_breaker_state(backend)
+        status[backend] = {
+            "state": state,
+            "failures": failures,
+            "timeouts": {
+                endpoint: {"connect": connect, "read": read}
+                for endpoint, (connect, read) in upstream.get_timeouts(
+                    backend
+                ).items()
+            },
+        }
+        mirrors = upstream.get_mirror_breaker_states(backend)
+        if mirrors:
+            status[backend]["mirrors"] = {
+                mirror: {"state": state, "failures": failures}
+                for mirror, (state, failures) in mirrors.items()
+            }
+    return flask.jsonify(status)
+
+
 # Forward the old "/spectrum/" endpoint to the new Dash interface.
 @blueprint.route("/spectrum/", methods=["GET"])
 def spectrum_forward():
@@ -88,7 +138,9 @@ def generate_png():
     # noinspection PyTypeChecker
     spectrum = prepare_spectrum(
         tasks.parse_usi_or_spectrum(
-            drawing_controls.get("usi1"), spectrum_peaks_json
+            drawing_controls.get("usi1"),
+            spectrum_peaks_json,
+            drawing_controls["centroid"],
         )[0],
         **drawing_controls,
     )
@@ -110,10 +162,14 @@ def generate_mirror_png():
     # noinspection PyTypeChecker
     spectrum1, spectrum2 = _prepare_mirror_spectra(
         tasks.parse_usi_or_spectrum(
-            drawing_controls.get("usi1"), spectrum1_peaks_json
+            drawing_controls.get("usi1"),
+            spectrum1_peaks_json,
+            drawing_controls["centroid"],
         )[0],
         tasks.parse_usi_or_spectrum(
-            drawing_controls.get("usi2"), spectrum2_peaks_json
+            drawing_controls.get("usi2"),
+            spectrum2_peaks_json,
+            drawing_controls["centroid"],
         )[0],
         **drawing_controls,
     )
@@ -138,7 +194,9 @@ def generate_svg():
     # noinspection PyTypeChecker
     spectrum = prepare_spectrum(
         tasks.parse_usi_or_spectrum(
-            drawing_controls.get("usi1"), spectrum_peaks_json
+            drawing_controls.get("usi1"),
+            spectrum_peaks_json,
+            drawing_controls["centroid"],
         )[0],
         **drawing_controls,
     )
@@ -160,10 +218,14 @@ def generate_mirror_svg():
     # noinspection PyTypeChecker
     spectrum1, spectrum2 = _prepare_mirror_spectra(
         tasks.parse_usi_or_spectrum(
-            drawing_controls.get("usi1"), spectrum1_peaks_json
+            drawing_controls.get("usi1"),
+            spectrum1_peaks_json,
+            drawing_controls["centroid"],
         )[0],
         tasks.parse_usi_or_spectrum(
-            drawing_controls.get("usi2"), spectrum2_peaks_json
+            drawing_controls.get("usi2"),
+            spectrum2_peaks_json,
+            drawing_controls["centroid"],
         )[0],
         **drawing_controls,
     )
@@ -186,8 +248,9 @@ def get_drawing_controls(
     annotation_rotation: int = default_drawing_controls["annotation_rotation"],
     cosine: str = default_drawing_controls["cosine"],
     fragment_mz_tolerance: Optional[float] = None,
-    grid: bool = default_drawing_controls["grid"],
+    grid: Union[bool, str] = default_drawing_controls["grid"],
     annotate_peaks: List[Union[bool, List[float]]] = None,
+    centroid: Union[bool, str] = False,
     mirror: Optional[bool] = False,
 ) -> Dict[str, Any]:
     """
@@ -218,10 +281,12 @@ def get_drawing_controls(
         The type of cosine score.
     fragment_mz_tolerance : float
         The fragment m/z tolerance.
-    grid : bool
+    grid : Union[bool, str]
         Whether to display the grid.
     annotate_peaks: List[Union[bool, List[float]]] = None
         M/z values of the peaks in both spectra that should be labeled.
+    centroid : Union[bool, str]
+        Whether to centroid profile-mode spectra.
     mirror : bool
         Flag indicating whether this is a mirror spectrum or not.
 
@@ -292,13 +357,14 @@ def get_drawing_controls(
         drawing_controls["fragment_mz_tolerance"] = default_drawing_controls[
             "fragment_mz_tolerance"
         ]
-    drawing_controls["grid"] = grid == "True"
+    drawing_controls["grid"] = _is_true(grid)
     # Make sure that `annotate_peaks` is no longer a JSON encoded string.
     drawing_controls["annotate_peaks"] = (
         json.loads(annotate_peaks)
         if isinstance(annotate_peaks, str)
         else annotate_peaks
     )
+    drawing_controls["centroid"] = _is_true(centroid)
     if drawing_controls["max_intensity"] is None:
         if annotate_peaks is not None and any(annotate_peaks):
             # Labeled (because peak annotations are provided) standard or
@@ -319,6 +385,11 @@ def get_drawing_controls(
     return drawing_controls
 
 
+def _is_true(value: Union[None, bool, str]) -> bool:
+    # Boolean request parameters, e.g. "grid=true" or "centroid=True".
+    return str(value).lower() == "true"
+
+
 def prepare_spectrum(
     spectrum: sus.MsmsSpectrum, **kwargs: Any
 ) -> sus.MsmsSpectrum:
@@ -473,20 +544,11 @@ def _prepare_mirror_spectra(
 @blueprint.route("/json/")
 def peak_json():
     try:
-        spectrum, _, splash_key = tasks.parse_usi(
-            flask.request.args.get("usi1")
+        spectrum, _ = tasks.parse_usi(
+            flask.request.args.get("usi1"),
+            centroid=_is_true(flask.request.args.get("centroid")),
         )
-        result_dict = {
-            "peaks": list(
-                zip(
-                    spectrum.mz.astype(float), spectrum.intensity.astype(float)
-                )
-            ),
-            "n_peaks": len(spectrum.mz),
-            "precursor_mz": float(spectrum.precursor_mz),
-            "precursor_charge": int(spectrum.precursor_charge),
-            "splash": splash_key,
-        }
+        result_dict = _get_peak_dict(spectrum)
         status = 200
     except UsiError as e:
         result_dict = {"error": {"code": e.error_code, "message": str(e)}}
@@ -497,17 +559,124 @@ def peak_json():
     return flask.jsonify(result_dict), status
 
 
+@blueprint.route("/json/batch/", methods=["POST"])
+def peak_json_batch():
+    """
+    Resolve a batch of USIs and stream their peaks as newline-delimited JSON.
+
+    The USIs are given in the POST body as a JSON list (or a JSON object with
+    a "usis" list), or as plain text with one USI per line. One JSON line per
+    USI is streamed in completion order, with the same content as the
+    "/json/" endpoint and an additional "usi" field.
+    """
+    try:
+        usis = _get_batch_usis(flask.request)
+    except UsiError as e:
+        result_dict = {"error": {"code": e.error_code, "message": str(e)}}
+        return flask.jsonify(result_dict), e.error_code
+
+    centroid = _is_true(flask.request.args.get("centroid"))
+
+    def generate_peak_json_lines():
+        for usi, result in tasks.parse_usis(usis, centroid):
+            if isinstance(result, UsiError):
+                result_dict = {
+                    "error": {
+                        "code": result.error_code,
+                        "message": str(result),
+                    }
+                }
+            elif isinstance(result, ValueError):
+                result_dict = {"error": {"code": 404, "message": str(result)}}
+            elif isinstance(result, Exception):
+                result_dict = {"error": {"code": 500, "message": str(result)}}
+            else:
+                spectrum, _ = result
+                result_dict = _get_peak_dict(spectrum)
+            yield json.dumps({"usi": usi, **result_dict}) + "\n"
+
+    return flask.Response(
+        flask.stream_with_context(generate_peak_json_lines()),
+        mimetype="application/x-ndjson",
+    )
+
+
+def _get_batch_usis(request: flask.Request) -> List[str]:
+    """
+    Get the USIs from the body of a batch request.
+
+    Parameters
+    ----------
+    request : flask.Request
+        The batch request.
+
+    Returns
+    -------
+    List[str]
+        The requested USIs.
+
+    Raises
+    ------
+    UsiError
+        If the request body is incorrectly formatted or contains too many
+        USIs.
+    """
+    if request.is_json:
+        usis = request.get_json(silent=True)
+        if isinstance(usis, dict):
+            usis = usis.get("usis")
+        if not isinstance(usis, list) or not all(
+            isinstance(usi, str) for usi in usis
+        ):
+            raise UsiError("Batch request should contain a list of USIs", 400)
+    else:
+        usis = request.get_data(as_text=True).splitlines()
+    usis = [usi.strip() for usi in usis if usi.strip()]
+    if len(usis) > config.BATCH_MAX_USIS:
+        raise UsiError(
+            f"Batch request contains more than {config.BATCH_MAX_USIS} USIs",
+            400,
+        )
+    return usis
+
+
+def _get_peak_dict(spectrum: sus.MsmsSpectrum) -> Dict[str, Any]:
+    """
+    Get the JSON representation of a spectrum's peaks.
+
+    Parameters
+    ----------
+    spectrum : sus.MsmsSpectrum
+        The spectrum.
+
+    Returns
+    -------
+    Dict[str, Any]
+        A dictionary with the spectrum's peaks, precursor information, and
+        SPLASH.
+    """
+    return {
+        "peaks": list(
+            zip(spectrum.mz.astype(float), spectrum.intensity.astype(float))
+        ),
+        "n_peaks": len(spectrum.mz),
+        "precursor_mz": float(spectrum.precursor_mz),
+        "precursor_charge": int(spectrum.precursor_charge),
+        "splash": splashing.get_spectrum_splash(spectrum),
+    }
+
+
 @blueprint.route("/json/mirror/")
 def mirror_json():
     try:
         drawing_controls = get_drawing_controls(
             **flask.request.args.to_dict(), mirror=True
         )
-        spectrum1, source1, splash_key1 = tasks.parse_usi(
-            drawing_controls["usi1"]
+        spectrum1, _ = tasks.parse_usi(
+            drawing_controls["usi1"], centroid=drawing_controls["centroid"]
         )
-        spectrum2, source2, splash_key2 = tasks.parse_usi(
-            drawing_controls["usi2"]
+        spectrum2, _ = tasks.parse_usi(
+            drawing_controls["usi2"], centroid=drawing_controls["centroid"]
         )
         _spectrum1, _spectrum2 = _prepare_mirror_spectra(
             spectrum1, spectrum2, **drawing_controls
@@ -518,33 +687,9 @@ def mirror_json():
             drawing_controls["fragment_mz_tolerance"],
             drawing_controls["cosine"] == "shifted",
         )
-        spectrum1_dict = {
-            "peaks": list(
-                zip(
-                    spectrum1.mz.astype(float),
-                    spectrum1.intensity.astype(float),
-                )
-            ),
-            "n_peaks": len(spectrum1.mz),
-            "precursor_mz": float(spectrum1.precursor_mz),
-            "precursor_charge": int(spectrum1.precursor_charge),
-            "splash": splash_key1,
-        }
-        spectrum2_dict = {
-            "peaks": list(
-                zip(
-                    spectrum2.mz.astype(float),
-                    spectrum2.intensity.astype(float),
-                )
-            ),
-            "n_peaks": len(spectrum2.mz),
-            "precursor_mz": float(spectrum2.precursor_mz),
-            "precursor_charge": int(spectrum2.precursor_charge),
-            "splash": splash_key2,
-        }
         result_dict = {
-            "spectrum1": spectrum1_dict,
-            "spectrum2": spectrum2_dict,
+            "spectrum1": _get_peak_dict(spectrum1),
+            "spectrum2": _get_peak_dict(spectrum2),
             "cosine": score,
             "n_peak_matches": len(peak_matches),
             "peak_matches": peak_matches,
@@ -563,7 +708,9 @@ def mirror_json():
 def peak_proxi_json():
     try:
         usi = flask.request.args.get("usi")
-        spectrum, _, splash_key = tasks.parse_usi(usi)
+        spectrum, _ = tasks.parse_usi(
+            usi, centroid=_is_true(flask.request.args.get("centroid"))
+        )
         result_dict = {
             "usi": usi,
             "status": "READABLE",
@@ -580,16 +727,13 @@ def peak_proxi_json():
                     "name": "charge state",
                     "value": str(spectrum.precursor_charge),
                 },
-            ],
-        }
-        if splash_key is not None:
-            result_dict["attributes"].append(
                 {
                     "accession": "MS:1002599",
                     "name": "splash key",
-                    "value": splash_key,
-                }
-            )
+                    "value": splashing.get_spectrum_splash(spectrum),
+                },
+            ],
+        }
     except UsiError as e:
         result_dict = {"error": {"code": e.error_code, "message": str(e)}}
     except ValueError as e:
@@ -599,7 +743,10 @@ def peak_proxi_json():
 
 @blueprint.route("/csv/")
 def peak_csv():
-    spectrum, _, _ = tasks.parse_usi(flask.request.args.get("usi1"))
+    spectrum, _ = tasks.parse_usi(
+        flask.request.args.get("usi1"),
+        centroid=_is_true(flask.request.args.get("centroid")),
+    )
     with io.StringIO() as csv_str:
         writer = csv.writer(csv_str)
         writer.writerow(["mz", "intensity"])
@@ -628,7 +775,7 @@ def generate_qr():
 
 @blueprint.errorhandler(Exception)
 def render_error(error):
-    if type(error) == UsiError:
+    if isinstance(error, UsiError):
         error_code = error.error_code
     else:
         error_code = 500
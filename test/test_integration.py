@@ -8,6 +8,7 @@ import unittest.mock
 
 import flask
 import flex
+import numpy as np
 import PIL
 import pytest
 import requests
@@ -15,7 +16,13 @@ import spectrum_utils.spectrum as sus
 import urllib.parse
 from pyzbar import pyzbar
 
-from metabolomics_spectrum_resolver import app
+from metabolomics_spectrum_resolver import (
+    app,
+    centroiding,
+    config,
+    deadlines,
+    upstream,
+)
 from metabolomics_spectrum_resolver.error import UsiError
 
 from usi_test_data import usis_to_test
@@ -87,6 +94,44 @@ def test_render_heartbeat(client):
     assert json.loads(response.data) == {"status": "success"}
 
 
+def test_render_upstream_status(client):
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.get_breaker_state",
+        side_effect=lambda backend: (
+            ("open", 5) if backend == "gnps" else ("closed", 0)
+        ),
+    ), unittest.mock.patch.dict(upstream._latencies, clear=True):
+        response = client.get("/status/upstream")
+    assert response.status_code == 200
+    status = json.loads(response.data)
+    assert status["gnps"]["state"] == "open"
+    assert status["gnps"]["failures"] == 5
+    assert status["massbank"]["state"] == "closed"
+    assert status["massbank"]["failures"] == 0
+    assert status["massbank"]["timeouts"]["default"] == {
+        "connect": config.UPSTREAM_TIMEOUT_DEFAULTS["connect"][1],
+        "read": config.UPSTREAM_TIMEOUTS["massbank"]["read"][1],
+    }
+
+
+def test_request_deadline(client):
+    remaining = []
+
+    def parse_usi(usi, centroid=False):
+        remaining.append(deadlines.remaining())
+        raise deadlines.exceeded()
+
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks.parse_usi",
+        side_effect=parse_usi,
+    ):
+        response = client.get(
+            "/json/", query_string="usi1=mzspec:MASSBANK::accession:SM858102"
+        )
+    assert response.status_code == 504
+    assert 0 < remaining[0] <= config.REQUEST_TIMEOUT
+
+
 def test_render_spectrum(client):
     for usi in usis_to_test:
         response = client.get(
@@ -255,6 +300,62 @@ def test_peak_json(client):
         )
 
 
+def test_peak_json_centroid(client):
+    mz = np.arange(100.0, 100.1, 0.01)
+    intensity = 100 - 1000 * (mz - 100.05) ** 2
+    usi = "mzspec:MASSBANK::accession:SM858102"
+
+    def parse_usi(usi, centroid=False):
+        spectrum = sus.MsmsSpectrum(usi, 0, 0, mz, intensity)
+        if centroid:
+            spectrum = centroiding.centroid_spectrum(spectrum)
+        return spectrum, ""
+
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks.parse_usi",
+        side_effect=parse_usi,
+    ) as mock_parse_usi:
+        for centroid, n_peaks in [("false", len(mz)), ("true", 1)]:
+            response = client.get(
+                "/json/", query_string=f"usi1={usi}&centroid={centroid}"
+            )
+            assert response.status_code == 200
+            assert json.loads(response.data)["n_peaks"] == n_peaks
+        assert mock_parse_usi.call_args.kwargs == {"centroid": True}
+
+
+def test_peak_json_batch(client):
+    invalid_usis = [
+        usi for usi, _ in _get_invalid_usi_status_code() if usi is not None
+    ]
+    response = client.post("/json/batch/", json=usis_to_test + invalid_usis)
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    response_dicts = {}
+    for line in response.data.decode().splitlines():
+        response_dict = json.loads(line)
+        response_dicts[response_dict["usi"]] = response_dict
+    assert response_dicts.keys() == set(usis_to_test + invalid_usis)
+    for usi in usis_to_test:
+        response_dict = response_dicts[usi]
+        assert response_dict["n_peaks"] == len(response_dict["peaks"])
+        assert "precursor_mz" in response_dict
+        assert "splash" in response_dict
+    for usi, status_code in _get_invalid_usi_status_code():
+        if usi is not None:
+            assert response_dicts[usi]["error"]["code"] == status_code, usi
+    # Plain text body with one USI per line.
+    response = client.post("/json/batch/", data="\n".join(usis_to_test[:2]))
+    assert response.status_code == 200
+    assert len(response.data.decode().splitlines()) == 2
+
+
+def test_peak_json_batch_invalid(client):
+    response = client.post("/json/batch/", json={"usis": "not_a_list"})
+    assert response.status_code == 400
+    assert json.loads(response.data)["error"]["code"] == 400
+
+
 def test_peak_json_invalid(client):
     for usi, status_code in _get_invalid_usi_status_code():
         if usi is not None:
@@ -1,15 +1,42 @@
+import base64
+import concurrent.futures
 import functools
+import io
 import json
+import os
+import time
 import unittest.mock
+import zlib
 
+import joblib
 import numpy as np
 import pytest
+import redis
 import requests
+import splash
 from spectrum_utils import spectrum as sus
 
-from metabolomics_spectrum_resolver import parsing, similarity, views
+from metabolomics_spectrum_resolver import (
+    caching,
+    centroiding,
+    datasets,
+    deadlines,
+    decoding,
+    ingest,
+    limits,
+    ms2lda,
+    parsing,
+    similarity,
+    splashing,
+    store,
+    tasks,
+    taskfiles,
+    upstream,
+    views,
+)
 from metabolomics_spectrum_resolver.error import UsiError
 
+from peak_test_data import peaks_to_test
 from usi_test_data import usis_to_test
 
 
@@ -36,13 +63,17 @@ def _get_splash_remote(spectrum):
 
 def test_parse_usi():
     for usi in usis_to_test:
-        spectrum, _, splash_key = parsing.parse_usi(usi)
-        assert splash_key == _get_splash_remote(spectrum)
+        spectrum, _ = parsing.parse_usi(usi)
+        assert splashing.get_spectrum_splash(
+            spectrum
+        ) == _get_splash_remote(spectrum)
     # Legacy USIs should also support the "mzdraft" prefix.
     for usi in usis_to_test[-6:]:
-        spectrum, _, splash_key = parsing.parse_usi(
+        spectrum, _ = parsing.parse_usi(
             usi.replace('mzspec', 'mzdraft'))
-        assert splash_key == _get_splash_remote(spectrum)
+        assert splashing.get_spectrum_splash(
+            spectrum
+        ) == _get_splash_remote(spectrum)
 
 
 def test_parse_usi_invalid():
@@ -81,13 +112,774 @@ def test_parse_usi_invalid():
     assert exc_info.value.error_code == 400
 
 
+def test_parse_usi_components():
+    assert parsing.parse_usi_components(
+        "mzspec:PXD000561:Adult_Frontalcortex_bRP_Elite_85_f09:scan:17555:"
+        "VLHPLEGAVVIIFK/2"
+    ) == (
+        "PXD000561",
+        "Adult_Frontalcortex_bRP_Elite_85_f09",
+        "scan",
+        "17555",
+        "VLHPLEGAVVIIFK/2",
+    )
+    assert parsing.parse_usi_components(
+        "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00005436077"
+    ) == ("GNPS", "GNPS-LIBRARY", "accession", "CCMSLIB00005436077", None)
+    # Legacy USIs.
+    assert parsing.parse_usi_components(
+        "mzspec:GNPSTASK-c95481f0c53d42e78a61bf899e9f9adb:"
+        "spectra/specs_ms.mgf:scan:1943"
+    ) == (
+        "GNPS",
+        "TASK-c95481f0c53d42e78a61bf899e9f9adb-spectra/specs_ms.mgf",
+        "scan",
+        "1943",
+        None,
+    )
+    assert parsing.parse_usi_components(
+        "mzdraft:MS2LDATASK-190:document:270684"
+    ) == ("MS2LDA", "TASK-190", "accession", "270684", None)
+    # Parsed USIs are memoized.
+    parsing.parse_usi_components.cache_clear()
+    for _ in range(3):
+        parsing.parse_usi_components("mzspec:MASSBANK:SM858102")
+    assert parsing.parse_usi_components.cache_info().hits == 2
+    with pytest.raises(UsiError) as exc_info:
+        parsing.parse_usi_components("mzspec:GNPSTASK-666:file:scan:1")
+    assert exc_info.value.error_code == 400
+
+
+def test_parse_usi_prevalidated():
+    # Invalid USIs are rejected before they're queued.
+    with unittest.mock.patch.object(
+        tasks._task_parse_usi, "apply_async"
+    ) as mock_apply_async:
+        with pytest.raises(UsiError) as exc_info:
+            tasks.parse_usi("mzspec:RANDOM666:file:scan:1")
+        assert exc_info.value.error_code == 400
+        mock_apply_async.assert_not_called()
+
+
+def test_singleflight():
+    calls = []
+
+    def slow_square(x):
+        calls.append(x)
+        time.sleep(0.2)
+        if x < 0:
+            raise ValueError("Negative value")
+        return [x * x]
+
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        futures = [
+            pool.submit(caching.singleflight, "square", slow_square, 3)
+            for _ in range(4)
+        ]
+        results = [future.result() for future in futures]
+        assert results == [[9]] * 4
+        assert len(calls) == 1
+        # Exceptions are shared as well.
+        futures = [
+            pool.submit(caching.singleflight, "negative", slow_square, -3)
+            for _ in range(4)
+        ]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+        assert len(calls) == 2
+    # Calls after completion are recomputed.
+    assert caching.singleflight("square", slow_square, 3) == [9]
+    assert len(calls) == 3
+    assert caching._flights == {}
+
+
+def test_generate_figure_singleflight():
+    spectrum = sus.MsmsSpectrum(
+        "test", 500.0, 2, np.array([100.0, 200.0]), np.array([1.0, 2.0])
+    )
+
+    def generate_figure(spectrum, extension, **kwargs):
+        time.sleep(0.2)
+        return io.BytesIO(b"figure")
+
+    with unittest.mock.patch.object(
+        tasks._task_generate_figure,
+        "apply_async",
+        side_effect=redis.exceptions.ConnectionError,
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.drawing.generate_figure",
+        side_effect=generate_figure,
+    ) as mock_generate_figure:
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            futures = [
+                pool.submit(tasks.generate_figure, spectrum, "png", width=10)
+                for _ in range(3)
+            ] + [pool.submit(tasks.generate_figure, spectrum, "svg")]
+            bufs = [future.result() for future in futures]
+        assert mock_generate_figure.call_count == 2
+        # Each caller gets its own buffer.
+        assert len({id(buf) for buf in bufs}) == 4
+        for buf in bufs:
+            assert buf.read() == b"figure"
+
+
+def _square(x):
+    _square.calls += 1
+    return x * x
+
+
+def test_cache_revalidated(tmp_path):
+    cached_square = joblib.Memory(str(tmp_path), verbose=0).cache(
+        caching.timestamped
+    )
+    _square.calls = 0
+    caching._refreshes.clear()
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.upstream.executor"
+    ) as mock_executor, unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.time.time",
+        return_value=1000.0,
+    ) as mock_time:
+        # Refresh synchronously.
+        mock_executor.return_value.submit.side_effect = (
+            lambda func, *args, **kwargs: func(*args, **kwargs)
+        )
+        for _ in range(2):
+            assert caching.get_revalidated(cached_square, "3", _square, 3) == 9
+        assert _square.calls == 1
+        # Stale results are served and refreshed once.
+        mock_time.return_value += caching.config.CACHE_SOFT_TTL + 1
+        for _ in range(2):
+            assert caching.get_revalidated(cached_square, "3", _square, 3) == 9
+        assert _square.calls == 2
+        assert cached_square(_square, 3)[0] == mock_time.return_value
+        # Slow computations are refreshed early.
+        mock_cached_func = unittest.mock.Mock(
+            return_value=(mock_time.return_value, 10.0, 9)
+        )
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.caching.random.expovariate",
+            return_value=caching.config.CACHE_SOFT_TTL,
+        ):
+            result = caching.get_revalidated(
+                mock_cached_func, "slow", 3, refresh=True
+            )
+        assert result == 9
+        mock_cached_func.assert_called_once_with(3)
+        mock_cached_func.call.assert_called_once_with(3, refresh=True)
+        # Fast computations are refreshed early relative to the soft TTL.
+        mock_cached_func = unittest.mock.Mock(
+            return_value=(mock_time.return_value, 0.0, 9)
+        )
+        for jitter, refreshed in ((1.0, False), (20.0, True)):
+            with unittest.mock.patch(
+                "metabolomics_spectrum_resolver.caching.random.expovariate",
+                return_value=jitter,
+            ), unittest.mock.patch(
+                "metabolomics_spectrum_resolver.config.CACHE_SOFT_TTL_JITTER",
+                0.05,
+            ):
+                caching.get_revalidated(mock_cached_func, "fast", 3)
+            assert mock_cached_func.call.called == refreshed
+    caching._refreshes.clear()
+
+
+def test_parse_usi_negative_cache():
+    task = "c95481f0c53d42e78a61bf899e9f9adb"
+    usi = f"mzspec:GNPS:TASK-{task}-spectra/specs_ms.mgf:scan:1"
+    legacy_usi = f"mzspec:GNPSTASK-{task}:spectra/specs_ms.mgf:scan:1"
+    assert parsing.canonicalize_usi(usi) == parsing.canonicalize_usi(
+        legacy_usi
+    )
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch.object(
+        tasks._task_parse_usi,
+        "apply_async",
+        side_effect=redis.exceptions.ConnectionError,
+    ) as mock_apply_async, unittest.mock.patch(
+        "metabolomics_spectrum_resolver.parsing.parse_usi",
+        side_effect=UsiError("Spectrum not found", 404),
+    ) as mock_parse_usi, unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.time.time",
+        return_value=1000.0,
+    ) as mock_time:
+        caching._negative_cache.clear()
+        # Failures are remembered per canonical USI.
+        for failing_usi in (usi, usi, legacy_usi):
+            with pytest.raises(UsiError) as exc_info:
+                tasks.parse_usi(failing_usi)
+            assert exc_info.value.error_code == 404
+            assert exc_info.value.message == "Spectrum not found"
+        assert mock_apply_async.call_count == 1
+        assert mock_parse_usi.call_count == 1
+        # Failures are retried after their TTL.
+        mock_time.return_value += caching.config.NEGATIVE_CACHE_TTL[404] + 1
+        with pytest.raises(UsiError):
+            tasks.parse_usi(usi)
+        assert mock_parse_usi.call_count == 2
+        # Unexpected errors are not remembered.
+        mock_parse_usi.side_effect = UsiError("Internal error", 500)
+        usi = f"mzspec:GNPS:TASK-{task}-spectra/specs_ms.mgf:scan:2"
+        for _ in range(2):
+            with pytest.raises(UsiError):
+                tasks.parse_usi(usi)
+        assert mock_parse_usi.call_count == 4
+        # Neither is locally shed load.
+        mock_parse_usi.side_effect = limits._busy("gnps")
+        usi = f"mzspec:GNPS:TASK-{task}-spectra/specs_ms.mgf:scan:3"
+        for _ in range(2):
+            with pytest.raises(UsiError) as exc_info:
+                tasks.parse_usi(usi)
+            assert exc_info.value.error_code == 503
+        assert mock_parse_usi.call_count == 6
+        caching._negative_cache.clear()
+
+
+def test_upstream_circuit_breaker():
+    upstream._breakers.clear()
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=requests.exceptions.ConnectTimeout,
+    ) as mock_get, unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.time.time",
+        return_value=1000.0,
+    ) as mock_time:
+        for _ in range(upstream.config.CIRCUIT_BREAKER_THRESHOLD):
+            with pytest.raises(requests.exceptions.ConnectTimeout):
+                upstream.get("gnps", "https://gnps.ucsd.edu/")
+        assert upstream.get_breaker_state("gnps") == (
+            "open",
+            upstream.config.CIRCUIT_BREAKER_THRESHOLD,
+        )
+        # Requests fail immediately while the breaker is open.
+        with pytest.raises(UsiError) as exc_info:
+            upstream.get("gnps", "https://gnps.ucsd.edu/")
+        assert exc_info.value.error_code == 503
+        assert (
+            mock_get.call_count == upstream.config.CIRCUIT_BREAKER_THRESHOLD
+        )
+        # Other backends are unaffected.
+        mock_get.side_effect = None
+        mock_get.return_value.status_code = 200
+        upstream.get("massbank", "https://massbank.eu/")
+        assert upstream.get_breaker_state("massbank") == ("closed", 0)
+        # A single probe request is allowed after the reset timeout.
+        mock_time.return_value += (
+            upstream.config.CIRCUIT_BREAKER_RESET_TIMEOUT + 1
+        )
+        assert upstream.get_breaker_state("gnps")[0] == "half-open"
+        assert upstream._acquire_probe("gnps")
+        with pytest.raises(UsiError):
+            upstream.get("gnps", "https://gnps.ucsd.edu/")
+        # The breaker closes if the probe succeeds.
+        upstream._breakers["gnps"]["probe_until"] = 0.0
+        upstream.get("gnps", "https://gnps.ucsd.edu/")
+        assert upstream.get_breaker_state("gnps") == ("closed", 0)
+    upstream._breakers.clear()
+
+
+def test_upstream_deadline_timeout():
+    upstream._latencies.clear()
+    mock_client = unittest.mock.Mock()
+    mock_client.mget.return_value = None, None
+    mock_client.incr.return_value = 1
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis",
+        return_value=mock_client,
+    ), unittest.mock.patch.dict(
+        "metabolomics_spectrum_resolver.config.UPSTREAM_LIMITS", clear=True
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=requests.exceptions.ReadTimeout,
+    ):
+        # Timeouts shortened by the deadline don't count as failures.
+        with deadlines.scope(time.time() + 1), pytest.raises(
+            UsiError
+        ) as exc_info:
+            upstream.get("gnps", "https://gnps.ucsd.edu/", timeout=10)
+        assert exc_info.value.error_code == 504
+        assert unittest.mock.call("circuit:gnps:failures") not in (
+            mock_client.incr.call_args_list
+        )
+        assert len(upstream._latencies["gnps"]) == 0
+        # Timeouts within the deadline do.
+        with deadlines.scope(time.time() + 30), pytest.raises(
+            requests.exceptions.ReadTimeout
+        ):
+            upstream.get("gnps", "https://gnps.ucsd.edu/", timeout=10)
+        mock_client.incr.assert_called_once_with("circuit:gnps:failures")
+        assert len(upstream._latencies["gnps"]) == 1
+    upstream._latencies.clear()
+
+
+def test_upstream_hedged():
+    slow_response, fast_response = unittest.mock.Mock(), unittest.mock.Mock()
+    slow_response.status_code = fast_response.status_code = 200
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return slow_response
+        return fast_response
+
+    upstream._latencies.clear()
+    upstream._hedge_tokens.clear()
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=get,
+    ):
+        # Requests are not hedged without latency observations.
+        assert upstream.get_hedged("massive", "url") is slow_response
+        assert len(calls) == 1
+        upstream._latencies["massive"].extend(
+            [0.01] * upstream.config.LATENCY_MIN_SAMPLES
+        )
+        assert upstream.get_latency_percentile("massive", 95) == 0.01
+        # Slow requests are hedged within the budget.
+        calls.clear()
+        upstream._hedge_tokens["massive"] = 1
+        assert upstream.get_hedged("massive", "url") is fast_response
+        assert len(calls) == 2
+        calls.clear()
+        assert upstream.get_hedged("massive", "url") is slow_response
+        assert len(calls) == 1
+        # Backends without a budget are not hedged.
+        calls.clear()
+        upstream._latencies["massbank"].extend(
+            [0.01] * upstream.config.LATENCY_MIN_SAMPLES
+        )
+        assert upstream.get_hedged("massbank", "url") is slow_response
+        assert len(calls) == 1
+    upstream._latencies.clear()
+    upstream._hedge_tokens.clear()
+
+
+def test_upstream_mirrors():
+    responses = {}
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        host = url.split("/")[2]
+        if isinstance(responses[host], Exception):
+            raise responses[host]
+        time.sleep(0.5 if host == "slow" else 0)
+        response = unittest.mock.Mock()
+        response.status_code = responses[host]
+        return response
+
+    upstream._latencies.clear()
+    upstream._breakers.clear()
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=get,
+    ), unittest.mock.patch.dict(
+        upstream.config.UPSTREAM_MIRRORS,
+        {"gnps": ["https://slow", "https://fast"]},
+    ), unittest.mock.patch.object(
+        upstream.config, "MIRROR_RACE_DELAY", 0.1
+    ):
+        # Slow mirrors are raced against the next mirror.
+        responses.update({"slow": 200, "fast": 200})
+        start = time.time()
+        response = upstream.get_mirrored("gnps", "/path", "endpoint")
+        assert time.time() - start < 0.5
+        assert calls == ["https://slow/path", "https://fast/path"]
+        # Failed requests are immediately retried on the next mirror.
+        calls.clear()
+        responses.update({"slow": requests.exceptions.ConnectionError()})
+        for _ in range(upstream.config.CIRCUIT_BREAKER_THRESHOLD):
+            response = upstream.get_mirrored("gnps", "/path", "endpoint")
+            assert response.status_code == 200
+        # Unhealthy mirrors are used last.
+        threshold = upstream.config.CIRCUIT_BREAKER_THRESHOLD
+        assert upstream.get_mirror_breaker_states("gnps") == {
+            "https://slow": ("open", threshold),
+            "https://fast": ("closed", 0),
+        }
+        calls.clear()
+        response = upstream.get_mirrored("gnps", "/path", "endpoint")
+        assert calls == ["https://fast/path"]
+        # The last failure is used if all mirrors fail.
+        responses.update({"fast": 503})
+        with pytest.raises(UsiError) as exc_info:
+            upstream.get_mirrored("gnps", "/path", "endpoint")
+        assert exc_info.value.error_code == 503
+    upstream._latencies.clear()
+    upstream._breakers.clear()
+
+
+def test_upstream_timeouts():
+    upstream._latencies.clear()
+    upstream._breakers.clear()
+    # The maximum timeouts are used without latency observations.
+    assert upstream.get_timeout("massbank", "spectra") == (10, 15)
+    assert upstream.get_timeout("massive", "QuerySpectrum") == (10, 25)
+    # Timeouts are derived from the latencies, within the bounds.
+    upstream._latencies["massive:QuerySpectrum"].extend(
+        [2.0] * upstream.config.LATENCY_MIN_SAMPLES
+    )
+    assert upstream.get_timeout("massive", "QuerySpectrum") == (6.0, 6.0)
+    assert upstream.get_timeout("massive", "DownloadResultFile") == (10, 25)
+    upstream._latencies["massbank:spectra"].extend(
+        [0.01] * upstream.config.LATENCY_MIN_SAMPLES
+    )
+    assert upstream.get_timeout("massbank", "spectra") == (1, 1)
+    assert upstream.get_timeouts("massbank") == {
+        "default": (10, 15),
+        "spectra": (1, 1),
+    }
+    # Timed out requests are observed as slow requests.
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=requests.exceptions.ReadTimeout,
+    ) as mock_get:
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            upstream.get("massbank", "url", "spectra")
+        assert mock_get.call_args.kwargs["timeout"] == (1, 1)
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            upstream.get("massbank", "url", "spectra", timeout=5)
+        assert mock_get.call_args.kwargs["timeout"] == 5
+    assert len(upstream._latencies["massbank:spectra"]) == (
+        upstream.config.LATENCY_MIN_SAMPLES + 2
+    )
+    upstream._latencies.clear()
+    upstream._breakers.clear()
+
+
+def test_upstream_limits():
+    limits._semaphores.clear()
+    limits._buckets.clear()
+    backend_limits = {"concurrency": 1, "rate": 10, "burst": 1}
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch.dict(
+        limits.config.UPSTREAM_LIMITS, {"gnps": backend_limits}
+    ), unittest.mock.patch.object(
+        limits.config, "UPSTREAM_LIMIT_QUEUE_TIMEOUT", 0.5
+    ):
+        # Concurrent requests beyond the limit wait and eventually fail.
+        with limits.acquire("gnps"):
+            start = time.monotonic()
+            with pytest.raises(UsiError) as exc_info:
+                with limits.acquire("gnps"):
+                    pass
+            assert exc_info.value.error_code == 503
+            assert time.monotonic() - start >= 0.5
+        # Requests wait for tokens to limit the request rate.
+        with limits.acquire("gnps"):
+            pass
+        start = time.monotonic()
+        with limits.acquire("gnps"):
+            pass
+        assert time.monotonic() - start >= 0.05
+        # Backends without limits are not limited.
+        for _ in range(10):
+            with limits.acquire("massbank"):
+                pass
+        # Streamed responses hold their slot until they're closed.
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+            return_value=unittest.mock.Mock(status_code=200),
+        ):
+            response = upstream.get("gnps", "url", stream=True, timeout=1)
+            with pytest.raises(UsiError):
+                with limits.acquire("gnps"):
+                    pass
+            response.close()
+            with limits.acquire("gnps"):
+                pass
+    limits._semaphores.clear()
+    limits._buckets.clear()
+    upstream._latencies.clear()
+    # Slots are leased for the duration of the request's timeout, limited to
+    # the deadline.
+    assert upstream._get_lease((5, 120)) == 125
+    with deadlines.scope(time.time() + 10):
+        assert 14 < upstream._get_lease((5, 120)) <= 15
+    mock_client = unittest.mock.Mock()
+    mock_client.evalsha.return_value = 0
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis",
+        return_value=mock_client,
+    ), unittest.mock.patch.dict(
+        limits.config.UPSTREAM_LIMITS, {"gnps": backend_limits}
+    ):
+        with limits.acquire("gnps", 125):
+            pass
+        assert mock_client.evalsha.call_args.args[-1] == (
+            125 + limits.config.UPSTREAM_LIMIT_LEASE_GRACE
+        )
+        mock_client.zrem.assert_called_once()
+        # Limits can specify a minimum lease.
+        backend_limits["lease"] = 3600
+        with limits.acquire("gnps", 125):
+            pass
+        assert mock_client.evalsha.call_args.args[-1] == (
+            3600 + limits.config.UPSTREAM_LIMIT_LEASE_GRACE
+        )
+
+
+def test_deadlines():
+    assert deadlines.remaining() is None
+    assert deadlines.limit_timeout(45) == 45
+    with deadlines.scope(time.time() + 10):
+        assert 9 < deadlines.remaining() <= 10
+        assert deadlines.limit_timeout(45) <= 10
+        assert deadlines.limit_timeout(2) == 2
+        connect_timeout, read_timeout = deadlines.limit_timeout((2, 45))
+        assert connect_timeout == 2 and 9 < read_timeout <= 10
+        # Nested deadlines can only be shorter.
+        with deadlines.scope(time.time() + 20):
+            assert deadlines.remaining() <= 10
+        with deadlines.scope(time.time() + 1):
+            assert deadlines.remaining() <= 1
+        # The deadline is kept on other threads.
+        pool = concurrent.futures.ThreadPoolExecutor(1)
+        assert pool.submit(deadlines.bind(deadlines.get)).result() == (
+            deadlines.get()
+        )
+    assert deadlines.get() is None
+    with deadlines.scope(time.time() - 1):
+        assert deadlines.expired()
+        with pytest.raises(UsiError) as exc_info:
+            deadlines.remaining()
+        assert exc_info.value.error_code == 504
+        # Upstream requests for callers that gave up are abandoned.
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.upstream.get_session"
+        ) as mock_get_session, unittest.mock.patch(
+            "metabolomics_spectrum_resolver.caching.get_redis",
+            return_value=None,
+        ):
+            with pytest.raises(UsiError) as exc_info:
+                upstream.get("massbank", "https://massbank.eu", timeout=45)
+            assert exc_info.value.error_code == 504
+            assert mock_get_session.call_count == 0
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks._get_cached_usi"
+    ) as mock_get_cached_usi:
+        usi = "mzspec:MASSBANK::accession:SM858102"
+        with pytest.raises(UsiError) as exc_info:
+            tasks._task_parse_usi.run(usi, deadline=time.time() - 1)
+        assert exc_info.value.error_code == 504
+        assert mock_get_cached_usi.call_count == 0
+        tasks._task_parse_usi.run(usi, deadline=time.time() + 10)
+        assert mock_get_cached_usi.call_count == 1
+
+
+def test_get_splash():
+    rng = np.random.default_rng(42)
+    splash_builder = splash.Splash()
+    for i in range(100):
+        n_peaks = rng.integers(1, 500)
+        mz = np.sort(rng.uniform(50, 2000, n_peaks)).astype(np.float32)
+        intensity = rng.exponential(1000, n_peaks).astype(np.float32)
+        if i % 2 == 0:
+            # Include duplicate m/z values and intensities.
+            mz = np.round(mz).astype(np.float32)
+            intensity = np.ceil(intensity / 500).astype(np.float32)
+        splash_key = splash_builder.splash(
+            splash.Spectrum(
+                list(zip(mz.tolist(), intensity.tolist())),
+                splash.SpectrumType.MS,
+            )
+        )
+        assert splashing.get_splash(mz, intensity) == splash_key
+    # SPLASH computed by the reference implementation.
+    assert (
+        splashing.get_splash(
+            np.asarray(peaks_to_test[0]["mzs"], np.float32),
+            np.asarray(peaks_to_test[0]["intensities"], np.float32),
+        )
+        == "splash10-0006-0921310330-bb44bbf7213f0efe8aee"
+    )
+
+
+def test_get_spectrum_splash():
+    mz = np.asarray([100.0, 200.0, 300.0], np.float32)
+    intensity = np.asarray([10.0, 100.0, 50.0], np.float32)
+    spectrum = sus.MsmsSpectrum("test", 500.0, 1, mz, intensity)
+    splash_key = splashing.get_splash(mz, intensity)
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.splashing.get_splash",
+        wraps=splashing.get_splash,
+    ) as mock_get_splash:
+        assert splashing.get_spectrum_splash(spectrum) == splash_key
+        assert splashing.get_spectrum_splash(spectrum) == splash_key
+        assert mock_get_splash.call_count == 1
+        # Other spectra get their own SPLASH.
+        spectrum = sus.MsmsSpectrum(
+            "test", 500.0, 1, mz, intensity
+        ).filter_intensity(0.2)
+        assert splashing.get_spectrum_splash(spectrum) != splash_key
+        assert mock_get_splash.call_count == 2
+
+
+def test_centroid():
+    mz = np.arange(99.9, 100.1, 0.005)
+    intensity = 1000 * np.exp(-(((mz - 100.0013) / 0.01) ** 2))
+    # Profile peak with zero intensity padding, and a centroided peak.
+    mz = np.append(mz, [150.0, 200.0, 200.01])
+    intensity = np.append(intensity, [50.0, 0.0, 0.0])
+    centroid_mz, centroid_intensity = centroiding.centroid(mz, intensity)
+    np.testing.assert_allclose(centroid_mz, [100.0013, 150.0], atol=1e-3)
+    np.testing.assert_allclose(centroid_intensity, [1000, 50], rtol=0.01)
+    assert centroid_mz.dtype == np.float32
+    spectrum = centroiding.centroid_spectrum(
+        sus.MsmsSpectrum("test", 500.0, 2, mz, intensity, peptide="PEPTIDE")
+    )
+    assert spectrum.precursor_mz == 500.0
+    assert spectrum.precursor_charge == 2
+    assert spectrum.peptide == "PEPTIDE"
+    np.testing.assert_array_equal(spectrum.mz, centroid_mz)
+    usi = "mzspec:MASSBANK::accession:SM858102"
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch.object(
+        tasks._task_parse_usi,
+        "apply_async",
+        side_effect=redis.exceptions.ConnectionError,
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks.parsing.parse_usi",
+        return_value=(sus.MsmsSpectrum(usi, 0, 0, mz, intensity), "link"),
+    ):
+        assert len(tasks.parse_usi(usi)[0].mz) == len(mz)
+        assert len(tasks.parse_usi(usi, centroid=True)[0].mz) == 2
+    # Centroided spectra are cached separately.
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks.caching.get_revalidated"
+    ) as mock_get_revalidated:
+        tasks._task_parse_usi.run(usi, centroid=True)
+        mock_get_revalidated.assert_called_once_with(
+            tasks.cached_centroid_usi,
+            f"usi:centroid:{usi}",
+            usi,
+            refresh=True,
+        )
+    # Refreshes centroid a newly retrieved spectrum rather than the cached one.
+    stale_spectrum = sus.MsmsSpectrum(usi, 0, 0, [100.0], [1.0])
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks._get_cached_usi",
+        return_value=(stale_spectrum, "link"),
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks.parsing.parse_usi",
+        return_value=(sus.MsmsSpectrum(usi, 0, 0, mz, intensity), "link"),
+    ) as mock_parse_usi:
+        assert len(tasks._centroid_usi(usi)[0].mz) == 1
+        assert mock_parse_usi.call_count == 0
+        assert len(tasks._centroid_usi(usi, refresh=True)[0].mz) == 2
+        mock_parse_usi.assert_called_once_with(usi)
+
+
+def test_decode_peaks():
+    mz, intensity = [100.1, 200.2, 300.3], [10.0, 20.0, 30.0]
+    for peaks in [
+        [[100.1, 10.0], [200.2, 20.0], [300.3, 30.0]],
+        "[[100.1, 10.0], [200.2, 20.0], [300.3, 30.0]]",
+        b"[[100.1, 10.0], [200.2, 20.0], [300.3, 30.0]]",
+    ]:
+        peaks_mz, peaks_intensity = decoding.peak_arrays(peaks)
+        np.testing.assert_allclose(peaks_mz, mz, rtol=1e-6)
+        np.testing.assert_allclose(peaks_intensity, intensity)
+        # Arrays can be used by spectrum_utils without conversion.
+        for array in (peaks_mz, peaks_intensity):
+            assert array.dtype == np.float32
+            assert array.flags.c_contiguous and array.flags.writeable
+    peaks_mz, peaks_intensity = decoding.peak_arrays_text(
+        "100.1:10 200.2:20.0\n300.3:3e1"
+    )
+    np.testing.assert_allclose(peaks_mz, mz, rtol=1e-6)
+    np.testing.assert_allclose(peaks_intensity, intensity)
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.decoding.orjson", None
+    ):
+        assert decoding.loads(b'{"peaks": [[1, 2]]}') == {"peaks": [[1, 2]]}
+    for invalid_peaks in ["[]", [[1.0, 2.0, 3.0]], [[1.0, 2.0], [3.0]]]:
+        with pytest.raises(ValueError):
+            decoding.peak_arrays(invalid_peaks)
+    with pytest.raises(ValueError):
+        decoding.peak_arrays_text("100.1:10 200.2")
+    with pytest.raises(json.JSONDecodeError):
+        decoding.peak_arrays("[[100.1, 10.0]")
+
+
+def test_decode_response_spectrum():
+    def mock_response(body, chunk_size, headers=None):
+        response = unittest.mock.Mock(headers=headers or {})
+        response.iter_content.return_value = [
+            body[i : i + chunk_size] for i in range(0, len(body), chunk_size)
+        ]
+        return response
+
+    body = (
+        b'{"precursor": {"mz": 500.5}, "peaks": [[100.125, 10.0], '
+        b'[200.25, 2e1], [300.5, 30]], "annotations": [[1]]}'
+    )
+    # Chunks split the key and the numbers.
+    for chunk_size in [1, 7, 16, len(body)]:
+        response = mock_response(body, chunk_size)
+        spectrum_dict = decoding.response_spectrum_json(response)
+        response.close.assert_called_once()
+        assert spectrum_dict["precursor"] == {"mz": 500.5}
+        assert spectrum_dict["annotations"] == [[1]]
+        mz, intensity = spectrum_dict["peaks"]
+        np.testing.assert_allclose(mz, [100.125, 200.25, 300.5])
+        np.testing.assert_allclose(intensity, [10.0, 20.0, 30.0])
+        assert mz.dtype == np.float32 and mz.flags.c_contiguous
+    with pytest.raises(ValueError):
+        decoding.response_spectrum_json(mock_response(b'{"peaks": []}', 4))
+    with pytest.raises(json.JSONDecodeError):
+        decoding.response_spectrum_json(mock_response(b'{"peaks": [[1', 4))
+    # Oversized spectra are rejected.
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.MAX_SPECTRUM_PEAKS", 2
+    ), pytest.raises(UsiError) as exc_info:
+        decoding.response_spectrum_json(mock_response(body, 16))
+    assert exc_info.value.error_code == 413
+    assert exc_info.value.message == (
+        "The spectrum exceeds the maximum size of 2 peaks"
+    )
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.MAX_SPECTRUM_BYTES", 64
+    ):
+        for response in [
+            mock_response(body, 16),
+            mock_response(b"{}", 2, {"Content-Length": "65"}),
+        ]:
+            with pytest.raises(UsiError) as exc_info:
+                decoding.response_spectrum_json(response)
+            assert exc_info.value.error_code == 413
+            assert exc_info.value.message == (
+                "The spectrum exceeds the maximum size of 64 bytes"
+            )
+            response.close.assert_called_once()
+        response.iter_content.assert_not_called()
+
+
 def test_parse_gnps_task():
     usi = (
         "mzspec:GNPS:TASK-c95481f0c53d42e78a61bf899e9f9adb-spectra/"
         "specs_ms.mgf:scan:1943"
     )
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
     # Invalid task pattern.
     with pytest.raises(UsiError) as exc_info:
         parsing.parse_usi(usi.replace(":TASK-", ":TASK-666"))
@@ -106,19 +898,127 @@ def test_parse_gnps_task():
     assert exc_info.value.error_code == 404
 
 
+def test_parse_gnps_task_file_cache(tmp_path):
+    # Forget failed downloads from other tests.
+    taskfiles._downloads.clear()
+    mgf = (
+        b"BEGIN IONS\nPEPMASS=301.1\nCHARGE=2+\nSCANS=7\n"
+        b"100.1 10.0\n200.2 20.0\nEND IONS\n\n"
+        b"BEGIN IONS\nPEPMASS=401.1\nSCANS=1943\n"
+        b"300.3 30.0\nEND IONS\n"
+    )
+    response = unittest.mock.MagicMock(status_code=200)
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [mgf[:50], mgf[50:]]
+    task = "c95481f0c53d42e78a61bf899e9f9adb"
+    usi = f"mzspec:GNPS:TASK-{task}-spectra/specs_ms.mgf:scan:1943"
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.GNPS_TASK_FILE_CACHE",
+        str(tmp_path),
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        return_value=response,
+    ) as mock_get:
+        # The first request triggers the download in the background.
+        filename = "spectra/specs_ms.mgf"
+        assert taskfiles.get_spectrum(task, filename, "7") is None
+        for _ in range(50):
+            if taskfiles.get_spectrum(task, filename, "7"):
+                break
+            time.sleep(0.1)
+        assert mock_get.call_count == 1
+        assert "block=main" in mock_get.call_args[0][0]
+        mock_get.side_effect = requests.exceptions.ConnectionError
+        spectrum, source_link = parsing._parse_gnps_task(usi)
+        assert spectrum.precursor_mz == pytest.approx(401.1)
+        assert spectrum.precursor_charge == 0
+        np.testing.assert_allclose(spectrum.mz, [300.3])
+        assert task in source_link
+        spectrum, _ = parsing._parse_gnps_task(usi.replace(":1943", ":7"))
+        assert spectrum.precursor_mz == pytest.approx(301.1)
+        assert spectrum.precursor_charge == 2
+        np.testing.assert_allclose(spectrum.intensity, [10.0, 20.0])
+        # Scans missing from the cached file are retrieved from GNPS.
+        with pytest.raises(requests.exceptions.ConnectionError):
+            parsing._parse_gnps_task(usi.replace(":1943", ":8"))
+        # Least recently used files are evicted when the cache is too large.
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.config.GNPS_TASK_FILE_CACHE_SIZE",
+            sum(path.stat().st_size for path in tmp_path.iterdir()),
+        ):
+            taskfiles._evict()
+            assert len(list(tmp_path.iterdir())) == 2
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.config.GNPS_TASK_FILE_CACHE_SIZE",
+            0,
+        ):
+            taskfiles._evict()
+            assert len(list(tmp_path.iterdir())) == 0
+
+
+def test_parse_gnps_task_file_cache_retry(tmp_path):
+    response = unittest.mock.MagicMock(status_code=200)
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [b"BEGIN IONS\n" * 10]
+    task, filename = "0123456789abcdef0123456789abcdef", "spectra/large.mgf"
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.GNPS_TASK_FILE_CACHE",
+        str(tmp_path),
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.GNPS_TASK_FILE_MAX_SIZE", 10
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        return_value=response,
+    ) as mock_get, unittest.mock.patch(
+        "metabolomics_spectrum_resolver.taskfiles.upstream.executor"
+    ) as mock_executor, unittest.mock.patch.dict(
+        "metabolomics_spectrum_resolver.config.UPSTREAM_MIRRORS",
+        {"gnps": ["https://mirror.test"]},
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.limits.acquire",
+        wraps=limits.acquire,
+    ) as mock_acquire:
+        # Download synchronously.
+        mock_executor.return_value.submit.side_effect = lambda f, *a: f(*a)
+        # Files that are too large aren't downloaded again for a while.
+        for _ in range(3):
+            assert taskfiles.get_spectrum(task, filename, "1") is None
+        assert mock_get.call_count == 1
+        assert len(list(tmp_path.iterdir())) == 0
+        # Downloads use the configured mirrors, outside the interactive
+        # limits.
+        assert mock_get.call_args[0][0].startswith(
+            "https://mirror.test/ProteoSAFe/DownloadResultFile?"
+        )
+        assert mock_acquire.call_args[0][0] == "gnps_download"
+        # Until the retry interval has passed.
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.config."
+            "GNPS_TASK_FILE_RETRY_INTERVAL",
+            0,
+        ):
+            assert taskfiles.get_spectrum(task, filename, "1") is None
+        assert mock_get.call_count == 2
+    taskfiles._downloads.clear()
+
+
 def test_parse_massive_task():
     usi = (
         "mzspec:MassIVE:TASK-f4b86b150a164ee4a440b661e97a7193-"
         "spectra:scan:471429:TSMGGTQQQFVEGVR/2"
     )
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
 
 
 def test_parse_gnps_library():
     usi = "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00005436077"
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
     # Invalid index flag.
     with pytest.raises(UsiError) as exc_info:
         parsing.parse_usi(usi.replace(":accession:", ":index:"))
@@ -132,16 +1032,90 @@ def test_parse_gnps_library():
         )
     assert exc_info.value.error_code == 404
     # Verify that the most recent annotation is used.
-    spectrum, _, splash_key = parsing.parse_usi(
+    spectrum, _ = parsing.parse_usi(
         "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00000001547"
     )
     assert spectrum.precursor_mz == pytest.approx(981.54)
 
 
+def test_parse_gnps_library_store(tmp_path):
+    mgf_filename = tmp_path / "ALL_GNPS.mgf"
+    mgf_filename.write_text(
+        "BEGIN IONS\n"
+        "PEPMASS=981.54\n"
+        "CHARGE=1+\n"
+        "SPECTRUMID=CCMSLIB00000001547\n"
+        "SCANS=1\n"
+        "100.1 10.0\n"
+        "200.2 20.0\n"
+        "END IONS\n"
+        "BEGIN IONS\n"
+        "PEPMASS=500.1\n"
+        "SPECTRUMID=CCMSLIB00005436077\n"
+        "300.3\t30.0\n"
+        "END IONS\n"
+    )
+    store_path = str(tmp_path / "gnps_library")
+    assert ingest.ingest_gnps_library(str(mgf_filename), store_path) == 2
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.GNPS_LIBRARY_STORE",
+        store_path,
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=requests.exceptions.ConnectionError,
+    ):
+        spectrum, source_link = parsing._parse_gnps_library(
+            "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00000001547"
+        )
+        assert spectrum.precursor_mz == pytest.approx(981.54)
+        assert spectrum.precursor_charge == 1
+        np.testing.assert_allclose(spectrum.mz, [100.1, 200.2])
+        np.testing.assert_allclose(spectrum.intensity, [10.0, 20.0])
+        assert "CCMSLIB00000001547" in source_link
+        # Spectra missing from the store are retrieved from GNPS.
+        with pytest.raises(requests.exceptions.ConnectionError):
+            parsing._parse_gnps_library(
+                "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00000000001"
+            )
+    # Rebuilding the store replaces the previous spectra.
+    json_filename = tmp_path / "ALL_GNPS.json"
+    json_filename.write_text(
+        json.dumps(
+            [
+                {
+                    "spectrum_id": "CCMSLIB00000000001",
+                    "Precursor_MZ": "123.4",
+                    "Charge": "0",
+                    "peaks_json": "[[50.5, 1.0], [60.6, 2.0]]",
+                },
+                {"spectrum_id": "CCMSLIB00000000002", "peaks_json": "null"},
+            ]
+        )
+    )
+    assert ingest.ingest_gnps_library(str(json_filename), store_path) == 1
+    assert store.lookup(store_path, "CCMSLIB00000001547") is None
+    library_spectrum = store.lookup(store_path, "CCMSLIB00000000001")
+    assert library_spectrum.precursor_mz == pytest.approx(123.4)
+    np.testing.assert_allclose(library_spectrum.mz, [50.5, 60.6])
+    # Stores are swapped atomically and only the previous version is kept.
+    previous_store = store.SpectrumStore(store_path)
+    assert os.path.islink(store_path)
+    assert ingest.ingest_gnps_library(str(json_filename), store_path) == 1
+    assert not previous_store.is_current()
+    assert previous_store.get("CCMSLIB00000000001") is not None
+    assert ingest.ingest_gnps_library(str(json_filename), store_path) == 1
+    assert len(list(tmp_path.glob("gnps_library.v*"))) == 2
+    assert store.lookup(store_path, "CCMSLIB00000000001") is not None
+    assert store.lookup(str(tmp_path / "nonexisting"), "CCMSLIB1") is None
+    assert store.lookup(None, "CCMSLIB00000000001") is None
+
+
 def test_parse_massbank():
     usi = "mzspec:MASSBANK::accession:SM858102"
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
     # Invalid index flag.
     with pytest.raises(UsiError) as exc_info:
         parsing.parse_usi(usi.replace(":accession:", ":index:"))
@@ -154,10 +1128,48 @@ def test_parse_massbank():
     assert exc_info.value.error_code == 404
 
 
+def test_parse_massbank_store(tmp_path):
+    records_dir = tmp_path / "MassBank-data" / "AAFC"
+    records_dir.mkdir(parents=True)
+    (records_dir / "MSBNK-AAFC-AC000646.txt").write_text(
+        "ACCESSION: MSBNK-AAFC-AC000646\n"
+        "RECORD_TITLE: Example\n"
+        "MS$FOCUSED_ION: BASE_PEAK 181.0\n"
+        "MS$FOCUSED_ION: PRECURSOR_M/Z 195.0877\n"
+        "PK$NUM_PEAK: 2\n"
+        "PK$PEAK: m/z int. rel.int.\n"
+        "  110.0713 2400 240\n"
+        "  138.0662 9990 999\n"
+        "//\n"
+    )
+    (records_dir / "README.txt").write_text("Not a MassBank record.\n")
+    store_path = str(tmp_path / "massbank")
+    assert ingest.ingest_massbank(str(tmp_path), store_path) == 1
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.MASSBANK_STORE", store_path
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=requests.exceptions.ConnectionError,
+    ):
+        for accession in ("MSBNK-AAFC-AC000646", "AC000646"):
+            spectrum, source_link = parsing._parse_massbank(
+                f"mzspec:MASSBANK::accession:{accession}"
+            )
+            assert spectrum.precursor_mz == pytest.approx(195.0877)
+            np.testing.assert_allclose(spectrum.mz, [110.0713, 138.0662])
+            np.testing.assert_allclose(spectrum.intensity, [2400, 9990])
+            assert source_link.endswith("id=AC000646")
+        # Records missing from the store are retrieved from MassBank.
+        with pytest.raises(requests.exceptions.ConnectionError):
+            parsing._parse_massbank("mzspec:MASSBANK::accession:SM858102")
+
+
 def test_parse_ms2lda():
     usi = "mzspec:MS2LDA:TASK-190:accession:270684"
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
     # Invalid task pattern.
     with pytest.raises(UsiError) as exc_info:
         parsing.parse_usi(usi.replace(":TASK-", ":TASK-bla"))
@@ -178,10 +1190,126 @@ def test_parse_ms2lda():
     assert exc_info.value.error_code == 404
 
 
+def _mock_json_response(payload):
+    response = unittest.mock.MagicMock(status_code=200, headers={})
+    response.__enter__.return_value = response
+    response.iter_content.return_value = [json.dumps(payload).encode()]
+    return response
+
+
+def test_parse_ms2lda_prefetch(tmp_path):
+    responses = {
+        ms2lda.EXPERIMENT_URL.format("190"): [
+            {
+                "document_id": 270684,
+                "precursor_mz": 255.1,
+                "peaks": [[100.1, 10.0], [200.2, 20.0]],
+            },
+            {"document_id": 270685, "precursor_mz": None, "peaks": []},
+            # Documents without an identifier are skipped.
+            {"precursor_mz": 300.1, "peaks": [[100.1, 10.0]]},
+        ],
+        ms2lda.MOTIFSETS_URL: {"motifset": 1},
+        ms2lda.MOTIFSET_URL.format(1): {
+            "motif_1.m2m": {"fragment_100.5": 0.2, "loss_18.0": 0.5},
+            "motif_2.m2m": {"fragment_80.5": 0.3, "fragment_60.5": 0.1},
+            "motif_3.m2m": {"fragment_70.5": 0.3},
+        },
+        ms2lda.MOTIFSET_METADATA_URL.format(1): {
+            "motif_1.m2m": {"motif_id": 171163},
+            "motif_2.m2m": {"motif_id": 171164},
+        },
+    }
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.MS2LDA_STORE",
+        str(tmp_path / "ms2lda"),
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.MOTIFDB_STORE",
+        str(tmp_path / "motifdb"),
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=lambda url, **_: _mock_json_response(responses[url]),
+    ) as mock_get:
+        # The first requests trigger the prefetches in the background.
+        assert ms2lda.get_document("190", "270684") is None
+        assert ms2lda.get_motif("171163") is None
+        for _ in range(50):
+            if (tmp_path / "ms2lda" / "190").exists() and (
+                tmp_path / "motifdb"
+            ).exists():
+                break
+            time.sleep(0.1)
+        assert mock_get.call_count == 4
+        mock_get.side_effect = requests.exceptions.ConnectionError
+        spectrum, source_link = parsing._parse_ms2lda(
+            "mzspec:MS2LDA:TASK-190:accession:270684"
+        )
+        assert spectrum.precursor_mz == pytest.approx(255.1)
+        np.testing.assert_allclose(spectrum.mz, [100.1, 200.2])
+        np.testing.assert_allclose(spectrum.intensity, [10.0, 20.0])
+        assert "270684" in source_link
+        spectrum, source_link = parsing._parse_motifdb(
+            "mzspec:MOTIFDB::accession:171164"
+        )
+        np.testing.assert_allclose(spectrum.mz, [60.5, 80.5])
+        np.testing.assert_allclose(spectrum.intensity, [0.1, 0.3])
+        assert "171164" in source_link
+        # Documents and motifs missing locally are retrieved from MS2LDA.
+        with pytest.raises(requests.exceptions.ConnectionError):
+            parsing._parse_ms2lda("mzspec:MS2LDA:TASK-190:accession:270686")
+        with pytest.raises(requests.exceptions.ConnectionError):
+            parsing._parse_motifdb("mzspec:MOTIFDB::accession:171165")
+        assert store.lookup(str(tmp_path / "ms2lda" / "190"), "None") is None
+        # Outdated stores are served while they're prefetched again.
+        store_path = tmp_path / "ms2lda" / "190"
+        outdated = time.time() - ms2lda.config.MS2LDA_STORE_MAX_AGE - 1
+        os.utime(store_path, (outdated, outdated))
+        mock_get.reset_mock()
+        mock_get.side_effect = lambda url, **_: _mock_json_response(
+            responses[url]
+        )
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.config.MS2LDA_PREFETCH_INTERVAL", 0
+        ):
+            assert ms2lda.get_document("190", "270684") is not None
+            for _ in range(50):
+                if store_path.stat().st_mtime > outdated:
+                    break
+                time.sleep(0.1)
+        assert mock_get.call_count == 1
+        assert ms2lda.get_document("190", "270684") is not None
+        # Unexpected or empty payloads don't replace the stores.
+        for payload in [["Unknown experiment"], []]:
+            mock_get.side_effect = lambda url, **_: _mock_json_response(
+                payload
+            )
+            for prefetch, args in [
+                (ms2lda.prefetch_experiment, ("190",)),
+                (ms2lda.prefetch_motifdb, ()),
+            ]:
+                with pytest.raises(ValueError):
+                    prefetch(str(tmp_path / "invalid"), *args)
+                assert not (tmp_path / "invalid").exists()
+        # Prefetches are limited in size.
+        mock_get.side_effect = lambda url, **_: _mock_json_response(
+            responses[url]
+        )
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.config.MS2LDA_PREFETCH_MAX_BYTES",
+            16,
+        ):
+            with pytest.raises(UsiError) as exc_info:
+                ms2lda.prefetch_experiment(str(tmp_path / "invalid"), "190")
+            assert exc_info.value.error_code == 413
+            assert not (tmp_path / "invalid").exists()
+
+
 def test_parse_msv_pxd():
     usi = "mzspec:MSV000079514:Adult_Frontalcortex_bRP_Elite_85_f09:scan:17555"
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
     # Invalid collection.
     with pytest.raises(UsiError) as exc_info:
         parsing.parse_usi(usi.replace(":MSV000079514:", ":MSV666666666:"))
@@ -205,10 +1333,267 @@ def test_parse_msv_pxd():
     assert exc_info.value.error_code == 404
 
 
+def _mzml_binary_data_array(values, accessions):
+    return (
+        f'<binaryDataArray encodedLength="{len(values)}">'
+        + "".join(f'<cvParam accession="{acc}"/>' for acc in accessions)
+        + f"<binary>{values}</binary></binaryDataArray>"
+    )
+
+
+def _mzml_spectrum(scan, mz, intensity):
+    return (
+        f'<spectrum index="{scan - 1}" '
+        f'id="controllerType=0 controllerNumber=1 scan={scan}" '
+        f'defaultArrayLength="3"><precursorList><precursor><selectedIonList>'
+        f'<selectedIon><cvParam accession="MS:1000744" value="445.12"/>'
+        f'<cvParam accession="MS:1000041" value="2"/></selectedIon>'
+        f"</selectedIonList></precursor></precursorList>"
+        f"<binaryDataArrayList>{mz}{intensity}</binaryDataArrayList>"
+        f"</spectrum>\n"
+    )
+
+
+def test_parse_msv_pxd_local(tmp_path):
+    mz = np.asarray([100.1, 200.2, 300.3])
+    intensity = np.asarray([10.0, 20.0, 30.0])
+    # Uncompressed, zlib, and MS-Numpress binary data arrays.
+    spectra = [
+        _mzml_spectrum(
+            1,
+            _mzml_binary_data_array(
+                base64.b64encode(mz.astype("<f8").tobytes()).decode(),
+                ["MS:1000514", "MS:1000523", "MS:1000576"],
+            ),
+            _mzml_binary_data_array(
+                base64.b64encode(
+                    zlib.compress(intensity.astype("<f4").tobytes())
+                ).decode(),
+                ["MS:1000515", "MS:1000521", "MS:1000574"],
+            ),
+        ),
+        _mzml_spectrum(
+            2,
+            _mzml_binary_data_array(
+                "eJxz6HdgAAGWdkYGDj5mhgYAFk0CNQ==",
+                ["MS:1000514", "MS:1000523", "MS:1002746"],
+            ),
+            _mzml_binary_data_array(
+                "QI9AAAAAAABeCeULag0=", ["MS:1000515", "MS:1002314"]
+            ),
+        ),
+        _mzml_spectrum(
+            3,
+            _mzml_binary_data_array(
+                base64.b64encode(mz.astype("<f8").tobytes()).decode(),
+                ["MS:1000514", "MS:1000523"],
+            ),
+            _mzml_binary_data_array("emQW4Q==", ["MS:1000515", "MS:1002313"]),
+        ),
+    ]
+    mzml = '<?xml version="1.0"?>\n<indexedmzML><mzML><run><spectrumList>\n'
+    offsets = []
+    for spectrum in spectra:
+        offsets.append(len(mzml))
+        mzml += spectrum
+    mzml += "</spectrumList></run></mzML>\n"
+    index_offset = len(mzml)
+    mzml += (
+        '<indexList count="1"><index name="spectrum">'
+        + "".join(
+            f'<offset idRef="controllerType=0 controllerNumber=1 '
+            f'scan={i}">{offset}</offset>'
+            for i, offset in enumerate(offsets, 1)
+        )
+        + "</index></indexList>\n"
+        f"<indexListOffset>{index_offset}</indexListOffset>\n"
+        "</indexedmzML>\n"
+    )
+    dataset_dir = tmp_path / "MSV000000001" / "peak"
+    dataset_dir.mkdir(parents=True)
+    (dataset_dir / "run1.mzML").write_text(mzml)
+    # Non-indexed file, which is indexed by scanning it.
+    (dataset_dir / "run2.mzML").write_text(mzml[:index_offset])
+    # mzML files are preferred over MGF files.
+    (dataset_dir / "run2.mgf").write_text("")
+    peaks = base64.b64encode(
+        np.column_stack([mz, intensity]).astype(">f4").tobytes()
+    ).decode()
+    (dataset_dir / "run3.mzXML").write_text(
+        '<?xml version="1.0"?>\n<mzXML><msRun>'
+        '<scan num="5" msLevel="1"><peaks precision="32" byteOrder="network"'
+        ' contentType="m/z-int">AAAAAAAAAAA=</peaks>'
+        '<scan num="6" msLevel="2">'
+        '<precursorMz precursorCharge="2">445.12</precursorMz>'
+        '<peaks precision="32" byteOrder="network" contentType="m/z-int">'
+        f"{peaks}</peaks></scan></scan></msRun></mzXML>\n"
+    )
+    (dataset_dir / "run4.mgf").write_text(
+        "BEGIN IONS\nPEPMASS=445.12\nCHARGE=2+\nSCANS=7\n"
+        "100.1 10.0\n200.2 20.0\n300.3 30.0\nEND IONS\n"
+    )
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.LOCAL_DATASET_ROOT",
+        str(tmp_path),
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
+        side_effect=requests.exceptions.ConnectionError,
+    ):
+        for ms_run, scan in [
+            ("run1", 1),
+            ("run1", 2),
+            ("run1", 3),
+            ("run2", 1),
+            ("run2", 3),
+            ("run3", 6),
+            ("run4", 7),
+        ]:
+            spectrum, source_link = parsing._parse_msv_pxd(
+                f"mzspec:MSV000000001:{ms_run}:scan:{scan}"
+            )
+            assert spectrum.precursor_mz == pytest.approx(445.12)
+            assert spectrum.precursor_charge == 2
+            np.testing.assert_allclose(spectrum.mz, mz, rtol=1e-6)
+            np.testing.assert_allclose(spectrum.intensity, intensity, 1e-3)
+            assert "MSV000000001" in source_link
+        assert datasets.get_spectrum("MSV000000001", "run1", "4") is None
+        assert datasets.get_spectrum("MSV000000001", "run5", "1") is None
+        assert datasets.get_spectrum("MSV000000002", "run1", "1") is None
+        # Missing spectra are retrieved from MassIVE.
+        with pytest.raises(requests.exceptions.ConnectionError):
+            parsing._parse_msv_pxd("mzspec:MSV000000001:run1:scan:4")
+        # Concurrent lookups scan the dataset and index the file only once.
+        datasets._listings.clear()
+        datasets._open_files.clear()
+
+        def slow(func, *args):
+            time.sleep(0.2)
+            return func(*args)
+
+        with unittest.mock.patch(
+            "metabolomics_spectrum_resolver.datasets._list_files",
+            side_effect=functools.partial(slow, datasets._list_files),
+        ) as mock_list_files, unittest.mock.patch(
+            "metabolomics_spectrum_resolver.datasets.peakfiles.index_mzml",
+            side_effect=functools.partial(slow, datasets.peakfiles.index_mzml),
+        ) as mock_index_mzml:
+            with concurrent.futures.ThreadPoolExecutor(4) as pool:
+                results = list(
+                    pool.map(
+                        lambda _: datasets.get_spectrum(
+                            "MSV000000001", "run1", "1"
+                        ),
+                        range(4),
+                    )
+                )
+        assert all(result[0] == pytest.approx(445.12) for result in results)
+        assert mock_list_files.call_count == 1
+        assert mock_index_mzml.call_count == 1
+    datasets._listings.clear()
+    datasets._open_files.clear()
+
+
+def test_probe_msv_files():
+    def _fetch_msv_file_spectrum(file_descriptor, scan):
+        delay, found = {
+            "a.mzML": (0.3, False),
+            "b.mzML": (0.5, True),
+            "c.mzML": (0.0, True),
+            "d.mzML": (0.0, False),
+            "e.mzML": (0.0, None),
+        }[file_descriptor]
+        time.sleep(delay)
+        if found is None:
+            raise requests.exceptions.HTTPError("503 Server Error")
+        return {"file": file_descriptor, "scan": scan} if found else None
+
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.parsing._fetch_msv_file_spectrum",
+        side_effect=_fetch_msv_file_spectrum,
+    ):
+        # The earliest candidate that contains the scan is preferred.
+        spectrum_dict = parsing._probe_msv_files(
+            ["a.mzML", "b.mzML", "c.mzML"], "1"
+        )
+        assert spectrum_dict == ("b.mzML", {"file": "b.mzML", "scan": "1"})
+        # More candidates than the fan-out.
+        spectrum_dict = parsing._probe_msv_files(
+            ["d.mzML"] * 10 + ["c.mzML"], "2"
+        )
+        assert spectrum_dict == ("c.mzML", {"file": "c.mzML", "scan": "2"})
+        assert parsing._probe_msv_files(["d.mzML"] * 10, "3") is None
+        assert parsing._probe_msv_files([], "4") is None
+        # Failed probes are skipped and not reported as probed.
+        probed = {}
+        spectrum_dict = parsing._probe_msv_files(
+            ["e.mzML", "d.mzML", "c.mzML"], "5", probed
+        )
+        assert spectrum_dict == ("c.mzML", {"file": "c.mzML", "scan": "5"})
+        assert probed == {"d.mzML": False, "c.mzML": True}
+
+
+def test_parse_msv_pxd_file_cache():
+    def _fetch_msv_file_spectrum(file_descriptor, scan):
+        if file_descriptor == "b.mzML" and scan != "3":
+            return {"peaks": (mz, intensity), "precursor": {"charge": 2}}
+        return None
+
+    mz = np.asarray([100.1, 200.2], np.float32)
+    intensity = np.asarray([10.0, 20.0], np.float32)
+    lookup_response = unittest.mock.Mock()
+    lookup_response.content = json.dumps(
+        {
+            "row_data": [
+                {"file_descriptor": file_descriptor}
+                for file_descriptor in ["a.mzML", "b.mzML", "c.txt"]
+            ]
+        }
+    ).encode()
+    caching._msv_files.clear()
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.caching.get_redis", return_value=None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.config.LOCAL_DATASET_ROOT", None
+    ), unittest.mock.patch(
+        "metabolomics_spectrum_resolver.parsing.upstream.get_hedged",
+        return_value=lookup_response,
+    ) as mock_get_hedged, unittest.mock.patch(
+        "metabolomics_spectrum_resolver.parsing._fetch_msv_file_spectrum",
+        side_effect=_fetch_msv_file_spectrum,
+    ) as mock_fetch:
+        usi = "mzspec:MSV000000001:run1:scan:{}"
+        spectrum, _ = parsing._parse_msv_pxd(usi.format(1))
+        assert spectrum.precursor_charge == 2
+        assert mock_get_hedged.call_count == 1
+        assert mock_fetch.call_count == 2
+        assert caching.get_msv_files("MSV000000001", "run1") == {
+            "a.mzML": False,
+            "b.mzML": True,
+        }
+        # Later scans are retrieved directly from the file that contained
+        # the earlier scan.
+        spectrum, _ = parsing._parse_msv_pxd(usi.format(2))
+        np.testing.assert_array_equal(spectrum.mz, mz)
+        assert mock_get_hedged.call_count == 1
+        mock_fetch.assert_called_with("b.mzML", "2")
+        # Files that didn't contain scans are only tried as a last resort.
+        with pytest.raises(UsiError) as exc_info:
+            parsing._parse_msv_pxd(usi.format(3))
+        assert exc_info.value.error_code == 404
+        assert mock_get_hedged.call_count == 2
+        assert mock_fetch.call_args_list[-2:] == [
+            unittest.mock.call("b.mzML", "3"),
+            unittest.mock.call("a.mzML", "3"),
+        ]
+    caching._msv_files.clear()
+
+
 def test_parse_motifdb():
     usi = "mzspec:MOTIFDB::accession:171163"
-    spectrum, _, splash_key = parsing.parse_usi(usi)
-    assert splash_key == _get_splash_remote(spectrum)
+    spectrum, _ = parsing.parse_usi(usi)
+    assert splashing.get_spectrum_splash(spectrum) == _get_splash_remote(
+        spectrum
+    )
     # Invalid index flag.
     with pytest.raises(UsiError) as exc_info:
         parsing.parse_usi(usi.replace(":accession:", ":index:"))
@@ -221,7 +1606,7 @@ def test_parse_motifdb():
 
 def test_parse_timeout():
     with unittest.mock.patch(
-        "metabolomics_spectrum_resolver.parsing.requests.get",
+        "metabolomics_spectrum_resolver.upstream.requests.Session.get",
         side_effect=UsiError(
             "Timeout while retrieving the USI from an " "external resource",
             504,
@@ -233,6 +1618,57 @@ def test_parse_timeout():
         assert exc_info.value.error_code == 504
 
 
+def test_parse_usis():
+    def _parse_usi(usi, centroid=False):
+        # Each lookup has its own deadline.
+        assert 0 < deadlines.remaining() <= tasks.config.REQUEST_TIMEOUT
+        if "MASSBANK" in usi:
+            time.sleep(0.5)
+        elif usi.endswith("404"):
+            time.sleep(0.3)
+        else:
+            time.sleep(0.1)
+        if usi.endswith("404"):
+            raise UsiError("Unknown USI", 404)
+        return usi
+
+    usis = [
+        "mzspec:MASSBANK::accession:SM858102",
+        "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00005436077",
+        "mzspec:GNPS:GNPS-LIBRARY:accession:CCMSLIB00005436077",
+        "mzspec:MOTIFDB::accession:404",
+        "this:is:an:invalid:usi",
+    ]
+    with unittest.mock.patch(
+        "metabolomics_spectrum_resolver.tasks.parse_usi",
+        side_effect=_parse_usi,
+    ) as mock_parse_usi:
+        results = list(tasks.parse_usis(usis))
+    # Duplicate USIs are only resolved once.
+    assert mock_parse_usi.call_count == 3
+    # Results are in completion order.
+    assert [usi for usi, _ in results] == [
+        usis[4],
+        usis[1],
+        usis[3],
+        usis[0],
+    ]
+    assert results[0][1].error_code == 400
+    assert results[1][1] == usis[1]
+    assert results[2][1].error_code == 404
+    assert results[3][1] == usis[0]
+
+
+def test_upstream_session_pooled():
+    session = upstream.get_session("gnps")
+    assert upstream.get_session("gnps") is session
+    assert upstream.get_session("massive") is not session
+    adapter = session.get_adapter("https://gnps.ucsd.edu/")
+    assert adapter._pool_maxsize == 64
+    assert adapter.max_retries.total == 2
+    assert adapter.max_retries.read == 0
+
+
 def _get_plotting_args(**kwargs):
     plotting_args = views.default_drawing_controls.copy()
     plotting_args["max_intensity"] = plotting_args["max_intensity_unlabeled"]
@@ -351,9 +1787,25 @@ def test_get_plotting_args_invalid_fragment_mz_tolerance():
     )
 
 
+def test_get_plotting_args_flags():
+    for value, flag in [
+        ("True", True),
+        ("true", True),
+        (True, True),
+        ("False", False),
+        ("false", False),
+        (None, False),
+    ]:
+        plotting_args = views.get_drawing_controls(
+            **_get_plotting_args(grid=value, centroid=value)
+        )
+        assert plotting_args["grid"] == flag
+        assert plotting_args["centroid"] == flag
+
+
 def test_prepare_spectrum():
     usi = "mzspec:MOTIFDB::accession:171163"
-    spectrum, _, _ = parsing.parse_usi(usi)
+    spectrum, _ = parsing.parse_usi(usi)
     spectrum_processed = views.prepare_spectrum(
         spectrum,
         **views.get_drawing_controls(
@@ -372,7 +1824,7 @@ def test_prepare_spectrum():
 
 def test_prepare_spectrum_annotate_peaks_default():
     usi = "mzspec:MOTIFDB::accession:171163"
-    spectrum, _, _ = parsing.parse_usi(usi)
+    spectrum, _ = parsing.parse_usi(usi)
     spectrum_processed = views.prepare_spectrum(
         spectrum, **views.get_drawing_controls(**_get_plotting_args())
     )
@@ -383,7 +1835,7 @@ def test_prepare_spectrum_annotate_peaks_default():
 
 def test_prepare_spectrum_annotate_peaks_specified():
     usi = "mzspec:MOTIFDB::accession:171163"
-    spectrum, _, _ = parsing.parse_usi(usi)
+    spectrum, _ = parsing.parse_usi(usi)
     spectrum_processed = views.prepare_spectrum(
         spectrum,
         **views.get_drawing_controls(
@@ -410,7 +1862,7 @@ def test_prepare_spectrum_annotate_peaks_specified():
 
 def test_prepare_spectrum_annotate_peaks_specified_invalid():
     usi = "mzspec:MOTIFDB::accession:171163"
-    spectrum, _, _ = parsing.parse_usi(usi)
+    spectrum, _ = parsing.parse_usi(usi)
     spectrum_processed = views.prepare_spectrum(
         spectrum,
         **views.get_drawing_controls(
@@ -425,8 +1877,8 @@ def test_prepare_spectrum_annotate_peaks_specified_invalid():
 def test_prepare_mirror_spectra():
     usi1 = "mzspec:MOTIFDB::accession:171163"
     usi2 = "mzspec:MOTIFDB::accession:171164"
-    spectrum1, _, _ = parsing.parse_usi(usi1)
-    spectrum2, _, _ = parsing.parse_usi(usi2)
+    spectrum1, _ = parsing.parse_usi(usi1)
+    spectrum2, _ = parsing.parse_usi(usi2)
     spectrum1_processed, spectrum2_processed = views._prepare_mirror_spectra(
         spectrum1,
         spectrum2,